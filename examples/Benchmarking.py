@@ -103,11 +103,12 @@ def GT_SNR_CNR(GT):
     None
     """
 
-    for index, row in GT.iterrows():
-        mu = np.array([row["mu_air"], row["mu_wax"], row["mu_tissue"]])
-        sigma = np.array([row["sigma_air"], row["sigma_wax"], row["sigma_tissue"]])
-        output_fname = "{}/{}_GT.csv".format(phantom_dir, row["phantom_name"])
-        output_df = QM_calc.QM_calc(mu, sigma, results_dir = "NA", save_results = False, verbose = False) # will save results manually
+    mu = GT[["mu_air", "mu_wax", "mu_tissue"]].values
+    sigma = GT[["sigma_air", "sigma_wax", "sigma_tissue"]].values
+    SNR, CNR = QM_calc.SNR_CNR(mu, sigma) # all phantoms at once, shape (n_phantoms, 3, 3)
+    for i, phantom_name in enumerate(GT["phantom_name"]):
+        output_fname = "{}/{}_GT.csv".format(phantom_dir, phantom_name)
+        output_df = QM_calc.SNR_CNR_table(SNR[i], CNR[i])
         output_df.to_csv(output_fname)
 
 # Fit GMMs, calculate SNR and CNR
@@ -139,7 +140,7 @@ def GMM_SNR_CNR(GT):
         GMM_fit.plot_GMM_fit(I, GMM, phantom_fname)
         plt.close()
         output_fname = "{}/{}_fitted.csv".format(phantom_dir, row["phantom_name"])
-        output_df = QM_calc.QM_calc(mu_fitted, sigma_fitted, results_dir = "NA", save_results = False, verbose = False)
+        output_df = QM_calc.SNR_CNR_table(*QM_calc.SNR_CNR(mu_fitted, sigma_fitted))
         output_df.to_csv(output_fname)
 
 # Calculate SNR and CNR using conventional user-defined ROIs method
@@ -169,7 +170,7 @@ def SNR_CNR_conv(GT):
             mu_conv.append(mu_sigma_avg[0])
             sigma_conv.append(mu_sigma_avg[1])
         output_fname = "{}/{}_conv.csv".format(phantom_dir, row["phantom_name"])
-        output_df = QM_calc.QM_calc(mu_conv, sigma_conv, results_dir = "NA", save_results = False, verbose = False)
+        output_df = QM_calc.SNR_CNR_table(*QM_calc.SNR_CNR(mu_conv, sigma_conv))
         output_df.to_csv(output_fname)
     
 def r2_val(x, y):
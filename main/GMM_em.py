@@ -0,0 +1,570 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.special import logsumexp
+
+CHUNK_SIZE = 2**18 # voxels per chunk of fit_voxels_chunked, temporary arrays hold CHUNK_SIZE * n_gaussians values
+
+class GMMResult:
+    """ Fitted 1-D Gaussian mixture model, with the same attributes as sklearn.mixture.GaussianMixture
+
+    Can be passed anywhere a fitted GaussianMixture is expected, e.g. GMM_fit.extract_GMM_results.
+
+    Parameters
+    ----------
+    means : array-like, shape (n_gaussians, )
+        Means of Gaussian components
+    variances : array-like, shape (n_gaussians, )
+        Variances of Gaussian components
+    weights : array-like, shape (n_gaussians, )
+        Weights of Gaussian components
+    n_iter : int
+        Number of EM iterations used
+    converged : bool
+        True if EM converged before max_iter
+    lower_bound : float
+        Mean log-likelihood per voxel of the fitted model
+    lower_bound_history : list, optional
+        Mean log-likelihood per voxel at each EM iteration
+    """
+
+    def __init__(self, means, variances, weights, n_iter = 0, converged = True, lower_bound = -np.inf, lower_bound_history = None):
+        means = np.asarray(means, dtype = np.float64)
+        n_gaussians = len(means)
+        self.n_components = n_gaussians
+        self.means_ = means.reshape([n_gaussians, 1])
+        self.covariances_ = np.asarray(variances, dtype = np.float64).reshape([n_gaussians, 1, 1])
+        self.precisions_ = 1. / self.covariances_
+        self.weights_ = np.asarray(weights, dtype = np.float64).reshape([n_gaussians])
+        self.n_iter_ = n_iter
+        self.converged_ = converged
+        self.lower_bound_ = lower_bound
+        self.lower_bound_history_ = lower_bound_history
+
+def estimate_log_prob(x, means, variances, weights):
+    """ Weighted log probability density of each Gaussian component at x
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of grey values, shape (n, )
+    means, variances, weights : numpy array
+        1-D arrays of component parameters, shape (n_gaussians, )
+
+    Returns
+    -------
+    numpy array
+        log(weight * N(x | mean, variance)), shape (n, n_gaussians)
+    """
+    x = x[:, np.newaxis]
+    return -0.5 * (np.log(2 * np.pi * variances) + (x - means) ** 2 / variances) + np.log(weights)
+
+def init_histogram(x, counts, n_gaussians, n_kmeans_iter = 100, centres = None):
+    """ Initialises component parameters by weighted k-means on histogram bins, as sklearn does on voxels
+
+    Unless centres are given, cluster centres are seeded at equal-count quantiles of the histogram, so
+    initialisation is deterministic.
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres
+    counts : numpy array
+        1-D array of voxel counts per bin
+    n_gaussians : int
+        Number of Gaussian components
+    n_kmeans_iter : int, default 100
+        Maximum number of k-means iterations
+    centres : numpy array, optional
+        Initial cluster centres, shape (n_gaussians, ), e.g. output from kmeans_plusplus_centres
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        1-D arrays of initial component parameters, shape (n_gaussians, )
+    """
+    if centres is None:
+        cdf = np.cumsum(counts) / counts.sum()
+        centres = x[np.minimum(np.searchsorted(cdf, (np.arange(n_gaussians) + 0.5) / n_gaussians), len(x) - 1)]
+    for i in range(n_kmeans_iter):
+        labels = np.argmin(np.abs(x[:, np.newaxis] - centres), axis = 1)
+        resp = np.zeros([len(x), n_gaussians])
+        resp[np.arange(len(x)), labels] = 1.
+        nk = counts @ resp
+        new_centres = np.where(nk > 0, ((counts * x) @ resp) / np.maximum(nk, 1), centres)
+        if np.allclose(new_centres, centres):
+            break
+        centres = new_centres
+    return m_step(x, counts, resp)
+
+def kmeans_plusplus_centres(x, counts, n_gaussians, rng):
+    """ Draws initial cluster centres from histogram bins by k-means++ seeding, weighting bins by their counts
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres
+    counts : numpy array
+        1-D array of voxel counts per bin
+    n_gaussians : int
+        Number of Gaussian components
+    rng : numpy.random.RandomState
+        Random number generator
+
+    Returns
+    -------
+    numpy array
+        1-D array of cluster centres, shape (n_gaussians, )
+    """
+    centres = [x[rng.choice(len(x), p = counts / counts.sum())]]
+    for i in range(1, n_gaussians):
+        p = counts * np.min((x[:, np.newaxis] - np.array(centres)) ** 2, axis = 1) # squared distance to nearest centre
+        p = counts if p.sum() == 0 else p
+        centres.append(x[rng.choice(len(x), p = p / p.sum())])
+    return np.array(centres)
+
+def init_quantile(x, counts, n_gaussians):
+    """ Initialises component parameters from equal-count slices of the histogram, without k-means
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres
+    counts : numpy array
+        1-D array of voxel counts per bin
+    n_gaussians : int
+        Number of Gaussian components
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        1-D arrays of initial component parameters, shape (n_gaussians, )
+    """
+    cdf = np.cumsum(counts) / counts.sum()
+    labels = np.minimum((cdf - 0.5 * counts / counts.sum()) * n_gaussians, n_gaussians - 1).astype(int)
+    resp = np.zeros([len(x), n_gaussians])
+    resp[np.arange(len(x)), labels] = 1.
+    return m_step(x, counts, resp)
+
+def m_step(x, counts, resp, reg_covar = 1e-6):
+    """ Maximisation step of EM with voxel counts as sample weights
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of grey values (or bin centres), shape (n, )
+    counts : numpy array
+        1-D array of voxel counts per grey value, shape (n, )
+    resp : numpy array
+        Responsibilities of each component for each grey value, shape (n, n_gaussians)
+    reg_covar : float, default 1e-6
+        Added to variances to keep them positive, as in sklearn
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        1-D arrays of component parameters, shape (n_gaussians, )
+    """
+    weighted_resp = counts[:, np.newaxis] * resp
+    nk = weighted_resp.sum(axis = 0) + 10 * np.finfo(np.float64).eps
+    means = (x @ weighted_resp) / nk
+    variances = ((x[:, np.newaxis] - means) ** 2 * weighted_resp).sum(axis = 0) / nk + reg_covar
+    weights = nk / nk.sum()
+    return means, variances, weights
+
+def fit_histogram(x, counts, n_gaussians, means_init = None, variances_init = None, weights_init = None, tol = 1e-3, max_iter = 100, reg_covar = 1e-6):
+    """ Fits a 1-D Gaussian mixture model to a histogram by EM with bin counts as sample weights
+
+    Each EM iteration costs O(n_bins * n_gaussians), independent of the number of voxels. Stopping criteria
+    match sklearn.mixture.GaussianMixture, so fitting the histogram of integer voxels gives the same model.
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres
+    counts : numpy array
+        1-D array of voxel counts per bin
+    n_gaussians : int
+        Number of Gaussian components to fit
+    means_init, variances_init, weights_init : array-like, shape (n_gaussians, ), optional
+        Initial component parameters. Any not given are initialised by weighted k-means.
+    tol : float, default 1e-3
+        EM stops when the mean log-likelihood per voxel improves by less than tol
+    max_iter : int, default 100
+        Maximum number of EM iterations
+    reg_covar : float, default 1e-6
+        Added to variances to keep them positive
+
+    Returns
+    -------
+    GMMResult
+        Fitted Gaussian mixture model
+    """
+    x = np.asarray(x, dtype = np.float64)
+    counts = np.asarray(counts, dtype = np.float64)
+
+    if means_init is None or variances_init is None or weights_init is None:
+        params = init_histogram(x, counts, n_gaussians)
+    else: # warm start, no k-means needed
+        params = (None, None, None)
+    means, variances, weights = override_init(n_gaussians, params, means_init, variances_init, weights_init)
+
+    history = []
+    means, variances, weights, lower_bound, n_iter, converged = em_steps(x, counts, means, variances, weights, max_iter, tol, reg_covar, history = history)
+
+    return GMMResult(means, variances, weights, n_iter, converged, lower_bound, history)
+
+def fit_voxels_chunked(img, means_init, variances_init, weights_init, chunk_size = CHUNK_SIZE, dtype = np.float64, accumulator_dtype = np.float64, tol = 1e-3, max_iter = 100, reg_covar = 1e-6):
+    """ Fits a 1-D Gaussian mixture model to every voxel by EM, chunk_size voxels at a time
+
+    Each EM iteration streams over the voxels once, accumulating the sufficient statistics of every component
+    (responsibility sums and first and second moments about the current means), so peak memory is
+    O(chunk_size * n_gaussians) instead of the O(n_voxels * n_gaussians) responsibility matrix of sklearn, and
+    no floating point copy of the image is made. Stopping criteria match fit_histogram and sklearn.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image of any shape, in any dtype, e.g. output from QM_load
+    means_init, variances_init, weights_init : array-like, shape (n_gaussians, )
+        Initial component parameters, e.g. from init_histogram on the histogram of img
+    chunk_size : int, default CHUNK_SIZE
+        Number of voxels processed at once
+    dtype : numpy dtype, default np.float64
+        dtype each chunk is converted to for the E-step, e.g. float32 for 8-bit and 16-bit images
+    accumulator_dtype : numpy dtype, default np.float64
+        dtype the sufficient statistics are summed in
+    tol, max_iter, reg_covar
+        See fit_histogram
+
+    Returns
+    -------
+    GMMResult
+        Fitted Gaussian mixture model
+    """
+    img_1d = np.ravel(img)
+    n_voxels = len(img_1d)
+    means, variances, weights = [np.asarray(param, dtype = np.float64).ravel() for param in (means_init, variances_init, weights_init)]
+    n_gaussians = len(means)
+
+    lower_bound = -np.inf
+    history = []
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        prev_lower_bound = lower_bound
+        log_norm_sum = np.zeros(1, dtype = accumulator_dtype)
+        nk, first_moment, second_moment = np.zeros([3, n_gaussians], dtype = accumulator_dtype)
+        chunk_means, chunk_variances = means.astype(dtype), variances.astype(dtype)
+        log_const = (-0.5 * np.log(2 * np.pi * variances) + np.log(weights)).astype(dtype)
+        for i in range(0, n_voxels, chunk_size):
+            diff = img_1d[i:i + chunk_size].astype(dtype)[:, np.newaxis] - chunk_means # deviation from current means
+            log_prob = log_const - 0.5 * diff ** 2 / chunk_variances
+            log_norm = logsumexp(log_prob, axis = 1)
+            resp = np.exp(log_prob - log_norm[:, np.newaxis])
+            log_norm_sum += log_norm.sum(dtype = accumulator_dtype)
+            nk += resp.sum(axis = 0, dtype = accumulator_dtype)
+            resp *= diff
+            first_moment += resp.sum(axis = 0, dtype = accumulator_dtype)
+            resp *= diff
+            second_moment += resp.sum(axis = 0, dtype = accumulator_dtype)
+        lower_bound = float(log_norm_sum[0]) / n_voxels
+        history.append(lower_bound)
+
+        nk = nk.astype(np.float64) + 10 * np.finfo(np.float64).eps
+        shift = first_moment.astype(np.float64) / nk
+        means = means + shift
+        variances = np.maximum(second_moment.astype(np.float64) / nk - shift ** 2, 0.) + reg_covar
+        weights = nk / nk.sum()
+        if abs(lower_bound - prev_lower_bound) < tol:
+            converged = True
+            break
+
+    return GMMResult(means, variances, weights, n_iter, converged, lower_bound, history)
+
+def override_init(n_gaussians, params, means_init = None, variances_init = None, weights_init = None):
+    """ Replaces initial component parameters with any given by the user
+
+    Parameters
+    ----------
+    n_gaussians : int
+        Number of Gaussian components
+    params : tuple
+        (means, variances, weights) from an initialisation method
+    means_init, variances_init, weights_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial parameters
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        1-D arrays of initial component parameters, shape (n_gaussians, )
+    """
+    user_params = [means_init, variances_init, weights_init]
+    return tuple(param if user_param is None else np.asarray(user_param, dtype = np.float64).reshape([n_gaussians])
+        for param, user_param in zip(params, user_params))
+
+def em_steps(x, counts, means, variances, weights, max_iter, tol = 1e-3, reg_covar = 1e-6, lower_bound = -np.inf, history = None):
+    """ Runs up to max_iter EM iterations on a histogram, stopping early once converged
+
+    Can be called repeatedly to continue EM, passing the returned parameters and lower bound back in.
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres, float64
+    counts : numpy array
+        1-D array of voxel counts per bin, float64
+    means, variances, weights : numpy array
+        1-D arrays of current component parameters, shape (n_gaussians, )
+    max_iter : int
+        Maximum number of EM iterations to run
+    tol : float, default 1e-3
+        EM stops when the mean log-likelihood per voxel improves by less than tol
+    reg_covar : float, default 1e-6
+        Added to variances to keep them positive
+    lower_bound : float, default -np.inf
+        Mean log-likelihood per voxel from the previous call, if continuing EM
+    history : list, optional
+        If given, the mean log-likelihood per voxel of each iteration is appended to it
+
+    Returns
+    -------
+    means, variances, weights, lower_bound, n_iter, converged
+        Updated parameters, mean log-likelihood per voxel, number of iterations run and whether EM converged
+    """
+    n_voxels = counts.sum()
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        prev_lower_bound = lower_bound
+        log_prob = estimate_log_prob(x, means, variances, weights)
+        log_norm = logsumexp(log_prob, axis = 1)
+        lower_bound = (counts @ log_norm) / n_voxels
+        if history is not None:
+            history.append(float(lower_bound))
+        means, variances, weights = m_step(x, counts, np.exp(log_prob - log_norm[:, np.newaxis]), reg_covar)
+        if abs(lower_bound - prev_lower_bound) < tol:
+            converged = True
+            break
+    return means, variances, weights, lower_bound, n_iter, converged
+
+def fit_histogram_multistart(x, counts, n_gaussians, n_init = 4, means_init = None, variances_init = None, weights_init = None, n_warmup = 10, abandon_tol = 1e-2, random_state = 3, n_workers = None, tol = 1e-3, max_iter = 100, reg_covar = 1e-6):
+    """ Fits a histogram by EM from several initialisations in parallel, abandoning starts which fall behind
+
+    The starts are, in order: the user-provided parameters if any, weighted k-means seeded at quantiles (as
+    fit_histogram), equal-count quantile slices, then k-means++ seeds for the remaining starts. All starts run n_warmup
+    EM iterations, then only starts whose mean log-likelihood per voxel is within abandon_tol of the best continue
+    to convergence, so a clearly losing start costs n_warmup iterations instead of a full fit.
+
+    Parameters
+    ----------
+    x : numpy array
+        1-D array of bin centres
+    counts : numpy array
+        1-D array of voxel counts per bin
+    n_gaussians : int
+        Number of Gaussian components to fit
+    n_init : int, default 4
+        Number of initialisations
+    means_init, variances_init, weights_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial parameters, used as one of the starts if means_init is given
+    n_warmup : int, default 10
+        Number of EM iterations run from every start before losing starts are abandoned
+    abandon_tol : float, default 1e-2
+        Starts whose mean log-likelihood per voxel is more than abandon_tol below the best after n_warmup
+        iterations are abandoned
+    random_state : int, default 3
+        Seed for k-means++ seeding, fixed for predictability
+    n_workers : int, optional
+        Number of threads running starts concurrently, defaults to the number of CPUs
+    tol, max_iter, reg_covar
+        See fit_histogram. max_iter counts the warm-up iterations.
+
+    Returns
+    -------
+    GMMResult
+        Fitted model of the start with the highest log-likelihood. Its n_init_ and n_abandoned_ attributes
+        give the number of starts run and abandoned.
+    """
+    x = np.asarray(x, dtype = np.float64)
+    counts = np.asarray(counts, dtype = np.float64)
+    rng = np.random.RandomState(random_state)
+
+    starts = [init_histogram(x, counts, n_gaussians), init_quantile(x, counts, n_gaussians)]
+    if means_init is not None:
+        starts.insert(0, override_init(n_gaussians, starts[0], means_init, variances_init, weights_init))
+    while len(starts) < n_init:
+        starts.append(init_histogram(x, counts, n_gaussians, centres = kmeans_plusplus_centres(x, counts, n_gaussians, rng)))
+    starts = starts[:max(int(n_init), 1)]
+
+    histories = [[] for start in starts]
+
+    def warmup(i):
+        return i, em_steps(x, counts, *starts[i], min(n_warmup, max_iter), tol, reg_covar, history = histories[i])
+
+    def finish(indexed_state):
+        i, state = indexed_state
+        means, variances, weights, lower_bound, n_iter, converged = state
+        if converged == True:
+            return indexed_state
+        state = em_steps(x, counts, means, variances, weights, max_iter - n_iter, tol, reg_covar, lower_bound, histories[i])
+        return i, state[:4] + (n_iter + state[4], state[5])
+
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(starts)))
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        states = list(executor.map(warmup, range(len(starts))))
+        best_lower_bound = max(state[3] for i, state in states)
+        survivors = [(i, state) for i, state in states if state[3] >= best_lower_bound - abandon_tol]
+        states = list(executor.map(finish, survivors))
+
+    best, (means, variances, weights, lower_bound, n_iter, converged) = max(states, key = lambda indexed_state: indexed_state[1][3])
+    GMM = GMMResult(means, variances, weights, n_iter, converged, lower_bound, histories[best])
+    GMM.n_init_ = len(starts)
+    GMM.n_abandoned_ = len(starts) - len(survivors)
+    return GMM
+
+def fit_histograms_batched(x, counts, n_gaussians, means_init = None, variances_init = None, weights_init = None, tol = 1e-3, max_iter = 100, reg_covar = 1e-6, n_kmeans_iter = 100):
+    """ Fits a 1-D Gaussian mixture model to each row of a histogram matrix, running EM for all rows at once
+
+    Every step of fit_histogram is applied to all histograms with array broadcasting, so thousands of small fits
+    cost a few array operations per iteration. Each row stops updating once it converges, so every row gets the
+    same model as fitting it on its own with fit_histogram. Temporary arrays hold n_histograms * n_bins * n_gaussians
+    values, so very large batches of 16-bit histograms may be split into several calls.
+
+    Parameters
+    ----------
+    x : numpy array
+        Bin centres shared by all histograms, shape (n_bins, ), or one row per histogram, shape (n_histograms, n_bins)
+    counts : numpy array
+        Voxel counts per bin, shape (n_histograms, n_bins)
+    n_gaussians : int
+        Number of Gaussian components to fit
+    means_init, variances_init, weights_init : array-like, shape (n_gaussians, ) or (n_histograms, n_gaussians), optional
+        Initial component parameters, shared by all histograms or one row per histogram. Initialised by
+        weighted k-means seeded at quantiles if not given.
+    tol, max_iter, reg_covar
+        See fit_histogram
+    n_kmeans_iter : int, default 100
+        Maximum number of k-means iterations for initialisation
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        Fitted component parameters, shape (n_histograms, n_gaussians)
+    n_iter : numpy array
+        Number of EM iterations of each histogram, shape (n_histograms, )
+    converged : numpy array
+        True for histograms where EM converged before max_iter, shape (n_histograms, )
+    lower_bound : numpy array
+        Mean log-likelihood per voxel of each histogram, shape (n_histograms, )
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype = np.float64))
+    n_histograms = counts.shape[0]
+    x = np.broadcast_to(np.asarray(x, dtype = np.float64), counts.shape)
+
+    if means_init is None or variances_init is None or weights_init is None:
+        params = init_histograms_batched(x, counts, n_gaussians, n_kmeans_iter)
+    else:
+        params = (None, None, None)
+    user_params = [means_init, variances_init, weights_init]
+    means, variances, weights = [param if user_param is None else
+        np.array(np.broadcast_to(np.asarray(user_param, dtype = np.float64), (n_histograms, n_gaussians)))
+        for param, user_param in zip(params, user_params)]
+
+    n_iter = np.zeros(n_histograms, dtype = int)
+    converged = np.zeros(n_histograms, dtype = bool)
+    lower_bound = np.full(n_histograms, -np.inf)
+    for i in range(max_iter):
+        active = np.flatnonzero(~converged)
+        if len(active) == 0:
+            break
+        x_active, counts_active = x[active], counts[active]
+        log_prob = estimate_log_prob_batched(x_active, means[active], variances[active], weights[active])
+        log_norm = logsumexp(log_prob, axis = 2)
+        prev_lower_bound = lower_bound[active]
+        lower_bound[active] = np.sum(counts_active * log_norm, axis = 1) / counts_active.sum(axis = 1)
+        means[active], variances[active], weights[active] = m_step_batched(x_active, counts_active, np.exp(log_prob - log_norm[:, :, np.newaxis]), reg_covar)
+        n_iter[active] += 1
+        converged[active] = np.abs(lower_bound[active] - prev_lower_bound) < tol
+
+    return means, variances, weights, n_iter, converged, lower_bound
+
+def estimate_log_prob_batched(x, means, variances, weights):
+    """ Weighted log probability density of each Gaussian component at x, for each histogram
+
+    Parameters
+    ----------
+    x : numpy array
+        Bin centres, shape (n_histograms, n_bins)
+    means, variances, weights : numpy array
+        Component parameters, shape (n_histograms, n_gaussians)
+
+    Returns
+    -------
+    numpy array
+        log(weight * N(x | mean, variance)), shape (n_histograms, n_bins, n_gaussians)
+    """
+    means, variances, weights = means[:, np.newaxis, :], variances[:, np.newaxis, :], weights[:, np.newaxis, :]
+    return -0.5 * (np.log(2 * np.pi * variances) + (x[:, :, np.newaxis] - means) ** 2 / variances) + np.log(weights)
+
+def m_step_batched(x, counts, resp, reg_covar = 1e-6):
+    """ Maximisation step of EM with voxel counts as sample weights, for each histogram
+
+    Parameters
+    ----------
+    x : numpy array
+        Bin centres, shape (n_histograms, n_bins)
+    counts : numpy array
+        Voxel counts per bin, shape (n_histograms, n_bins)
+    resp : numpy array
+        Responsibilities, shape (n_histograms, n_bins, n_gaussians)
+    reg_covar : float, default 1e-6
+        Added to variances to keep them positive
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        Component parameters, shape (n_histograms, n_gaussians)
+    """
+    weighted_resp = counts[:, :, np.newaxis] * resp
+    nk = weighted_resp.sum(axis = 1) + 10 * np.finfo(np.float64).eps
+    means = np.einsum("hb,hbk->hk", x, weighted_resp) / nk
+    variances = np.einsum("hbk,hbk->hk", (x[:, :, np.newaxis] - means[:, np.newaxis, :]) ** 2, weighted_resp) / nk + reg_covar
+    weights = nk / nk.sum(axis = 1, keepdims = True)
+    return means, variances, weights
+
+def init_histograms_batched(x, counts, n_gaussians, n_kmeans_iter = 100):
+    """ Initialises component parameters of each histogram by weighted k-means seeded at quantiles, as init_histogram
+
+    Parameters
+    ----------
+    x : numpy array
+        Bin centres, shape (n_histograms, n_bins)
+    counts : numpy array
+        Voxel counts per bin, shape (n_histograms, n_bins)
+    n_gaussians : int
+        Number of Gaussian components
+    n_kmeans_iter : int, default 100
+        Maximum number of k-means iterations
+
+    Returns
+    -------
+    means, variances, weights : numpy array
+        Initial component parameters, shape (n_histograms, n_gaussians)
+    """
+    n_histograms, n_bins = counts.shape
+    cdf = np.cumsum(counts, axis = 1) / counts.sum(axis = 1, keepdims = True)
+    quantiles = (np.arange(n_gaussians) + 0.5) / n_gaussians
+    seeds = np.minimum(np.sum(cdf[:, :, np.newaxis] < quantiles, axis = 1), n_bins - 1) # searchsorted on every row
+    centres = np.take_along_axis(x, seeds, axis = 1)
+    rows = np.arange(n_histograms)[:, np.newaxis]
+    for i in range(n_kmeans_iter):
+        labels = np.argmin(np.abs(x[:, :, np.newaxis] - centres[:, np.newaxis, :]), axis = 2)
+        resp = np.zeros([n_histograms, n_bins, n_gaussians])
+        resp[rows, np.arange(n_bins), labels] = 1.
+        nk = np.einsum("hb,hbk->hk", counts, resp)
+        new_centres = np.where(nk > 0, np.einsum("hb,hbk->hk", counts * x, resp) / np.maximum(nk, 1), centres)
+        if np.allclose(new_centres, centres):
+            break
+        centres = new_centres
+    return m_step_batched(x, counts, resp)
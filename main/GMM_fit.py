@@ -1,7 +1,10 @@
 import os
 import csv
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
 import sklearn.mixture
 import sys
 import matplotlib.pyplot as plt
@@ -11,42 +14,121 @@ plt.close('all')
 from scipy.stats import norm
 
 import QM_load
+import QM_histogram
+import QM_cache
+import GMM_em
 
-def GMM_fit(img, n_gaussians, mu_init = None, sigma_init = None):
+FITTER_VERSION = 1 # increment when fitting changes, so results cached by earlier versions are not reused
+
+def GMM_fit(img, n_gaussians, mu_init = None, sigma_init = None, engine = "sklearn", max_gaussians = 6, criterion = "bic", n_init = 1, weights_init = None, use_cache = False, cache_dir = None, histo = None):
     """
     Fits Gaussian mixture model to grey value histogram of img
 
     Parameters
     ----------
-    img : numpy array
-        3D numpy array of image, output from QM_load.py
-    n_gaussians : int
-        Number of Gaussian components to fit to histogram, usually equals number of material components in specimen
+    img : numpy array or Histogram
+        3D numpy array of image, output from QM_load.py, or grey value histogram, output from QM_histogram.QM_load_histogram
+    n_gaussians : int or "auto"
+        Number of Gaussian components to fit to histogram, usually equals number of material components in specimen.
+        If "auto", the number of components is chosen by select_n_gaussians, and mu_init and sigma_init are ignored.
     mu_init : array-like, shape (n_gaussians, ), optional
         User-provided initial means, defaults to None. 
     sigma_init : array-like, shape (n_gaussians, ), optional
         User-provided initial standard deviations, defaults to None. Can only be specified with mu_init.
+    engine : str, default "sklearn"
+        "sklearn" fits sklearn GaussianMixture to every voxel, in float64.
+        "histogram" bins the voxels first and runs EM on (grey value, count) pairs, so each iteration costs the
+        same whatever the number of voxels and no floating point copy of the image is made.
+        "coarse_to_fine" fits a random subsample first and warm-starts sklearn on every voxel from that fit,
+        see GMM_fit_coarse_to_fine, unless mu_init is given or n_init > 1, which already provide a start.
+        "chunked" runs EM on every voxel a chunk at a time, see GMM_fit_chunked, so memory use stays bounded
+        for very large imports.
+        Histograms are always fitted with the "histogram" engine.
+    max_gaussians : int, default 6
+        Largest number of components considered if n_gaussians == "auto"
+    criterion : str, default "bic"
+        "bic" or "aic", information criterion minimised if n_gaussians == "auto"
+    n_init : int, default 1
+        Number of initialisations. If greater than 1, EM is run from several starts in parallel on the histogram,
+        abandoning starts which fall behind, see GMM_em.fit_histogram_multistart. The sklearn engine then
+        refines the best start on every voxel.
+    weights_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial weights, defaults to None. Can only be specified with mu_init.
+    use_cache : bool, default False
+        If True, return the stored result if the same data was fitted with the same parameters before, see GMM_fit_cached
+    cache_dir : str, optional
+        Cache directory, defaults to QM_cache.CACHE_DIR
+    histo : Histogram, optional
+        Grey value histogram of img from QM_histogram.histogram_from_image, if already computed, e.g. for plotting.
+        Used wherever the voxels would otherwise be binned: by "auto", the "histogram" and "chunked" engines,
+        n_init > 1 and the cache key. Defaults to None, which bins img when needed.
     
     Returns
     -------
     GMM
-        instance of GaussianMixture class
+        instance of GaussianMixture class, or GMM_em.GMMResult if fitted with the "histogram" engine or read from the cache.
+        If n_gaussians == "auto", the model_selection_ attribute holds the score table from select_n_gaussians.
     """
 
+    if use_cache == True:
+        return GMM_fit_cached(img, n_gaussians, mu_init, sigma_init, engine, max_gaussians, criterion, n_init, weights_init, cache_dir, histo = histo)
+
     start = time.time()
 
-    img_1d = img.flatten() # flatten 3D img array
+    if engine not in ("sklearn", "histogram", "coarse_to_fine", "chunked"):
+        raise ValueError("engine must be 'sklearn', 'histogram', 'coarse_to_fine' or 'chunked', not '{}'".format(engine))
+
+    if isinstance(img, QM_histogram.Histogram):
+        histo = img
 
-    if mu_init != None:
-        mu_init = np.array(mu_init).reshape([n_gaussians, 1])
-        GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3, means_init = mu_init) # fix random state for predictability
-    if sigma_init != None: # not tested
-        mu_init = np.array(mu_init).reshape([n_gaussians, 1])
-        precisions_init = np.array(np.linalg.inv(sigma_init ** 2)).reshape([n_gaussians, 1]) # precisions = inv(sigma^2)
-        GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3, means_init = mu_init, precisions_init = precisions_init) # fix random state for predictability
+    if n_gaussians == "auto": # candidates are always compared on the histogram, which is fast to fit
+        histo = histo if histo is not None else QM_histogram.histogram_from_image(img)
+        GMM, scores = select_n_gaussians(histo, max_gaussians, criterion)
+        if engine != "histogram" and not isinstance(img, QM_histogram.Histogram):
+            GMM = GMM_fit(img, GMM.n_components, engine = engine, histo = histo) # refit the chosen model to every voxel
+        GMM.model_selection_ = scores
+        end = time.time()
+        print("Automatic GMM fit complete, time elapsed = {0:.2f} s\n".format((end-start)))
+        return GMM
+
+    if isinstance(img, QM_histogram.Histogram) or engine == "histogram":
+        histo = histo if histo is not None else QM_histogram.histogram_from_image(img)
+        GMM = GMM_fit_histogram(histo, n_gaussians, mu_init, sigma_init, n_init, weights_init)
+        end = time.time()
+        print("GMM fit complete, time elapsed = {0:.2f} s\n".format((end-start)))
+        return GMM
+
+    img_1d = np.ravel(img) # flatten 3D img array without copying
+
+    if engine == "coarse_to_fine" and mu_init is None and n_init == 1: # otherwise refined from the given starts
+        GMM = GMM_fit_coarse_to_fine(img_1d, n_gaussians)
+        end = time.time()
+        print("GMM fit complete, time elapsed = {0:.2f} s\n".format((end-start)))
+        return GMM
+
+    if engine == "chunked":
+        GMM = GMM_fit_chunked(img_1d, n_gaussians, mu_init, sigma_init, n_init, weights_init, histo = histo)
+        end = time.time()
+        print("GMM fit complete, time elapsed = {0:.2f} s\n".format((end-start)))
+        return GMM
+
+    if n_init > 1: # choose the best of several starts on the histogram, then refine on every voxel
+        histo = histo if histo is not None else QM_histogram.histogram_from_image(img_1d)
+        GMM_init = GMM_fit_histogram(histo, n_gaussians, mu_init, sigma_init, n_init, weights_init)
+        GMM = warm_start_GaussianMixture(GMM_init)
+    elif mu_init is not None:
+        init_params = {"means_init": np.asarray(mu_init, dtype = np.float64).reshape([n_gaussians, 1])}
+        if sigma_init is not None: # precisions = 1 / sigma^2 for each 1-D component
+            init_params["precisions_init"] = 1. / np.asarray(sigma_init, dtype = np.float64).reshape([n_gaussians, 1, 1]) ** 2
+        if weights_init is not None:
+            weights_init = np.asarray(weights_init, dtype = np.float64).reshape([n_gaussians])
+            init_params["weights_init"] = weights_init / weights_init.sum()
+        GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3, **init_params) # fix random state for predictability
     else:
         GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3) # fix random state for predictability
-    
+
+    img_1d = img_1d.astype(np.float64, copy = False) # float32 sums over millions of voxels bias mu and sigma
+
     GMMfit = GMM.fit(img_1d.reshape(-1,1))
 
     end = time.time()
@@ -54,6 +136,375 @@ def GMM_fit(img, n_gaussians, mu_init = None, sigma_init = None):
 
     return GMM
 
+def GMM_fit_cached(img, n_gaussians, mu_init = None, sigma_init = None, engine = "sklearn", max_gaussians = 6, criterion = "bic", n_init = 1, weights_init = None, cache_dir = None, max_cache_bytes = QM_cache.MAX_CACHE_BYTES, histo = None):
+    """
+    GMM_fit, returning the stored result if data with the same fingerprint was fitted with the same parameters before
+
+    Results are keyed by QM_cache.fit_fingerprint of img, so 8-bit and 16-bit images with the same grey value
+    histogram share a result, together with every fitting parameter, FITTER_VERSION and the sklearn version.
+    Entries share the size limit and least recently used eviction of the image cache.
+
+    Parameters
+    ----------
+    img, n_gaussians, mu_init, sigma_init, engine, max_gaussians, criterion, n_init, weights_init
+        See GMM_fit
+    cache_dir : str, optional
+        Cache directory, defaults to QM_cache.CACHE_DIR
+    max_cache_bytes : int, default QM_cache.MAX_CACHE_BYTES
+        Maximum total size of the cache directory
+    histo : Histogram, optional
+        Grey value histogram of img, see GMM_fit, also used for the fingerprint of 8-bit and 16-bit images
+
+    Returns
+    -------
+    GMM
+        Output from GMM_fit, or GMM_em.GMMResult with the stored parameters, convergence and model_selection_
+        if read from the cache
+    """
+    start = time.time()
+
+    def as_list(param):
+        return None if param is None else np.asarray(param, dtype = np.float64).ravel().tolist()
+
+    key = QM_cache.fit_cache_key(img, histo, n_gaussians = n_gaussians, mu_init = as_list(mu_init), sigma_init = as_list(sigma_init),
+        weights_init = as_list(weights_init), engine = engine, max_gaussians = max_gaussians, criterion = criterion, n_init = n_init,
+        fitter_version = FITTER_VERSION, sklearn_version = sklearn.__version__)
+    arrays = QM_cache.cache_load(key, cache_dir)
+    if arrays is not None:
+        GMM = GMM_em.GMMResult(arrays["means"], arrays["variances"], arrays["weights"], int(arrays["n_iter"]),
+            bool(arrays["converged"]), float(arrays["lower_bound"]), arrays["lower_bound_history"].tolist() if "lower_bound_history" in arrays else None)
+        if "model_selection" in arrays:
+            GMM.model_selection_ = pd.DataFrame.from_records(arrays["model_selection"]).set_index("n_gaussians")
+        print("GMM fit loaded from cache, time elapsed = {0:.2f} s\n".format((time.time()-start)))
+        return GMM
+
+    GMM = GMM_fit(img, n_gaussians, mu_init, sigma_init, engine, max_gaussians, criterion, n_init, weights_init, histo = histo)
+    arrays = {"means": GMM.means_.ravel(), "variances": GMM.covariances_.ravel(), "weights": GMM.weights_.ravel(),
+        "n_iter": np.array(GMM.n_iter_), "converged": np.array(GMM.converged_), "lower_bound": np.array(GMM.lower_bound_)}
+    if getattr(GMM, "lower_bound_history_", None) is not None:
+        arrays["lower_bound_history"] = np.array(GMM.lower_bound_history_)
+    if hasattr(GMM, "model_selection_"):
+        arrays["model_selection"] = GMM.model_selection_.to_records()
+    QM_cache.cache_save(key, arrays, cache_dir, max_cache_bytes)
+    return GMM
+
+def fit_dtype(dtype):
+    """
+    Chooses the floating point dtype the chunked engine converts each chunk of voxels to
+
+    Only the E-step of each chunk runs in this dtype, the sufficient statistics are summed in float64, see
+    GMM_em.fit_voxels_chunked. The sklearn engines always fit in float64.
+
+    Parameters
+    ----------
+    dtype : numpy dtype
+        dtype of the image
+
+    Returns
+    -------
+    numpy dtype
+        float32 if it represents every grey value of dtype exactly (8-bit, 16-bit and float32 images), else float64
+    """
+    dtype = np.dtype(dtype)
+    if dtype.itemsize <= 2 or dtype == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def GMM_fit_coarse_to_fine(img, n_gaussians, n_coarse = 100000, random_state = 3):
+    """
+    Fits Gaussian mixture model to a random subsample of img, then refines it on every voxel
+
+    Most EM iterations are spent moving away from the initialisation, so these run on n_coarse voxels only.
+    EM on every voxel then starts from the subsample fit and usually converges within a few iterations, to the
+    same solution as fitting every voxel from scratch.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image of any shape, output from QM_load.py
+    n_gaussians : int
+        Number of Gaussian components to fit
+    n_coarse : int, default 100000
+        Number of voxels drawn for the coarse fit. If img has at most 2 * n_coarse voxels, it is fitted directly.
+    random_state : int, default 3
+        Seed for drawing the subsample and initialising the coarse fit, fixed for predictability
+
+    Returns
+    -------
+    GMM
+        instance of GaussianMixture class fitted to every voxel. n_iter_ counts the EM iterations on every voxel
+        and n_iter_coarse_ the iterations of the coarse fit.
+    """
+    img_1d = np.ravel(img).astype(np.float64, copy = False) # as GMM_fit, so both give the same model
+    if len(img_1d) <= 2 * n_coarse: # nothing to gain from a coarse stage
+        GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = random_state).fit(img_1d.reshape(-1,1))
+        GMM.n_iter_coarse_ = 0
+        return GMM
+
+    rng = np.random.RandomState(random_state)
+    img_coarse = img_1d[rng.randint(0, len(img_1d), n_coarse)] # with replacement, no permutation of the whole image
+    GMM_coarse = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = random_state).fit(img_coarse.reshape(-1,1))
+
+    GMM = warm_start_GaussianMixture(GMM_coarse).fit(img_1d.reshape(-1,1))
+    GMM.n_iter_coarse_ = GMM_coarse.n_iter_
+    print("Coarse fit on {} voxels took {} EM iterations, refinement on {} voxels took {}".format(n_coarse, GMM_coarse.n_iter_, len(img_1d), GMM.n_iter_))
+    return GMM
+
+def GMM_fit_chunked(img, n_gaussians, mu_init = None, sigma_init = None, n_init = 1, weights_init = None, chunk_size = GMM_em.CHUNK_SIZE, histo = None):
+    """
+    Fits Gaussian mixture model to every voxel of img with EM streamed over fixed-size chunks
+
+    Initialised like the histogram engine, by k-means on the grey value histogram (or the best of n_init starts),
+    then refined on the voxels by GMM_em.fit_voxels_chunked. Chunks are converted to float32 for 8-bit, 16-bit and
+    float32 images, so peak memory is a few chunk_size * n_gaussians arrays rather than the float64 copy and
+    n_voxels * n_gaussians responsibility matrices made by sklearn.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image of any shape, output from QM_load.py
+    n_gaussians : int
+        Number of Gaussian components to fit
+    mu_init, sigma_init, weights_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial parameters, defaults to None
+    n_init : int, default 1
+        Number of initialisations compared on the histogram, see GMM_em.fit_histogram_multistart
+    chunk_size : int, default GMM_em.CHUNK_SIZE
+        Number of voxels processed at once
+    histo : Histogram, optional
+        Grey value histogram of img to initialise from, defaults to None, which bins img
+
+    Returns
+    -------
+    GMMResult
+        Fitted Gaussian mixture model
+    """
+    histo = histo if histo is not None else QM_histogram.histogram_from_image(img)
+    if n_init > 1:
+        GMM_init = GMM_fit_histogram(histo, n_gaussians, mu_init, sigma_init, n_init, weights_init)
+        params = GMM_init.means_.ravel(), GMM_init.covariances_.ravel(), GMM_init.weights_
+    else:
+        params = GMM_em.init_histogram(histo.bin_centres, histo.counts.astype(np.float64), n_gaussians)
+        variances_init = None if sigma_init is None else np.asarray(sigma_init, dtype = np.float64) ** 2
+        params = GMM_em.override_init(n_gaussians, params, mu_init, variances_init, weights_init)
+    return GMM_em.fit_voxels_chunked(img, *params, chunk_size = chunk_size, dtype = fit_dtype(img.dtype))
+
+def warm_start_GaussianMixture(GMM_init, **kwargs):
+    """
+    Creates an unfitted sklearn GaussianMixture which starts EM from the parameters of an already fitted model
+
+    Parameters
+    ----------
+    GMM_init : instance of GaussianMixture class or GMM_em.GMMResult
+        Fitted model to start from
+    **kwargs
+        Passed to GaussianMixture, e.g. tol or max_iter
+
+    Returns
+    -------
+    GaussianMixture
+        Unfitted model with means_init, precisions_init and weights_init set from GMM_init
+    """
+    weights_init = np.asarray(GMM_init.weights_, dtype = np.float64).reshape([-1])
+    return sklearn.mixture.GaussianMixture(n_components = GMM_init.n_components, random_state = 3,
+        means_init = np.asarray(GMM_init.means_, dtype = np.float64).reshape([-1, 1]),
+        precisions_init = np.asarray(GMM_init.precisions_, dtype = np.float64).reshape([-1, 1, 1]),
+        weights_init = weights_init / weights_init.sum(), **kwargs) # sklearn checks the weights sum to 1
+
+def GMM_fit_histogram(histo, n_gaussians, mu_init = None, sigma_init = None, n_init = 1, weights_init = None):
+    """
+    Fits Gaussian mixture model to a grey value histogram by EM weighted by bin counts
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram, output from QM_histogram.QM_load_histogram
+    n_gaussians : int
+        Number of Gaussian components to fit to histogram, usually equals number of material components in specimen
+    mu_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial means, defaults to None.
+    sigma_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial standard deviations, defaults to None.
+    n_init : int, default 1
+        Number of initialisations, see GMM_em.fit_histogram_multistart
+    weights_init : array-like, shape (n_gaussians, ), optional
+        User-provided initial weights, defaults to None.
+
+    Returns
+    -------
+    GMMResult
+        Fitted Gaussian mixture model with the same attributes as GaussianMixture
+    """
+    variances_init = None if sigma_init is None else np.asarray(sigma_init, dtype = np.float64) ** 2
+    if n_init > 1:
+        GMM = GMM_em.fit_histogram_multistart(histo.bin_centres, histo.counts, n_gaussians, n_init, mu_init, variances_init, weights_init)
+        print("{} of {} EM starts abandoned after warm-up".format(GMM.n_abandoned_, GMM.n_init_))
+    else:
+        GMM = GMM_em.fit_histogram(histo.bin_centres, histo.counts, n_gaussians, means_init = mu_init, variances_init = variances_init, weights_init = weights_init)
+    if histo.integer == False: # Sheppard's correction for the spread of grey values within each bin
+        GMM.covariances_ = np.maximum(GMM.covariances_ - histo.bin_width ** 2 / 12., 1e-6)
+        GMM.precisions_ = 1. / GMM.covariances_
+    return GMM
+
+def GMM_fit_series(imgs, n_gaussians, warm_start = "previous", engine = "sklearn"):
+    """
+    Fits a series of similar images, warm-starting each fit from the models already fitted
+
+    The first image is fitted from scratch. Each later image starts EM from the means, standard deviations and
+    weights of the previous fit, or of the running mean of all previous fits, so scans of near-identical
+    specimens usually converge in a few iterations.
+
+    Parameters
+    ----------
+    imgs : iterable
+        Images (numpy arrays output from QM_load.py) or Histograms, e.g. a generator loading one image at a time
+    n_gaussians : int
+        Number of Gaussian components to fit to every image
+    warm_start : str, default "previous"
+        "previous" starts from the previous fit, "mean" from the mean of all previous fits
+    engine : str, default "sklearn"
+        Fitting engine, see GMM_fit
+
+    Returns
+    -------
+    GMMs
+        List of fitted models, one per image
+    report
+        Pandas DataFrame indexed by scan number with the EM iterations used, the iterations saved compared to the
+        cold fit of the first scan, and whether EM converged
+    """
+    if warm_start not in ("previous", "mean"):
+        raise ValueError("warm_start must be 'previous' or 'mean', not '{}'".format(warm_start))
+
+    GMMs = []
+    rows = []
+    params_init = None
+    for scan, img in enumerate(imgs):
+        if params_init is None:
+            GMM = GMM_fit(img, n_gaussians, engine = engine)
+            n_iter_cold = GMM.n_iter_
+        else:
+            mu_init, sigma_init, weights_init = params_init
+            GMM = GMM_fit(img, n_gaussians, mu_init, sigma_init, engine = engine, weights_init = weights_init)
+        GMMs.append(GMM)
+        rows.append((scan, GMM.n_iter_, n_iter_cold - GMM.n_iter_, GMM.converged_))
+
+        params = np.array(extract_GMM_results(GMM), dtype = np.float64) # components sorted by mean
+        if warm_start == "mean" and params_init is not None:
+            params = params_init + (params - params_init) / len(GMMs) # running mean
+        params_init = params
+
+    report = pd.DataFrame(rows, columns = ["scan", "n_iter", "n_iter_saved", "converged"]).set_index("scan")
+    print("Series fit of {} scans, {} EM iterations saved by warm starts".format(len(GMMs), report["n_iter_saved"].sum()))
+
+    return GMMs, report
+
+def GMM_fit_batch(imgs, n_gaussians, mu_init = None, sigma_init = None, weights_init = None):
+    """
+    Fits Gaussian mixture models to the grey value histograms of many images at once with batched EM
+
+    Parameters
+    ----------
+    imgs : list
+        Images (numpy arrays output from QM_load.py) or Histograms. Integer images are binned one bin per grey
+        value; floating point images must be given as Histograms with the same bin edges.
+    n_gaussians : int
+        Number of Gaussian components to fit to every image
+    mu_init, sigma_init, weights_init : array-like, shape (n_gaussians, ) or (n_images, n_gaussians), optional
+        User-provided initial parameters, shared by all images or one row per image
+
+    Returns
+    -------
+    mu
+        Numpy array of shape (n_images, n_gaussians) with the fitted means of each image in ascending order
+    sigma
+        Numpy array of shape (n_images, n_gaussians) with the fitted standard deviations
+    weights
+        Numpy array of shape (n_images, n_gaussians) with the fitted weights
+    """
+    start = time.time()
+
+    histos = [img if isinstance(img, QM_histogram.Histogram) else QM_histogram.histogram_from_image(img) for img in imgs]
+    histo = QM_histogram.histogram_matrix(histos)
+    variances_init = None if sigma_init is None else np.asarray(sigma_init, dtype = np.float64) ** 2
+    means, variances, weights, n_iter, converged, lower_bound = GMM_em.fit_histograms_batched(histo.bin_centres, histo.counts,
+        n_gaussians, mu_init, variances_init, weights_init)
+    if histo.integer == False: # Sheppard's correction, as GMM_fit_histogram
+        variances = np.maximum(variances - histo.bin_width ** 2 / 12., 1e-6)
+
+    sort_ind = np.argsort(means, axis = 1) # ascending order of means for each image
+    mu = np.take_along_axis(means, sort_ind, axis = 1)
+    sigma = np.sqrt(np.take_along_axis(variances, sort_ind, axis = 1))
+    weights = np.take_along_axis(weights, sort_ind, axis = 1)
+
+    end = time.time()
+    print("Batched GMM fit of {} images complete, {} converged, time elapsed = {:.2f} s\n".format(len(histos), np.sum(converged), (end-start)))
+
+    return mu, sigma, weights
+
+def information_criteria(GMM, n_voxels):
+    """
+    Calculates the Akaike and Bayesian information criteria of a fitted 1-D Gaussian mixture model
+
+    Parameters
+    ----------
+    GMM : GMM_em.GMMResult
+        Fitted Gaussian mixture model, lower_bound_ is the mean log-likelihood per voxel
+    n_voxels : int
+        Number of voxels the model was fitted to
+
+    Returns
+    -------
+    log_likelihood, n_parameters, AIC, BIC
+        Total log-likelihood, number of free parameters (3 * n_gaussians - 1), AIC and BIC
+    """
+    log_likelihood = GMM.lower_bound_ * n_voxels
+    n_parameters = 3 * GMM.n_components - 1 # means, variances and weights, which sum to 1
+    AIC = -2 * log_likelihood + 2 * n_parameters
+    BIC = -2 * log_likelihood + n_parameters * np.log(n_voxels)
+    return log_likelihood, n_parameters, AIC, BIC
+
+def select_n_gaussians(histo, max_gaussians = 6, criterion = "bic", n_workers = None):
+    """
+    Fits 1 to max_gaussians components to a grey value histogram concurrently and keeps the model with the lowest AIC or BIC
+
+    Every candidate is fitted to the same histogram, so each fit costs O(n_bins) per iteration whatever the
+    number of voxels, and the candidates are fitted by a pool of threads.
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram, output from QM_histogram.QM_load_histogram or QM_histogram.histogram_from_image
+    max_gaussians : int, default 6
+        Largest number of Gaussian components considered
+    criterion : str, default "bic"
+        "bic" or "aic", information criterion to minimise
+    n_workers : int, optional
+        Number of threads fitting candidates concurrently, defaults to the number of CPUs
+
+    Returns
+    -------
+    GMM
+        GMM_em.GMMResult with the lowest criterion
+    scores
+        Pandas DataFrame indexed by n_gaussians with the log-likelihood, number of parameters, AIC, BIC and
+        convergence of every candidate
+    """
+    if criterion not in ("bic", "aic"):
+        raise ValueError("criterion must be 'bic' or 'aic', not '{}'".format(criterion))
+    candidates = range(1, int(max_gaussians) + 1)
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(candidates)))
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        GMMs = list(executor.map(lambda n_gaussians: GMM_fit_histogram(histo, n_gaussians), candidates))
+
+    rows = [(GMM.n_components,) + information_criteria(GMM, histo.n_voxels) + (GMM.converged_,) for GMM in GMMs]
+    scores = pd.DataFrame(rows, columns = ["n_gaussians", "log_likelihood", "n_parameters", "AIC", "BIC", "converged"])
+    scores = scores.set_index("n_gaussians")
+    best = int(scores[criterion.upper()].idxmin())
+    print("Model selection by {} \n{}\nSelected {} Gaussians\n".format(criterion.upper(), scores, best))
+
+    return GMMs[best - 1], scores
+
 def extract_GMM_results(GMM):
     """
     Extracts means, standard deviations and weights from fitted GMM
@@ -101,7 +552,7 @@ def save_GMM_results(img_fname, GMM):
         Saved in results directory
     """
     # Create results directory
-    results_dir = "{}_results".format(os.path.splitext(img_fname)[0])
+    results_dir = QM_load.get_results_dir(img_fname)
     if os.path.isdir(results_dir) == False:
         os.mkdir(results_dir)
     
@@ -117,30 +568,106 @@ def save_GMM_results(img_fname, GMM):
             w.writerow(to_write) # writes mu, sigma and weight of each fitted Gaussian as a new row
     print("Results saved to {} \n".format(results_dir))
 
+def load_GMM_results(img_fname):
+    """
+    Reads mu, sigma and weights saved by save_GMM_results back into a fitted model
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath to image name, used to find results directory
+
+    Returns
+    -------
+    GMM_em.GMMResult
+        Fitted model, e.g. to replot with plot_GMM_fit and QM_histogram.load_saved_histogram without reading the image
+    """
+    results = np.loadtxt(os.path.join(QM_load.get_results_dir(img_fname), "fitted_results.csv"), delimiter = ",", ndmin = 2)
+    return GMM_em.GMMResult(results[:, 0], results[:, 1] ** 2, results[:, 2])
+
+def fit_diagnostics(GMM, img = None):
+    """
+    Summarises the convergence of a fitted GMM, and the size of the data it was fitted to, as a JSON-serialisable dict
+
+    Parameters
+    ----------
+    GMM : instance of GaussianMixture class or GMMResult
+        Fitted Gaussian mixture model
+    img : numpy array or Histogram, optional
+        Data the model was fitted to, output from QM_load.py or QM_histogram.QM_load_histogram
+
+    Returns
+    -------
+    dict
+        n_gaussians, n_iter, converged and lower_bound (mean log-likelihood per voxel). lower_bound_history holds
+        the log-likelihood of every EM iteration for histogram and chunked fits, and is None for sklearn fits,
+        which do not record it. Attributes set by particular fits (n_iter_coarse, n_init, n_abandoned) are added
+        when present, and n_voxels, dtype, nbytes and n_bins describe img if given.
+    """
+    def finite_or_none(value):
+        return float(value) if np.isfinite(value) else None
+
+    history = getattr(GMM, "lower_bound_history_", None)
+    diagnostics = {"n_gaussians": int(GMM.n_components), "n_iter": int(GMM.n_iter_), "converged": bool(GMM.converged_),
+        "lower_bound": finite_or_none(GMM.lower_bound_),
+        "lower_bound_history": None if history is None else [finite_or_none(value) for value in history]}
+    for attribute in ["n_iter_coarse_", "n_init_", "n_abandoned_"]:
+        if hasattr(GMM, attribute):
+            diagnostics[attribute.rstrip("_")] = int(getattr(GMM, attribute))
+    if isinstance(img, QM_histogram.Histogram):
+        diagnostics.update({"n_voxels": img.n_voxels, "dtype": None, "nbytes": int(img.counts.nbytes), "n_bins": len(img.counts)})
+    elif img is not None:
+        diagnostics.update({"n_voxels": int(img.size), "dtype": str(img.dtype), "nbytes": int(img.nbytes), "n_bins": None})
+    return diagnostics
+
+def save_diagnostics(img_fname, diagnostics):
+    """
+    Saves fit diagnostics as fit_diagnostics.json next to fitted_results.csv in the results directory
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath to image name, used to find results directory
+    diagnostics : dict
+        JSON-serialisable diagnostics, e.g. from fit_diagnostics or QM_runner.QM_runner
+
+    Returns
+    -------
+    fit_diagnostics.json : json file
+        Saved in results directory
+    """
+    results_dir = QM_load.get_results_dir(img_fname)
+    if os.path.isdir(results_dir) == False:
+        os.mkdir(results_dir)
+    with open(os.path.join(results_dir, "fit_diagnostics.json"), "w") as json_file:
+        json.dump(diagnostics, json_file, indent = 2)
+
 def plot_GMM_fit(img, GMM, img_fname):
     """
     Plots fitted Gaussian components over grey value histogram from img, saves as png
 
     Parameters
     ----------
-    img : numpy array
-        3D numpy array of image, output from QM_load.py
+    img : numpy array or Histogram
+        3D numpy array of image, output from QM_load.py, or grey value histogram, output from QM_histogram.QM_load_histogram.
+        Pass the histogram if it is already computed, so the voxels are not binned again.
     GMM : instance of GaussianMixture class
         Output from GaussianMixture from which results are extracted
     img_fname : str
         Filepath to image name, used to create results directory
     """
     # Create results directory
-    results_dir = "{}_results".format(os.path.splitext(img_fname)[0])
+    results_dir = QM_load.get_results_dir(img_fname)
     if os.path.isdir(results_dir) == False:
         os.mkdir(results_dir)
 
     # Plot grey value histogram
-    img_1d = img.flatten()
     fig  = plt.figure()
     ax = plt.subplot(111)
-    bins = int(0.25 * np.sqrt(len(img_1d)))
-    histo = plt.hist(img_1d, bins = bins, density = True, linewidth = 0, label = "Pixel Intensities")
+    if not isinstance(img, QM_histogram.Histogram):
+        img = QM_histogram.histogram_from_image(img)
+    img_histo = img.rebin(int(0.25 * np.sqrt(img.n_voxels)))
+    histo = plt.hist(img_histo.bin_centres, bins = img_histo.bin_edges, weights = img_histo.counts, density = True, linewidth = 0, label = "Pixel Intensities")
 
     # Plot fitted Gaussians
     mu, sigma, weights = extract_GMM_results(GMM)
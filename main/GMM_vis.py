@@ -9,30 +9,44 @@ from bokeh.plotting import figure, output_file, show
 from bokeh.palettes import Set2, Greys
 from PIL import Image
 import QM_load
+import QM_histogram
 
 # Functions
 
-def bokeh_plot(img_fname):
+def bokeh_plot(img_fname, img=None):
     """ Generates Bokeh plot of img histogram and fitted GMM results
     Parameters
     ----------
+    img_fname : str
+        Filepath of image, fitted results are read from its results directory
+    img : numpy array or Histogram, optional
+        Loaded image or grey value histogram, output from QM_load or QM_histogram.QM_load_histogram.
+        If None, the histogram saved by QM_histogram.save_histogram is used, or if there is none, the image is
+        loaded with QM_load.
 
     Returns
     -------
 
     """
     # Create plot
-    basename = os.path.splitext(os.path.basename(img_fname))[0]
+    basename = os.path.splitext(os.path.basename(os.path.normpath(img_fname)))[0]
     p = figure(title="Image: {}, click on legend entries to hide".format(basename))
     #TODO[Elaine]: Figure out hover to show mu and sigma
     #TODO[Elaine]: Figure out how to use ColumnDataSource
     #TODO[Elaine]: Choose image from file input to view
 
     # Import image and generate histogram CDS
-    img = QM_load.QM_load(img_fname)
-    hist, edges = np.histogram(img, density=True, bins=int(0.25 * np.sqrt(len(img))))
-    bin_width = edges[1] - edges[0]
-    bin_midpoint = edges[:-1] + bin_width
+    results_dir = QM_load.get_results_dir(img_fname)
+    if img is None and os.path.isfile(os.path.join(results_dir, QM_histogram.HISTOGRAM_FNAME)):
+        img = QM_histogram.load_saved_histogram(img_fname)
+    elif img is None:
+        img = QM_load.QM_load(img_fname)
+    if not isinstance(img, QM_histogram.Histogram):
+        img = QM_histogram.histogram_from_image(img)
+    img_histo = img.rebin(int(0.25 * np.sqrt(img.n_voxels)))
+    hist = img_histo.density()
+    bin_width = img_histo.bin_width
+    bin_midpoint = img_histo.bin_centres
     
     # Histogram
     p.vbar(x=bin_midpoint, top=hist, bottom=0, width=bin_width, alpha=0.5, legend_label="Image histogram")
@@ -40,7 +54,6 @@ def bokeh_plot(img_fname):
     p.yaxis.axis_label = "Probability Density"
 
     # GMM results
-    results_dir = "{}_results".format(os.path.splitext(img_fname)[0])
     GMM_results = np.loadtxt(os.path.join(results_dir, "fitted_results.csv"), delimiter=",")
     norm_mat = np.zeros([len(bin_midpoint), len(GMM_results)])
     colours = (Set2[8])
@@ -58,9 +71,7 @@ def bokeh_plot(img_fname):
     p.legend.click_policy = "hide"
 
     # Get image and open to central slice
-    I = Image.open(img_fname)
-    I.seek(int(I.n_frames/2))
-    img_np = np.array(I)
+    img_np = QM_load.read_slices(img_fname, [int(QM_load.get_n_slices(img_fname)/2)], n_workers=1)[0]
     img_p_tooltips = [("x","$x"), ("y","$y"), ("grey value","@image")]
     img_p = figure(title=os.path.basename(img_fname), tooltips=img_p_tooltips)
     img_p.image(image=[img_np], x=0, y=0, dw=10, dh=10, palette=Greys[9], level="image")
@@ -0,0 +1,319 @@
+import os
+import time
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+import QM_load
+import QM_histogram
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "GMM_Image_Quality")
+MAX_CACHE_BYTES = 2 * 1024**3 # least recently used entries are evicted beyond this size
+CACHE_EXTENSION = ".npz"
+
+def file_identity(img_fname, raw_header = None):
+    """ Describes the files making up an image by path, size and modification time
+
+    Any change to the image, e.g. overwriting a slice of an image sequence or editing the header of a raw volume,
+    changes its identity, so stale cache entries are never used.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    raw_header : dict, optional
+        Raw volume description, see QM_load.raw_volume_memmap
+
+    Returns
+    -------
+    list
+        List of (absolute path, size in bytes, modification time in ns) tuples
+    """
+    if QM_load.is_image_sequence(img_fname):
+        fnames = QM_load.list_image_sequence(img_fname)
+    else:
+        fnames = [img_fname]
+        if QM_load.is_raw_volume(img_fname) and raw_header is None:
+            fnames.append(QM_load.find_raw_header(img_fname))
+    identity = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        identity.append((os.path.abspath(fname), stat.st_size, stat.st_mtime_ns))
+    return identity
+
+def cache_key(img_fname, kind, raw_header = None, **load_params):
+    """ Content-addressed key of an image loaded with given parameters
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image, as passed to QM_load
+    kind : str
+        What is cached, e.g. "voxels" or "histogram"
+    raw_header : dict, optional
+        Raw volume description, see QM_load.raw_volume_memmap
+    **load_params
+        Parameters which change the loaded voxels, e.g. pct_stack_import, grey value window and roi
+
+    Returns
+    -------
+    str
+        SHA-1 hex digest
+    """
+    identity = file_identity(img_fname, raw_header)
+    raw_header = None if raw_header is None else sorted(raw_header.items())
+    description = repr((kind, identity, raw_header, sorted(load_params.items())))
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+def fit_fingerprint(img, histo = None):
+    """ Digest of the grey values a Gaussian mixture model is fitted to
+
+    8-bit and 16-bit images are fingerprinted by their grey value histogram, so images holding the same grey values
+    in any order, e.g. byte-identical re-exports, share a fingerprint. Other images are fingerprinted by their voxels.
+
+    Parameters
+    ----------
+    img : numpy array or Histogram
+        Image output from QM_load.QM_load, or grey value histogram output from QM_histogram.QM_load_histogram
+    histo : Histogram, optional
+        QM_histogram.histogram_from_image of img, if already computed, so 8-bit and 16-bit images are not binned again
+
+    Returns
+    -------
+    str
+        SHA-1 hex digest
+    """
+    if isinstance(img, QM_histogram.Histogram):
+        arrays = ["histogram", img.bin_edges, img.counts]
+    elif np.issubdtype(img.dtype, np.integer) and img.dtype.itemsize <= 2:
+        histo = histo if histo is not None else QM_histogram.histogram_from_image(img)
+        arrays = ["voxels", histo.bin_edges, histo.counts]
+    else:
+        arrays = ["voxels", np.ravel(img)]
+    digest = hashlib.sha1(arrays[0].encode("utf-8"))
+    for array in arrays[1:]:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((str(array.dtype), array.shape)).encode("utf-8"))
+        digest.update(array)
+    return digest.hexdigest()
+
+def fit_cache_key(img, histo = None, **fit_params):
+    """ Content-addressed key of a Gaussian mixture model fitted to img with given parameters
+
+    Parameters
+    ----------
+    img : numpy array or Histogram
+        Data the model is fitted to, see fit_fingerprint
+    histo : Histogram, optional
+        Grey value histogram of img, see fit_fingerprint
+    **fit_params
+        Parameters which change the fitted model, e.g. n_gaussians, initial parameters, engine and fitter version
+
+    Returns
+    -------
+    str
+        SHA-1 hex digest
+    """
+    description = repr(("fit", fit_fingerprint(img, histo), sorted(fit_params.items())))
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+def cache_fname(key, cache_dir = None):
+    """ Filepath of the cache entry for key
+
+    Parameters
+    ----------
+    key : str
+        Output from cache_key
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+
+    Returns
+    -------
+    str
+        Filepath of .npz cache entry
+    """
+    return os.path.join(cache_dir or CACHE_DIR, key + CACHE_EXTENSION)
+
+def cache_load(key, cache_dir = None):
+    """ Reads the arrays stored under key, marking the entry as recently used
+
+    Parameters
+    ----------
+    key : str
+        Output from cache_key
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+
+    Returns
+    -------
+    dict or None
+        Dict of numpy arrays, or None if key is not cached
+    """
+    fname = cache_fname(key, cache_dir)
+    try:
+        with np.load(fname) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+    except (FileNotFoundError, PermissionError): # missing or evicted by another process
+        return None
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile): # truncated or corrupt, e.g. by a crash while copying the cache
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(fname) # modification time orders entries for eviction
+    except OSError: # evicted by another process since it was read
+        pass
+    return arrays
+
+def cache_save(key, arrays, cache_dir = None, max_cache_bytes = MAX_CACHE_BYTES):
+    """ Stores arrays under key as an uncompressed .npz file, then evicts least recently used entries
+
+    The entry is written to a temporary file and renamed, so readers never see a partial entry.
+
+    Parameters
+    ----------
+    key : str
+        Output from cache_key
+    arrays : dict
+        Dict of numpy arrays to store
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+    max_cache_bytes : int, default MAX_CACHE_BYTES
+        Maximum total size of the cache directory
+
+    Returns
+    -------
+    None
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok = True)
+    fd, tmp_fname = tempfile.mkstemp(suffix = ".tmp", dir = cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_fname, cache_fname(key, cache_dir))
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+    evict(cache_dir, max_cache_bytes)
+
+def evict(cache_dir = None, max_cache_bytes = MAX_CACHE_BYTES):
+    """ Deletes least recently used cache entries until the cache is at most max_cache_bytes
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+    max_cache_bytes : int, default MAX_CACHE_BYTES
+        Maximum total size of the cache directory
+
+    Returns
+    -------
+    None
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(CACHE_EXTENSION):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries): # oldest first
+        if total_bytes <= max_cache_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError: # already evicted by another process
+            pass
+        total_bytes -= size
+
+def QM_load_cached(img_fname, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 10., raw_header = None, n_samples = None, random_state = 3, roi = None, cache_dir = None, max_cache_bytes = MAX_CACHE_BYTES, **kwargs):
+    """ QM_load.QM_load, reading the voxels from the cache if the same image was loaded with the same parameters before
+
+    Parameters
+    ----------
+    img_fname, min_GV, max_GV, specify_gv, pct_stack_import, raw_header, n_samples, random_state, roi
+        See QM_load.QM_load
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+    max_cache_bytes : int, default MAX_CACHE_BYTES
+        Maximum total size of the cache directory
+    **kwargs
+        Passed to QM_load.QM_load, e.g. use_memmap and n_workers, which do not change the loaded voxels
+
+    Returns
+    -------
+    img
+        Flattened 1D numpy array, see QM_load.QM_load
+    """
+    start = time.time()
+    if specify_gv == False: # limits are ignored by QM_load, so must not split the cache
+        min_GV, max_GV = None, None
+    key = cache_key(img_fname, "voxels", raw_header, min_GV = min_GV, max_GV = max_GV, specify_gv = specify_gv,
+        pct_stack_import = pct_stack_import, n_samples = n_samples, random_state = random_state, roi = roi)
+    arrays = cache_load(key, cache_dir)
+    if arrays is not None:
+        print("Image loaded from cache, time elapsed = {0:.2f} s".format((time.time()-start)))
+        return arrays["img"]
+
+    img = QM_load.QM_load(img_fname, min_GV, max_GV, specify_gv, pct_stack_import, raw_header = raw_header,
+        n_samples = n_samples, random_state = random_state, roi = roi, **kwargs)
+    cache_save(key, {"img": img}, cache_dir, max_cache_bytes)
+    return img
+
+def QM_load_histogram_cached(img_fname, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 100., n_bins = 256, raw_header = None, roi = None, cache_dir = None, max_cache_bytes = MAX_CACHE_BYTES, **kwargs):
+    """ QM_histogram.QM_load_histogram, reading the histogram from the cache if it was accumulated before
+
+    Grey value limits with specify_gv == False only set the bins of images other than 8-bit and 16-bit, so
+    histograms of 8-bit and 16-bit images are stored without them, together with the dtype of the image. A
+    lookup with such limits falls back to that entry, so a cache hit never reads the image.
+
+    Parameters
+    ----------
+    img_fname, min_GV, max_GV, specify_gv, pct_stack_import, n_bins, raw_header, roi
+        See QM_histogram.QM_load_histogram
+    cache_dir : str, optional
+        Cache directory, defaults to CACHE_DIR
+    max_cache_bytes : int, default MAX_CACHE_BYTES
+        Maximum total size of the cache directory
+    **kwargs
+        Passed to QM_histogram.QM_load_histogram, e.g. use_memmap and n_workers
+
+    Returns
+    -------
+    Histogram
+        Grey value histogram, see QM_histogram.QM_load_histogram
+    """
+    start = time.time()
+
+    def histogram_key(min_GV, max_GV):
+        return cache_key(img_fname, "histogram", raw_header, min_GV = min_GV, max_GV = max_GV, specify_gv = specify_gv,
+            pct_stack_import = pct_stack_import, n_bins = n_bins, roi = roi)
+
+    def limits_unused(dtype):
+        return np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2 # limits only set the bins of other dtypes
+
+    ignored_limits = specify_gv == False and (min_GV is not None or max_GV is not None)
+    key = histogram_key(min_GV, max_GV)
+    arrays = cache_load(key, cache_dir)
+    if arrays is None and ignored_limits == True: # 8-bit and 16-bit histograms are stored without the limits
+        arrays = cache_load(histogram_key(None, None), cache_dir)
+        if arrays is not None and ("dtype" not in arrays or not limits_unused(np.dtype(str(arrays["dtype"])))):
+            arrays = None
+    if arrays is not None:
+        print("Image histogram loaded from cache, time elapsed = {0:.2f} s".format((time.time()-start)))
+        return QM_histogram.Histogram(arrays["bin_edges"], arrays["counts"], bool(arrays["integer"]))
+
+    slice_indices = QM_load.roi_slice_indices(QM_load.get_n_slices(img_fname, raw_header), pct_stack_import, roi)
+    dtype = QM_load.read_slice(img_fname, slice_indices[0], raw_header = raw_header, crop = QM_load.roi_slices(roi)[1:]).dtype
+    if ignored_limits == True and limits_unused(dtype):
+        min_GV, max_GV = None, None
+        key = histogram_key(None, None)
+    histo = QM_histogram.QM_load_histogram(img_fname, min_GV, max_GV, specify_gv, pct_stack_import, n_bins = n_bins,
+        raw_header = raw_header, roi = roi, **kwargs)
+    cache_save(key, {"bin_edges": histo.bin_edges, "counts": histo.counts, "integer": np.array(histo.integer),
+        "dtype": np.array(dtype.str)}, cache_dir, max_cache_bytes)
+    return histo
@@ -2,8 +2,128 @@ import numpy as np
 import sys
 import pandas as pd
 import os
+from scipy.stats import norm
 
-def QM_calc(mu, sigma, results_dir, save_results = True, verbose = True):
+def SNR_CNR(mu, sigma):
+    """ Calculates SNR and CNR of every pair of Gaussians, for one or many images at once
+
+    SNR = mu_A / sigma_B
+    CNR = |mu_A - mu_B| / sqrt(sigma_A**2 + sigma_B**2)
+
+    Parameters
+    ----------
+    mu : array-like
+        Means of fitted Gaussians, shape (n_gaussians, ) or (n_images, n_gaussians)
+    sigma : array-like
+        Standard deviations of fitted Gaussians, same shape as mu
+
+    Returns
+    -------
+    SNR, CNR : numpy array
+        Shape (n_gaussians, n_gaussians) or (n_images, n_gaussians, n_gaussians), with Gaussian A along the second
+        last and Gaussian B along the last axis. Pairs of a Gaussian with itself are NaN.
+    """
+    mu = np.asarray(mu, dtype = np.float64)
+    sigma = np.asarray(sigma, dtype = np.float64)
+    mu_A, mu_B = mu[..., :, np.newaxis], mu[..., np.newaxis, :]
+    sigma_A, sigma_B = sigma[..., :, np.newaxis], sigma[..., np.newaxis, :]
+    SNR = mu_A / sigma_B
+    CNR = np.abs(mu_A - mu_B) / np.sqrt(sigma_A**2 + sigma_B**2)
+    diagonal = np.eye(mu.shape[-1], dtype = bool)
+    SNR[..., diagonal] = np.nan
+    CNR[..., diagonal] = np.nan
+    return SNR, CNR
+
+def overlap_metrics(mu, sigma, weights):
+    """ Calculates the separation of every pair of Gaussians in closed form, for one or many images at once
+
+    Bhattacharyya = (mu_A - mu_B)**2 / (4 * (sigma_A**2 + sigma_B**2)) + ln((sigma_A**2 + sigma_B**2) / (2 * sigma_A * sigma_B)) / 2
+    Overlap = integral of min(w_A * N(x; mu_A, sigma_A), w_B * N(x; mu_B, sigma_B)) dx, with w_A + w_B = 1
+    Threshold = grey value between mu_A and mu_B where w_A * N(x; mu_A, sigma_A) = w_B * N(x; mu_B, sigma_B)
+
+    Overlap is the fraction of voxels of materials A and B which are misclassified by the Bayes optimal
+    classifier, i.e. by assigning each grey value to the more probable of the two Gaussians. The weighted
+    densities cross where a quadratic in x is zero, and between consecutive crossings one density lies below
+    the other, so the overlap is the sum over these intervals of the smaller Gaussian mass, from the normal CDF.
+    Threshold is NaN if neither crossing lies between the means, e.g. if one Gaussian is so much larger that it
+    is more probable than the other at every grey value.
+
+    Parameters
+    ----------
+    mu : array-like
+        Means of fitted Gaussians, shape (n_gaussians, ) or (n_images, n_gaussians)
+    sigma : array-like
+        Standard deviations of fitted Gaussians, same shape as mu
+    weights : array-like
+        Weights of fitted Gaussians, same shape as mu, renormalised within each pair
+
+    Returns
+    -------
+    Bhattacharyya, Overlap, Threshold : numpy array
+        Symmetric, shape (n_gaussians, n_gaussians) or (n_images, n_gaussians, n_gaussians) as SNR_CNR, NaN where A == B
+    """
+    mu = np.asarray(mu, dtype = np.float64)
+    sigma = np.asarray(sigma, dtype = np.float64)
+    weights = np.asarray(weights, dtype = np.float64)
+    mu_A, mu_B = mu[..., :, np.newaxis], mu[..., np.newaxis, :]
+    sigma_A, sigma_B = sigma[..., :, np.newaxis], sigma[..., np.newaxis, :]
+    weights_A, weights_B = weights[..., :, np.newaxis], weights[..., np.newaxis, :]
+    weights_A, weights_B = weights_A / (weights_A + weights_B), weights_B / (weights_A + weights_B)
+    variance_sum = sigma_A**2 + sigma_B**2
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        Bhattacharyya = (mu_A - mu_B)**2 / (4. * variance_sum) + 0.5 * np.log(variance_sum / (2. * sigma_A * sigma_B))
+
+        # log(w_A N_A) - log(w_B N_B) = a x**2 + b x + c
+        a = 1. / (2. * sigma_B**2) - 1. / (2. * sigma_A**2)
+        b = mu_A / sigma_A**2 - mu_B / sigma_B**2
+        c = mu_B**2 / (2. * sigma_B**2) - mu_A**2 / (2. * sigma_A**2) + np.log(weights_A * sigma_B / (weights_B * sigma_A))
+        quadratic = np.abs(a) * np.maximum(sigma_A, sigma_B)**2 > 1e-12 # otherwise equal sigma, a single crossing
+        discriminant = b**2 - 4. * a * c
+        root = np.sqrt(np.where(discriminant >= 0, discriminant, np.nan)) # no crossings if negative
+        crossings = np.where(quadratic[..., np.newaxis],
+            np.stack([(-b - root) / (2. * a), (-b + root) / (2. * a)], axis = -1),
+            np.stack([-c / b, np.full(np.broadcast(b, c).shape, np.nan)], axis = -1))
+    crossings = np.sort(np.where(np.isnan(crossings), np.inf, crossings), axis = -1) # missing crossings give empty intervals
+
+    edges = np.concatenate([np.full(crossings.shape[:-1] + (1, ), -np.inf), crossings, np.full(crossings.shape[:-1] + (1, ), np.inf)], axis = -1)
+    mass_A = weights_A[..., np.newaxis] * np.diff(norm.cdf(edges, mu_A[..., np.newaxis], sigma_A[..., np.newaxis]), axis = -1)
+    mass_B = weights_B[..., np.newaxis] * np.diff(norm.cdf(edges, mu_B[..., np.newaxis], sigma_B[..., np.newaxis]), axis = -1)
+    Overlap = np.minimum(mass_A, mass_B).sum(axis = -1)
+
+    low, high = np.minimum(mu_A, mu_B)[..., np.newaxis], np.maximum(mu_A, mu_B)[..., np.newaxis]
+    between = (crossings >= low) & (crossings <= high)
+    Threshold = np.where(between, crossings, np.inf).min(axis = -1)
+    Threshold[np.isinf(Threshold)] = np.nan
+
+    diagonal = np.eye(mu.shape[-1], dtype = bool)
+    for metric in (Bhattacharyya, Overlap, Threshold):
+        metric[..., diagonal] = np.nan
+    return Bhattacharyya, Overlap, Threshold
+
+def SNR_CNR_table(SNR, CNR, metrics = None):
+    """ Formats SNR and CNR of one image as a table with one row per pair of different Gaussians
+
+    Parameters
+    ----------
+    SNR, CNR : numpy array
+        Output from SNR_CNR for one image, shape (n_gaussians, n_gaussians)
+    metrics : dict
+        Optional further pairwise metrics of the same shape to add as columns, keyed by column name, e.g. the
+        output from overlap_metrics. Defaults to None.
+
+    Returns
+    -------
+    SNR_CNR_df : pandas DataFrame
+        Pandas DataFrame indexed by Gaussian_A with columns Gaussian_B, SNR, CNR and any metrics
+    """
+    gaussian_A, gaussian_B = np.nonzero(~np.eye(len(SNR), dtype = bool)) # every ordered pair with A != B
+    SNR_CNR_df = pd.DataFrame({"Gaussian_A": gaussian_A, "Gaussian_B": gaussian_B,
+        "SNR": SNR[gaussian_A, gaussian_B], "CNR": CNR[gaussian_A, gaussian_B]})
+    for name, metric in (metrics or {}).items():
+        SNR_CNR_df[name] = metric[gaussian_A, gaussian_B]
+    return SNR_CNR_df.set_index("Gaussian_A")
+
+def QM_calc(mu, sigma, results_dir, save_results = True, verbose = True, weights = None):
     """ Given mu and sigma, calculate SNR and CNR of all possible combinations
 
     SNR = mu_A / sigma_B
@@ -21,40 +141,32 @@ def QM_calc(mu, sigma, results_dir, save_results = True, verbose = True):
         If True, save results to results_dir.
     verbose : bool
         If True, print results to console
-    
+    weights : numpy array
+        Numpy 1-D array of weights of fitted Gaussians as floats. If given, the Bhattacharyya distance, overlap
+        and decision threshold of each pair are added, see overlap_metrics. Defaults to None.
+
     Returns
     -------
     SNR_CNR_df : pandas DataFrames
-        Pandas DataFame of Gaussian A, Gaussian B, SNR and CNR
+        Pandas DataFame of Gaussian A, Gaussian B, SNR and CNR, and Bhattacharyya, Overlap and Threshold if weights are given
     """
 
-    SNR_all = [] # initialise lists to append to
-    CNR_all = []
-    gaussian_A = []
-    gaussian_B = []
-
     # Calculate SNR and CNR ------------------------------------------------------------------------------------------------------------
+    metrics = None
+    if weights is not None:
+        metrics = dict(zip(["Bhattacharyya", "Overlap", "Threshold"], overlap_metrics(mu, sigma, weights)))
+    SNR_CNR_df = SNR_CNR_table(*SNR_CNR(mu, sigma), metrics = metrics)
+
     print("SNR and CNR Results \n===================")
-    for i in range(len(mu)):
-        for j in range(len(mu)):
-            if(i != j):
-                SNR = mu[i] / sigma[j] # calculate SNR
-                CNR = np.abs(mu[i] - mu[j]) / np.sqrt(sigma[i]**2 + sigma[j]**2) # calculate CNR
-                SNR_all.append(SNR)
-                CNR_all.append(CNR)
-                gaussian_A.append(i)
-                gaussian_B.append(j)
-                if verbose == True:
-                    print("SNR = {0:.2f} and CNR = {1:.2f} with Gaussian A = {2} and Gaussian B = {3}".format(SNR, CNR, i, j))
+    if verbose == True:
+        for gaussian_A, row in SNR_CNR_df.iterrows():
+            print("SNR = {0:.2f} and CNR = {1:.2f} with Gaussian A = {2} and Gaussian B = {3}".format(row["SNR"], row["CNR"], gaussian_A, int(row["Gaussian_B"])))
     if verbose == False:
         print("Non-verbose mode")
 
     # Output as pd df to send to .csv --------------------------------------------------------------------------------------------------
 
-    columns = ["Gaussian_A", "Gaussian_B", "SNR", "CNR"]
-    SNR_CNR_df = pd.DataFrame(list(zip(gaussian_A, gaussian_B, SNR_all, CNR_all)), columns = columns)
-    SNR_CNR_df = SNR_CNR_df.set_index("Gaussian_A")
     if save_results == True:
         SNR_CNR_df.to_csv(os.path.join(results_dir, "SNR_CNR_Results.csv"))
 
-    return SNR_CNR_df
\ No newline at end of file
+    return SNR_CNR_df
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import sqlite3
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    img_fname TEXT NOT NULL,
+    n_gaussians INTEGER NOT NULL,
+    engine TEXT,
+    params TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS components (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    gaussian INTEGER NOT NULL,
+    mu REAL, sigma REAL, weight REAL,
+    PRIMARY KEY (run_id, gaussian)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    gaussian_a INTEGER NOT NULL,
+    gaussian_b INTEGER NOT NULL,
+    snr REAL, cnr REAL, bhattacharyya REAL, overlap REAL, threshold REAL,
+    PRIMARY KEY (run_id, gaussian_a, gaussian_b)
+);
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    step TEXT NOT NULL,
+    seconds REAL,
+    PRIMARY KEY (run_id, step)
+);
+CREATE INDEX IF NOT EXISTS runs_img_fname ON runs (img_fname);
+CREATE INDEX IF NOT EXISTS runs_engine_n_gaussians ON runs (engine, n_gaussians);
+"""
+METRIC_COLUMNS = ["SNR", "CNR", "Bhattacharyya", "Overlap", "Threshold"] # columns of QM_calc.QM_calc, in table order
+
+def connect(db_fname):
+    """ Opens a results database, creating the tables and indices if they do not exist yet
+
+    Parameters
+    ----------
+    db_fname : str
+        Filepath of the SQLite database, e.g. one database for every scan of a study
+
+    Returns
+    -------
+    sqlite3.Connection
+    """
+    db_dir = os.path.dirname(os.path.abspath(db_fname))
+    if os.path.isdir(db_dir) == False:
+        os.makedirs(db_dir)
+    connection = sqlite3.connect(db_fname)
+    connection.execute("PRAGMA journal_mode = WAL") # readers are not blocked while a batch is written
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+def run_record(img_fname, mu, sigma, weights, SNR_CNR_df, params = None, timing = None):
+    """ Collects the results of one run of the workflow for save_runs
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of the fitted image
+    mu, sigma, weights : numpy array
+        Output from GMM_fit.extract_GMM_results
+    SNR_CNR_df : pandas DataFrame
+        Output from QM_calc.QM_calc, with or without the overlap metrics
+    params : dict
+        User parameters of the run, e.g. engine and pct_stack_import, must be JSON-serialisable. Defaults to None.
+    timing : dict
+        Seconds spent in each step, e.g. the timing of QM_runner diagnostics. Defaults to None.
+
+    Returns
+    -------
+    dict
+    """
+    params = dict(params or {})
+    return {"img_fname": os.path.abspath(img_fname), "n_gaussians": len(mu), "engine": params.get("engine"),
+        "params": json.dumps(params, sort_keys = True, default = str), "created": time.time(),
+        "components": [(i, float(mu[i]), float(sigma[i]), float(weights[i])) for i in range(len(mu))],
+        "metrics": [(int(gaussian_A), int(row["Gaussian_B"])) + tuple(float(row[column]) if column in row else None for column in METRIC_COLUMNS)
+            for gaussian_A, row in SNR_CNR_df.iterrows()],
+        "timing": sorted((timing or {}).items())}
+
+def save_runs(db_fname, records):
+    """ Writes many runs to a results database in a single transaction
+
+    Either every run is written or, if anything fails, none are, so the database never holds partial runs.
+    Writing runs in batches rather than one at a time avoids a disk sync per run.
+
+    Parameters
+    ----------
+    db_fname : str
+        Filepath of the SQLite database
+    records : list
+        Outputs from run_record
+
+    Returns
+    -------
+    list
+        run_id of each record, in order
+    """
+    connection = connect(db_fname)
+    run_ids = []
+    try:
+        with connection: # commits on success, rolls back on any exception
+            for record in records:
+                cursor = connection.execute("INSERT INTO runs (img_fname, n_gaussians, engine, params, created) VALUES (?, ?, ?, ?, ?)",
+                    (record["img_fname"], record["n_gaussians"], record["engine"], record["params"], record["created"]))
+                run_id = cursor.lastrowid
+                connection.executemany("INSERT INTO components VALUES (?, ?, ?, ?, ?)", [(run_id, ) + row for row in record["components"]])
+                connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(run_id, ) + row for row in record["metrics"]])
+                connection.executemany("INSERT INTO timings VALUES (?, ?, ?)", [(run_id, step, seconds) for step, seconds in record["timing"]])
+                run_ids.append(run_id)
+    finally:
+        connection.close()
+    return run_ids
+
+def run_filter(img_fname = None, engine = None, n_gaussians = None, run_ids = None):
+    """ SQL WHERE clause and arguments selecting runs, using the indices on img_fname, engine and n_gaussians """
+    conditions, args = [], []
+    if img_fname is not None:
+        conditions.append("runs.img_fname = ?")
+        args.append(os.path.abspath(img_fname))
+    if engine is not None:
+        conditions.append("runs.engine = ?")
+        args.append(engine)
+    if n_gaussians is not None:
+        conditions.append("runs.n_gaussians = ?")
+        args.append(int(n_gaussians))
+    if run_ids is not None:
+        run_ids = [int(run_id) for run_id in run_ids]
+        conditions.append("runs.run_id IN ({})".format(", ".join("?" * len(run_ids)) or "NULL"))
+        args.extend(run_ids)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), args
+
+def query_runs(db_fname, img_fname = None, engine = None, n_gaussians = None, run_ids = None):
+    """ Lists runs in a results database with their parameters and timings
+
+    Parameters
+    ----------
+    db_fname : str
+        Filepath of the SQLite database
+    img_fname, engine, n_gaussians, run_ids : optional
+        Only return runs of this image, engine, number of Gaussians or with these run_ids. Defaults to None, no filter.
+
+    Returns
+    -------
+    runs_df : pandas DataFrame
+        Indexed by run_id, with columns img_fname, n_gaussians, engine, params (JSON), created (seconds since the
+        epoch) and one column time_<step> per timed step, NaN where that step was not timed
+    """
+    where, args = run_filter(img_fname, engine, n_gaussians, run_ids)
+    connection = connect(db_fname)
+    try:
+        runs_df = pd.read_sql_query("SELECT * FROM runs" + where + " ORDER BY run_id", connection, params = args, index_col = "run_id")
+        timings_df = pd.read_sql_query("SELECT timings.* FROM timings JOIN runs USING (run_id)" + where, connection, params = args)
+    finally:
+        connection.close()
+    timings_df = timings_df.pivot(index = "run_id", columns = "step", values = "seconds").add_prefix("time_")
+    return runs_df.join(timings_df)
+
+def export_results(db_fname, img_fname = None, engine = None, n_gaussians = None, run_ids = None):
+    """ Exports the metrics of every pair of Gaussians of many runs as one table, with a single query
+
+    Parameters
+    ----------
+    db_fname : str
+        Filepath of the SQLite database
+    img_fname, engine, n_gaussians, run_ids : optional
+        See query_runs
+
+    Returns
+    -------
+    results_df : pandas DataFrame
+        One row per run and ordered pair of different Gaussians, with columns run_id, img_fname, n_gaussians,
+        engine, Gaussian_A, Gaussian_B, mu, sigma and weight of both Gaussians (suffixed _A and _B) and SNR, CNR,
+        Bhattacharyya, Overlap and Threshold
+    """
+    where, args = run_filter(img_fname, engine, n_gaussians, run_ids)
+    query = """SELECT runs.run_id, runs.img_fname, runs.n_gaussians, runs.engine,
+        metrics.gaussian_a AS Gaussian_A, metrics.gaussian_b AS Gaussian_B,
+        a.mu AS mu_A, a.sigma AS sigma_A, a.weight AS weight_A, b.mu AS mu_B, b.sigma AS sigma_B, b.weight AS weight_B,
+        metrics.snr AS SNR, metrics.cnr AS CNR, metrics.bhattacharyya AS Bhattacharyya, metrics.overlap AS Overlap, metrics.threshold AS Threshold
+        FROM metrics JOIN runs USING (run_id)
+        JOIN components a ON a.run_id = metrics.run_id AND a.gaussian = metrics.gaussian_a
+        JOIN components b ON b.run_id = metrics.run_id AND b.gaussian = metrics.gaussian_b""" + where + """
+        ORDER BY runs.run_id, metrics.gaussian_a, metrics.gaussian_b"""
+    connection = connect(db_fname)
+    try:
+        results_df = pd.read_sql_query(query, connection, params = args)
+    finally:
+        connection.close()
+    return results_df
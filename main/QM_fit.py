@@ -10,7 +10,11 @@ from scipy.stats import norm
 import os
 import csv
 
-def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True):
+import GMM_fit
+import QM_load
+import QM_histogram
+
+def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True, engine = "sklearn"):
     """ Fits Gaussian mixture model to grey value histogram of img
 
     Parameters
@@ -25,6 +29,8 @@ def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True):
         If True, save results to results directory, if false don't save results.
     show_plots : bool
         If True, show plots
+    engine : str
+        "sklearn" to fit every voxel with sklearn GaussianMixture, or "histogram" to run EM on the grey value histogram
 
     Returns
     -------
@@ -38,10 +44,14 @@ def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True):
     
     start = time.time()
 
-    img_1d = img.flatten() # flatten 3D img array
+    img_1d = np.ravel(img) # flatten 3D img array without copying
+    img_histo = QM_histogram.histogram_from_image(img_1d) # binned once, for fitting and plotting
 
-    GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3) # fix random state for predictability
-    GMMfit = GMM.fit(img_1d.reshape(-1,1))
+    if engine == "histogram":
+        GMM = GMM_fit.GMM_fit_histogram(img_histo, n_gaussians)
+    else:
+        GMM = sklearn.mixture.GaussianMixture(n_components = n_gaussians, random_state = 3) # fix random state for predictability
+        GMMfit = GMM.fit(img_1d.astype(np.float64, copy = False).reshape(-1,1))
     
     end = time.time()
 
@@ -51,8 +61,8 @@ def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True):
     
     fig = plt.figure()
     ax = plt.subplot(111)
-    bins = int(0.25 * np.sqrt(len(img_1d)))
-    histo = plt.hist(img_1d, bins = bins, density = True, linewidth = 0)
+    plot_histo = img_histo.rebin(int(0.25 * np.sqrt(len(img_1d))))
+    histo = plt.hist(plot_histo.bin_centres, bins = plot_histo.bin_edges, weights = plot_histo.counts, density = True, linewidth = 0)
 
     # Extract mu and sigma from fitted model ---------------------------------------------------------------------------------------
 
@@ -69,7 +79,7 @@ def QM_fit(img, n_gaussians, img_fname, save_results = True, show_plots = True):
     # Plot fitted Gaussians and save to out_dir ---------------------------------------------------------------------------------------
     
     if save_results == True:
-        out_dir = "{}_results".format(os.path.splitext(img_fname)[0]) # define results directory
+        out_dir = QM_load.get_results_dir(img_fname) # define results directory
         if os.path.isdir(out_dir) == False:
             os.mkdir(out_dir) # create results directory if not already existing
 
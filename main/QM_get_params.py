@@ -11,12 +11,14 @@ def QM_get_params():
     -------
     dict
         Dict containing user parameters
-        - min_gv: minimum grey value (optional), defaults to 0
-        - max_gv: maximum grey value (optional), defaults to 255
+        - min_gv: minimum grey value (optional), None if "auto", i.e. no lower limit
+        - max_gv: maximum grey value (optional), None if "auto", i.e. no upper limit
         - pct_stack_import: % of stack to import
         - img_fname: image filename to import
-        - n_gaussians: number of Gaussians to fit
+        - n_gaussians: number of Gaussians to fit, or "auto" to choose by BIC
+        - max_gaussians: largest number of Gaussians considered if n_gaussians is "auto", defaults to 6
         - specify_gv: if True, limit grey values to min_gv, max_gv
+        - roi: bounding box (z_min, z_max, y_min, y_max, x_min, x_max) to crop to, None if not specified
     """
     # Find users_params.txt
     f = open(os.path.join(os.path.dirname(__file__), "temp_user_dir.txt"), "r")
@@ -34,11 +36,17 @@ def QM_get_params():
     user_params = dict(zip(keys, vals))
 
     # Format values properly
-    user_params['max_gv'] = float(user_params['max_gv'])
-    user_params['min_gv'] = float(user_params['min_gv'])
+    for key in ['min_gv', 'max_gv']:
+        user_params[key] = None if user_params[key].strip().lower() in ["auto", ""] else float(user_params[key])
     user_params['pct_stack_import'] = float(user_params['pct_stack_import'])
-    user_params['n_gaussians'] = int(user_params['n_gaussians'])
+    if user_params['n_gaussians'] != "auto":
+        user_params['n_gaussians'] = int(user_params['n_gaussians'])
+    user_params['max_gaussians'] = int(user_params.get('max_gaussians', 6))
     user_params['specify_gv'] = user_params['specify_gv'] == "True"
+    if user_params.get('specify_roi') == "True":
+        user_params['roi'] = tuple(None if value.lower() == "none" else int(value) for value in user_params['roi'].replace(",", " ").split())
+    else:
+        user_params['roi'] = None
     
     # Print user params to console
     print("Selected parameters: \n====================")
@@ -0,0 +1,341 @@
+import os
+import time
+import numpy as np
+
+import QM_load
+
+MAX_INTEGER_BINS = 65536 # integer images spanning more grey values are binned like floating point images
+ADD_CHUNK_SIZE = 2**20 # voxels binned at once, bounds the temporary arrays made by bincount
+HISTOGRAM_FNAME = "histogram.npz" # saved in the results directory by save_histogram
+
+class Histogram:
+    """ Grey value histogram which can be accumulated slice by slice
+
+    Integer images, e.g. 8-bit and 16-bit, are binned with one bin per grey value, so the histogram holds
+    exactly the same information as the voxels for fitting. Floating point images, and integer images spanning
+    more than MAX_INTEGER_BINS grey values, are binned into n_bins equal width bins between min_GV and max_GV.
+
+    Parameters
+    ----------
+    bin_edges : numpy array
+        1-D array of bin edges, size = n_bins + 1
+    counts : numpy array, optional
+        1-D array of voxel counts per bin, size = n_bins, or one row of counts per histogram sharing these bins,
+        shape (n_histograms, n_bins). Defaults to zeros.
+    integer : bool, default False
+        True if bins are one grey value wide and centred on integer grey values
+    """
+
+    def __init__(self, bin_edges, counts = None, integer = False):
+        self.bin_edges = np.asarray(bin_edges, dtype = np.float64)
+        if counts is None:
+            counts = np.zeros(len(self.bin_edges) - 1, dtype = np.int64)
+        self.counts = np.asarray(counts, dtype = np.int64)
+        self.integer = integer
+
+    @classmethod
+    def for_dtype(cls, dtype, min_GV = None, max_GV = None, n_bins = 256):
+        """ Creates an empty histogram with bins suited to images of dtype
+
+        Parameters
+        ----------
+        dtype : numpy dtype
+            dtype of the image to be histogrammed
+        min_GV : float, optional
+            Lowest grey value to bin, defaults to the minimum of integer dtypes
+        max_GV : float, optional
+            Highest grey value to bin, defaults to the maximum of integer dtypes
+        n_bins : int, default 256
+            Number of bins, only used for floating point dtypes and integer ranges wider than MAX_INTEGER_BINS
+
+        Returns
+        -------
+        Histogram
+            Empty histogram
+        """
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.integer):
+            if dtype.itemsize > 2 and (min_GV is None or max_GV is None):
+                raise ValueError("min_GV and max_GV must be given to histogram {} images".format(dtype))
+            min_GV = np.iinfo(dtype).min if min_GV is None else int(np.floor(min_GV))
+            max_GV = np.iinfo(dtype).max if max_GV is None else int(np.ceil(max_GV))
+            if max_GV - min_GV + 1 <= MAX_INTEGER_BINS:
+                return cls(np.arange(min_GV, max_GV + 2) - 0.5, integer = True)
+            return cls(np.linspace(min_GV - 0.5, max_GV + 0.5, n_bins + 1))
+        if min_GV is None or max_GV is None:
+            raise ValueError("min_GV and max_GV must be given to histogram {} images".format(dtype))
+        return cls(np.linspace(min_GV, max_GV, n_bins + 1))
+
+    @property
+    def bin_centres(self):
+        """ numpy array : 1-D array of bin centres """
+        return 0.5 * (self.bin_edges[:-1] + self.bin_edges[1:])
+
+    @property
+    def bin_width(self):
+        """ float : width of each bin """
+        return self.bin_edges[1] - self.bin_edges[0]
+
+    @property
+    def n_voxels(self):
+        """ int : total number of voxels in histogram """
+        return int(self.counts.sum())
+
+    def add(self, img):
+        """ Adds grey values of img to the histogram in place
+
+        Grey values outside the range of the bins are ignored. Voxels are binned ADD_CHUNK_SIZE at a time in their
+        own dtype, so temporary arrays stay small however large img is.
+
+        Parameters
+        ----------
+        img : numpy array
+            Image or slice of any shape
+        """
+        img_1d = np.ravel(img)
+        if self.integer == True and np.issubdtype(img_1d.dtype, np.integer):
+            lowest = int(self.bin_edges[0] + 0.5)
+            for i in range(0, len(img_1d), ADD_CHUNK_SIZE):
+                chunk = img_1d[i:i + ADD_CHUNK_SIZE]
+                if lowest != 0 or chunk.dtype.kind == "i":
+                    chunk = chunk.astype(np.int64) - lowest
+                    chunk = chunk[(chunk >= 0) & (chunk < len(self.counts))]
+                counts = np.bincount(chunk, minlength = len(self.counts))
+                self.counts += counts[:len(self.counts)]
+        else:
+            self.counts += np.histogram(img_1d, bins = self.bin_edges)[0]
+
+    def threshold(self, min_GV, max_GV):
+        """ Keeps only bins with grey values inside (min_GV, max_GV), matching QM_load with specify_gv == True
+
+        Parameters
+        ----------
+        min_GV : float
+            Minimum grey value to consider, None places no lower limit
+        max_GV : float
+            Maximum grey value to consider, None places no upper limit
+
+        Returns
+        -------
+        Histogram
+            New histogram restricted to bins centred inside (min_GV, max_GV)
+        """
+        min_GV = -np.inf if min_GV is None else min_GV
+        max_GV = np.inf if max_GV is None else max_GV
+        centres = self.bin_centres
+        keep = np.flatnonzero((centres > min_GV) & (centres < max_GV))
+        if len(keep) == 0:
+            raise ValueError("No bins between min_GV = {} and max_GV = {}".format(min_GV, max_GV))
+        return Histogram(self.bin_edges[keep[0]:keep[-1] + 2], self.counts[..., keep[0]:keep[-1] + 1], self.integer)
+
+    def trim(self):
+        """ Removes empty bins at either end of the histogram
+
+        Returns
+        -------
+        Histogram
+            New histogram spanning only the occupied grey value range
+        """
+        occupied = np.flatnonzero(self.counts.reshape([-1, len(self.bin_edges) - 1]).sum(axis = 0))
+        if len(occupied) == 0:
+            return self
+        return Histogram(self.bin_edges[occupied[0]:occupied[-1] + 2], self.counts[..., occupied[0]:occupied[-1] + 1], self.integer)
+
+    def rebin(self, n_bins):
+        """ Merges neighbouring bins so that the histogram has at most n_bins bins, e.g. for plotting
+
+        Parameters
+        ----------
+        n_bins : int
+            Maximum number of bins
+
+        Returns
+        -------
+        Histogram
+            New histogram with merged bins, or self if already at most n_bins bins
+        """
+        n_bins_old = self.counts.shape[-1]
+        factor = int(np.ceil(n_bins_old / max(int(n_bins), 1)))
+        if factor <= 1:
+            return self
+        n_merged = int(np.ceil(n_bins_old / factor))
+        counts = np.zeros(self.counts.shape[:-1] + (n_merged * factor, ), dtype = np.int64)
+        counts[..., :n_bins_old] = self.counts
+        bin_edges = self.bin_edges[0] + self.bin_width * factor * np.arange(n_merged + 1)
+        return Histogram(bin_edges, counts.reshape(self.counts.shape[:-1] + (n_merged, factor)).sum(axis = -1))
+
+    def density(self):
+        """ Normalises counts so that the histogram integrates to 1
+
+        Returns
+        -------
+        numpy array
+            1-D array of probability density per bin
+        """
+        return self.counts / (self.n_voxels * np.diff(self.bin_edges))
+
+    def save(self, fname):
+        """ Saves bin edges and counts to a compressed .npz file, read back by Histogram.load
+
+        Parameters
+        ----------
+        fname : str
+            Filepath of .npz file
+        """
+        np.savez_compressed(fname, bin_edges = self.bin_edges, counts = self.counts, integer = self.integer)
+
+    @classmethod
+    def load(cls, fname):
+        """ Reads a histogram saved by Histogram.save
+
+        Parameters
+        ----------
+        fname : str
+            Filepath of .npz file
+
+        Returns
+        -------
+        Histogram
+        """
+        with np.load(fname) as saved:
+            return cls(saved["bin_edges"], saved["counts"], bool(saved["integer"]))
+
+def histogram_from_image(img, n_bins = 256):
+    """ Bins an image already loaded in memory, e.g. output from QM_load
+
+    Parameters
+    ----------
+    img : numpy array
+        Image of any shape
+    n_bins : int, default 256
+        Number of bins, only used for floating point images
+
+    Returns
+    -------
+    Histogram
+        Grey value histogram spanning the grey value range of img
+    """
+    histo = Histogram.for_dtype(img.dtype, np.min(img), np.max(img), n_bins)
+    histo.add(img)
+    return histo
+
+def save_histogram(img_fname, histo):
+    """ Saves the grey value histogram of an image to histogram.npz in its results directory
+
+    The histogram is all that is needed to refit or replot the image, e.g. with GMM_fit.plot_GMM_fit, without
+    reading the image again.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image, used to find the results directory
+    histo : Histogram
+        Grey value histogram of the image, e.g. output from QM_load_histogram or histogram_from_image
+    """
+    results_dir = QM_load.get_results_dir(img_fname)
+    if os.path.isdir(results_dir) == False:
+        os.mkdir(results_dir)
+    histo.save(os.path.join(results_dir, HISTOGRAM_FNAME))
+
+def load_saved_histogram(img_fname):
+    """ Reads the grey value histogram saved by save_histogram for an image
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image, used to find the results directory
+
+    Returns
+    -------
+    Histogram
+    """
+    return Histogram.load(os.path.join(QM_load.get_results_dir(img_fname), HISTOGRAM_FNAME))
+
+def histogram_matrix(histos):
+    """ Stacks histograms on common bins into one matrix, e.g. for GMM_em.fit_histograms_batched
+
+    Integer histograms are aligned on the union of their grey value ranges. Other histograms must share bin edges.
+
+    Parameters
+    ----------
+    histos : list of Histogram
+        Histograms to stack
+
+    Returns
+    -------
+    Histogram
+        Histogram spanning the common bins, with counts of shape (n_histograms, n_bins)
+    """
+    if all(histo.integer == True for histo in histos):
+        lowest = min(int(histo.bin_edges[0] + 0.5) for histo in histos)
+        highest = max(int(histo.bin_edges[-1] - 0.5) for histo in histos)
+        counts = np.zeros([len(histos), highest - lowest + 1], dtype = np.int64)
+        for row, histo in zip(counts, histos):
+            offset = int(histo.bin_edges[0] + 0.5) - lowest
+            row[offset:offset + len(histo.counts)] = histo.counts
+        return Histogram(np.arange(lowest, highest + 2) - 0.5, counts, integer = True)
+    if any(not np.array_equal(histo.bin_edges, histos[0].bin_edges) for histo in histos):
+        raise ValueError("Histograms of floating point images must have the same bin edges to be stacked")
+    return Histogram(histos[0].bin_edges, np.array([histo.counts for histo in histos]))
+
+def QM_load_histogram(img_fname, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 100., use_memmap = False, n_bins = 256, n_workers = None, raw_header = None, roi = None):
+    """ Streams slices of a 3D image stack into a grey value histogram, so memory use is independent of stack size
+
+    8-bit and 16-bit images are binned with one bin per grey value. For other dtypes, e.g. float32, the bins span
+    min_GV to max_GV, and any limit not given is found by an extra pass over the slices with QM_load.gv_range.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    min_GV : float, optional
+        Minimum grey value to consider. Also the lowest bin edge of floating point images. None detects it.
+    max_GV : float, optional
+        Maximum grey value to consider. Also the highest bin edge of floating point images. None detects it.
+    specify_gv : bool
+        If True, discard grey values outside [min_GV, max_GV]
+    pct_stack_import : float, default 100.
+        Percentage of stack to import. Used to calculate number of slices to import, evenly spaced throughout stack
+    use_memmap : bool, default False
+        If True, read slices of an uncompressed TIFF directly from disk through numpy.memmap instead of decoding with PIL
+    n_bins : int, default 256
+        Number of bins, only used for floating point images
+    n_workers : int, optional
+        Number of threads reading files of an image sequence concurrently, defaults to the number of CPUs
+    raw_header : dict, optional
+        Raw volume description, see QM_load.raw_volume_memmap. Only used for raw volumes.
+    roi : tuple, optional
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max) to crop the stack to, see QM_load.roi_slices
+
+    Returns
+    -------
+    Histogram
+        Grey value histogram of the imported slices
+    """
+    start = time.time()
+
+    slice_indices = QM_load.roi_slice_indices(QM_load.get_n_slices(img_fname, raw_header), pct_stack_import, roi)
+    crop = QM_load.roi_slices(roi)[1:]
+
+    dtype = QM_load.read_slice(img_fname, slice_indices[0], use_memmap, raw_header, crop).dtype
+    if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+        histo = Histogram.for_dtype(dtype)
+    else:
+        if min_GV is None or max_GV is None: # bin range must be known before binning
+            detected_min_GV, detected_max_GV = QM_load.gv_range(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop)
+            min_GV = detected_min_GV if min_GV is None else min_GV
+            max_GV = detected_max_GV if max_GV is None else max_GV
+        histo = Histogram.for_dtype(dtype, min_GV, max_GV, n_bins)
+
+    for img_slice in QM_load.iter_slices(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop):
+        histo.add(img_slice)
+
+    if specify_gv == True:
+        histo = histo.threshold(min_GV, max_GV)
+    histo = histo.trim()
+
+    end = time.time()
+
+    print("Image histogram accumulated from {0} slices, time elapsed = {1:.2f} s".format(len(slice_indices), (end-start)))
+
+    return histo
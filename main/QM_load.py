@@ -1,57 +1,770 @@
+import os
+import re
+import glob
 import time
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 import sys
 
 import matplotlib.pyplot as plt
 
-def QM_load(img_fname, min_GV = 0, max_GV = 255, specify_gv = False, pct_stack_import = 10.):
-    """Loads n slices of a 3D image stack specified by % of stack to import, limits to min and max GV if specify_gv == True
+# TIFF tags needed to locate uncompressed pixel data
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PREDICTOR = 317
+TIFF_SAMPLE_FORMAT = 339
+
+# File extensions read as slices of an image sequence
+IMAGE_SEQUENCE_EXTENSIONS = (".tif", ".tiff", ".png", ".bmp", ".jpg", ".jpeg")
+
+# File extensions read as raw binary volumes, and sidecar header extensions searched for next to them
+RAW_EXTENSIONS = (".raw", ".vol")
+RAW_HEADER_EXTENSIONS = (".txt", ".hdr", ".mhd")
+
+# MetaImage (.mhd) element types
+META_ELEMENT_TYPES = {"MET_UCHAR": "uint8", "MET_CHAR": "int8", "MET_USHORT": "uint16", "MET_SHORT": "int16",
+    "MET_UINT": "uint32", "MET_INT": "int32", "MET_FLOAT": "float32", "MET_DOUBLE": "float64"}
+
+def is_image_sequence(img_fname):
+    """ Checks if img_fname refers to an image sequence (a directory or glob pattern of per-slice files)
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices or glob pattern matching slices, e.g. "scan/slice_*.tif"
+
+    Returns
+    -------
+    bool
+        True if img_fname is a directory or glob pattern
+    """
+    return os.path.isdir(img_fname) or glob.has_magic(img_fname)
+
+def list_image_sequence(img_fname):
+    """ Lists the per-slice files of an image sequence in natural order, so slice_2 comes before slice_10
+
+    Parameters
+    ----------
+    img_fname : str
+        Directory of slices or glob pattern matching slices
+
+    Returns
+    -------
+    list
+        List of slice filepaths as str
+    """
+    if os.path.isdir(img_fname):
+        fnames = [os.path.join(img_fname, f) for f in os.listdir(img_fname)
+            if os.path.splitext(f)[1].lower() in IMAGE_SEQUENCE_EXTENSIONS and os.path.isfile(os.path.join(img_fname, f))]
+    else:
+        fnames = glob.glob(img_fname)
+    if len(fnames) == 0:
+        raise ValueError("No slices found in {}".format(img_fname))
+    natural_key = lambda f: [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", f)]
+    return sorted(fnames, key = natural_key)
+
+def is_raw_volume(img_fname):
+    """ Checks if img_fname is a raw binary volume (.raw or .vol)
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image
+
+    Returns
+    -------
+    bool
+        True if img_fname has a raw volume file extension
+    """
+    return os.path.splitext(img_fname)[1].lower() in RAW_EXTENSIONS
+
+def find_raw_header(img_fname):
+    """ Finds the sidecar header of a raw volume, e.g. scan.raw.txt, scan.txt, scan.hdr or scan.mhd
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of raw volume
+
+    Returns
+    -------
+    str
+        Filepath of header
+
+    Raises
+    ------
+    ValueError
+        If no header is found
+    """
+    base = os.path.splitext(img_fname)[0]
+    candidates = [img_fname + ".txt"] + [base + ext for ext in RAW_HEADER_EXTENSIONS]
+    for header_fname in candidates:
+        if os.path.isfile(header_fname):
+            return header_fname
+    raise ValueError("No header found for {}, expected one of {} or pass raw_header".format(img_fname, candidates))
+
+def read_raw_header(header_fname):
+    """ Reads dimensions, dtype, byte order and header offset of a raw volume from a text header
+
+    The header has one "key = value" per line, with keys dims (x y z), dtype (e.g. uint16), byte_order
+    (little or big) and header_offset (bytes before the voxel data). MetaImage .mhd headers (DimSize,
+    ElementType, ElementByteOrderMSB, HeaderSize) are also understood.
+
+    Parameters
+    ----------
+    header_fname : str
+        Filepath of header
+
+    Returns
+    -------
+    dict
+        Raw volume description with keys
+        - shape: (n_slices, height, width)
+        - dtype: voxel dtype as str
+        - byte_order: "little" or "big"
+        - header_offset: bytes before the voxel data, -1 if the voxel data ends the file
+    """
+    params = {}
+    with open(header_fname, "r") as f:
+        for line in f:
+            line = line.split("#")[0]
+            if "=" in line:
+                key, value = line.split("=", 1)
+                params[key.strip().lower()] = value.strip()
+
+    dims = [int(d) for d in params.get("dims", params.get("dimsize", "")).split()]
+    if len(dims) not in (2, 3):
+        raise ValueError("Header {} must give dims as width height [depth]".format(header_fname))
+    if "elementtype" in params:
+        dtype = META_ELEMENT_TYPES[params["elementtype"].upper()]
+    else:
+        dtype = params["dtype"]
+    big_endian = params.get("byte_order", "little").lower() == "big" or \
+        params.get("elementbyteordermsb", params.get("binarydatabyteordermsb", "false")).lower() == "true"
+
+    return {"shape": (dims[2] if len(dims) == 3 else 1, dims[1], dims[0]),
+        "dtype": dtype,
+        "byte_order": "big" if big_endian else "little",
+        "header_offset": int(params.get("header_offset", params.get("headersize", 0)))}
+
+def raw_volume_memmap(img_fname, raw_header = None):
+    """ Memory-maps a raw binary volume, so slices are read from disk only when accessed
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of raw volume
+    raw_header : dict, optional
+        Raw volume description with keys shape (n_slices, height, width), dtype, byte_order and
+        header_offset, as returned by read_raw_header. If None, read from the sidecar header.
+
+    Returns
+    -------
+    numpy.memmap
+        Read-only 3D array of shape (n_slices, height, width)
+    """
+    if raw_header is None:
+        raw_header = read_raw_header(find_raw_header(img_fname))
+    shape = tuple(int(d) for d in raw_header["shape"])
+    dtype = np.dtype(raw_header["dtype"]).newbyteorder(">" if raw_header.get("byte_order", "little") == "big" else "<")
+    header_offset = int(raw_header.get("header_offset", 0))
+    if header_offset < 0: # voxel data ends the file
+        header_offset = os.path.getsize(img_fname) - int(np.prod(shape)) * dtype.itemsize
+    return np.memmap(img_fname, dtype = dtype, mode = "r", offset = header_offset, shape = shape)
+
+def get_n_slices(img_fname, raw_header = None):
+    """ Number of slices in an image stack, image sequence or raw volume
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices, glob pattern matching slices or raw volume
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes.
+
+    Returns
+    -------
+    int
+        Number of slices
+    """
+    if is_raw_volume(img_fname):
+        return raw_volume_memmap(img_fname, raw_header).shape[0]
+    if is_image_sequence(img_fname):
+        return len(list_image_sequence(img_fname))
+    with Image.open(img_fname) as I:
+        return I.n_frames
+
+def get_results_dir(img_fname):
+    """ Results directory of an image, <image name>_results next to the image
+
+    For image sequences, the results directory is named after the directory holding the slices.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices or glob pattern matching slices
+
+    Returns
+    -------
+    str
+        Filepath of results directory
+    """
+    if glob.has_magic(img_fname):
+        img_fname = os.path.dirname(img_fname)
+    if os.path.isdir(img_fname):
+        return "{}_results".format(os.path.normpath(img_fname))
+    return "{}_results".format(os.path.splitext(img_fname)[0])
+
+def stack_slice_indices(n_frames, pct_stack_import):
+    """ Calculates indices of slices to import, evenly spaced through the stack
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of slices in the stack
+    pct_stack_import : float
+        Percentage of stack to import
+
+    Returns
+    -------
+    numpy array
+        1-D array of slice indices as ints
+    """
+    if n_frames == 1: # handles 1D case
+        return np.array([0])
+    n_slices = int(n_frames * (pct_stack_import/100)) # calculate number of slices to import
+    return np.array([int((i+1)*(n_frames/(n_slices + 1))) for i in range(n_slices)], dtype = int)
+
+def roi_slices(roi):
+    """ Converts a 3D bounding box into slices along each axis of the stack
+
+    Parameters
+    ----------
+    roi : tuple or None
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max) in voxels, with the same meaning as Python slices,
+        i.e. the max values are excluded and negative values count from the end. Any value can be None to use the
+        full extent along that axis. If roi is None, the whole stack is used.
+
+    Returns
+    -------
+    tuple
+        (z, y, x) slices
+
+    Raises
+    ------
+    ValueError
+        If roi does not have 6 values, or is empty along an axis whatever the size of the stack, e.g. y_min == y_max.
+        Bounds of different signs can only be checked against the slice size, see read_slice.
+    """
+    if roi is None:
+        return slice(None), slice(None), slice(None)
+    if len(roi) != 6:
+        raise ValueError("roi should be (z_min, z_max, y_min, y_max, x_min, x_max), got {}".format(roi))
+    z_min, z_max, y_min, y_max, x_min, x_max = [None if value is None else int(value) for value in roi]
+    for axis, low, high in [("z", z_min, z_max), ("y", y_min, y_max), ("x", x_min, x_max)]:
+        if low is not None and high is not None and (low < 0) == (high < 0) and low >= high:
+            raise ValueError("roi {} is empty along {}, {}_min must be less than {}_max".format(roi, axis, axis, axis))
+    return slice(z_min, z_max), slice(y_min, y_max), slice(x_min, x_max)
+
+def roi_slice_indices(n_frames, pct_stack_import, roi = None):
+    """ Calculates indices of slices to import, evenly spaced through the z range of a bounding box
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of slices in the stack
+    pct_stack_import : float
+        Percentage of slices inside the bounding box to import
+    roi : tuple, optional
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max), see roi_slices
+
+    Returns
+    -------
+    numpy array
+        1-D array of slice indices as ints, identical to stack_slice_indices if roi is None
+    """
+    z_indices = np.arange(n_frames)[roi_slices(roi)[0]]
+    if len(z_indices) == 0:
+        raise ValueError("roi {} does not contain any of the {} slices".format(roi, n_frames))
+    return z_indices[stack_slice_indices(len(z_indices), pct_stack_import)]
+
+def tiff_page_layout(img_fname, slice_indices):
+    """ Parses the TIFF directory once to find where the pixel data of each requested page is stored
+
+    Only uncompressed, single channel pages with contiguous strips can be described this way.
 
     Parameters
     ----------
     img_fname : str
-        Filepath of image to be loaded
+        Filepath of TIFF stack
+    slice_indices : array-like
+        Indices of pages to locate, e.g. output from stack_slice_indices
+
+    Returns
+    -------
+    list
+        List of (offset, shape, dtype) tuples, one per page in slice_indices
+
+    Raises
+    ------
+    ValueError
+        If img_fname is not a TIFF, or a requested page is tiled, compressed, has more than one sample per pixel
+        or non-contiguous strips
+    """
+    layout = []
+    with Image.open(img_fname) as I:
+        if I.format != "TIFF":
+            raise ValueError("{} is a {} image, only TIFF can be memory-mapped".format(img_fname, I.format))
+        with open(img_fname, "rb") as tiff_file:
+            byte_order = {b"II": "<", b"MM": ">"}[tiff_file.read(2)] # byte order mark at the start of every TIFF
+        for index in slice_indices:
+            I.seek(int(index)) # only reads the image file directory, pixels are not decoded
+            tags = I.tag_v2
+            if tags.get(TIFF_COMPRESSION, 1) != 1 or tags.get(TIFF_PREDICTOR, 1) != 1:
+                raise ValueError("Page {} of {} is compressed, cannot be memory-mapped".format(index, img_fname))
+            if tags.get(TIFF_SAMPLES_PER_PIXEL, 1) != 1:
+                raise ValueError("Page {} of {} has more than one sample per pixel, cannot be memory-mapped".format(index, img_fname))
+            if TIFF_STRIP_OFFSETS not in tags or TIFF_STRIP_BYTE_COUNTS not in tags:
+                raise ValueError("Page {} of {} is tiled, cannot be memory-mapped".format(index, img_fname))
+            offsets = np.atleast_1d(tags[TIFF_STRIP_OFFSETS])
+            byte_counts = np.atleast_1d(tags[TIFF_STRIP_BYTE_COUNTS])
+            if np.any(offsets[1:] != offsets[:-1] + byte_counts[:-1]):
+                raise ValueError("Page {} of {} has non-contiguous strips, cannot be memory-mapped".format(index, img_fname))
+
+            bits = np.atleast_1d(tags.get(TIFF_BITS_PER_SAMPLE, 8))[0]
+            sample_format = np.atleast_1d(tags.get(TIFF_SAMPLE_FORMAT, 1))[0]
+            kind = {1: "u", 2: "i", 3: "f"}[sample_format]
+            if bits not in (8, 16, 32, 64) or (kind == "f" and bits < 32):
+                raise ValueError("Page {} of {} has unsupported bit depth {}".format(index, img_fname, bits))
+            dtype = np.dtype("{}{}{}".format(byte_order, kind, bits // 8))
+            layout.append((int(offsets[0]), (I.size[1], I.size[0]), dtype))
+
+    return layout
+
+def QM_load_memmap(img_fname, slice_indices, raw_header = None, crop = None):
+    """ Exposes pages of an uncompressed TIFF stack as read-only memory-mapped arrays without decoding or copying
+
+    The file is mapped once and every page is a view into that one map, so a single file descriptor is held
+    however many pages are requested. If crop is given, only the disk pages holding rows inside the crop are read
+    when the arrays are accessed.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of TIFF stack, directory or glob pattern of single page TIFF slices, or raw volume
+    slice_indices : array-like
+        Indices of pages to map, e.g. output from stack_slice_indices
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes.
+    crop : tuple, optional
+        (y, x) slices to crop each page to, e.g. roi_slices(roi)[1:]. Defaults to the whole page.
+
+    Returns
+    -------
+    list
+        List of 2D numpy.memmap arrays, one per page in slice_indices. Each file of an image sequence is mapped
+        separately, use iter_slices to map them one at a time.
+    """
+    crop = (slice(None), slice(None)) if crop is None else tuple(crop)
+    if is_raw_volume(img_fname):
+        volume = raw_volume_memmap(img_fname, raw_header)
+        return [volume[int(index)][crop] for index in slice_indices] # views, nothing is read until accessed
+    if is_image_sequence(img_fname):
+        fnames = list_image_sequence(img_fname)
+        return [QM_load_memmap(fnames[index], [0], crop = crop)[0] for index in slice_indices]
+    layout = tiff_page_layout(img_fname, slice_indices)
+    file_map = np.memmap(img_fname, dtype = np.uint8, mode = "r") # one map, and file descriptor, for all pages
+    return [file_map[offset:offset + dtype.itemsize * shape[0] * shape[1]].view(dtype).reshape(shape)[crop]
+        for offset, shape, dtype in layout]
+
+def read_cropped_pages(img_fname, slice_indices, crop):
+    """ Reads cropped pages of an uncompressed TIFF through numpy.memmap, so only the rows inside crop are read
+
+    Decoding with PIL reads and decodes every pixel of a page before it can be cropped.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of TIFF stack or of a single slice
+    slice_indices : array-like
+        Indices of pages to read
+    crop : tuple
+        (y, x) slices to crop each page to
+
+    Returns
+    -------
+    list or None
+        List of cropped 2D numpy.memmap views, one per page in slice_indices, nothing is read until they are
+        accessed. None if crop is the whole page or the pages cannot be memory-mapped, e.g. compressed or not
+        TIFF, and must be decoded instead.
+    """
+    if tuple(crop) == (slice(None), slice(None)): # nothing to gain over decoding
+        return None
+    try:
+        return QM_load_memmap(img_fname, slice_indices, crop = crop)
+    except ValueError: # see tiff_page_layout
+        return None
+
+def read_slices(img_fname, slice_indices, n_workers = None, raw_header = None, crop = None):
+    """ Decodes slices of a 3D image stack concurrently into one preallocated array
+
+    Each worker thread opens its own file handle and decodes a contiguous block of the requested slices,
+    so compressed stacks are decoded on several cores at once. For image sequences, only the files of
+    the requested slices are opened.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices or glob pattern matching slices
+    slice_indices : array-like
+        Indices of slices to read, e.g. output from stack_slice_indices
+    n_workers : int, optional
+        Number of worker threads, defaults to the number of CPUs
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes.
+    crop : tuple, optional
+        (y, x) slices to crop each slice to, e.g. roi_slices(roi)[1:]. Defaults to the whole slice.
+        Only the rows inside crop are read from uncompressed TIFF slices, see read_cropped_pages. Compressed
+        slices are decoded in full and then cropped, so only memory use is reduced.
+
+    Returns
+    -------
+    numpy array
+        3D numpy array of shape (len(slice_indices), height, width), or the cropped height and width
+    """
+    slice_indices = np.asarray(slice_indices, dtype = int)
+    if len(slice_indices) == 0:
+        raise ValueError("pct_stack_import is too small to import any slices of {}".format(img_fname))
+    crop = (slice(None), slice(None)) if crop is None else tuple(crop)
+
+    if is_raw_volume(img_fname): # no decoding needed
+        volume = raw_volume_memmap(img_fname, raw_header)
+        return np.ascontiguousarray(volume[(slice_indices,) + crop], dtype = volume.dtype.newbyteorder("="))
+
+    if is_image_sequence(img_fname):
+        fnames = list_image_sequence(img_fname)
+        def read_block(positions):
+            for i in positions:
+                pages = read_cropped_pages(fnames[slice_indices[i]], [0], crop)
+                if pages is not None:
+                    img_nparray[i] = pages[0]
+                    continue
+                with Image.open(fnames[slice_indices[i]]) as I:
+                    img_nparray[i] = np.asarray(I)[crop]
+    else:
+        pages = read_cropped_pages(img_fname, slice_indices, crop)
+        if pages is not None: # single copy of the rows inside crop, no decoding
+            if pages[0].size == 0:
+                raise ValueError("Crop {} of slice {} of {} is empty".format(crop, slice_indices[0], img_fname))
+            img_nparray = np.empty((len(pages),) + pages[0].shape, dtype = pages[0].dtype.newbyteorder("="))
+            for i, page in enumerate(pages):
+                img_nparray[i] = page
+            return img_nparray
+        def read_block(positions):
+            with Image.open(img_fname) as I: # one file handle per worker
+                for i in positions:
+                    I.seek(int(slice_indices[i]))
+                    img_nparray[i] = np.asarray(I)[crop]
+
+    first_slice = read_slice(img_fname, slice_indices[0], crop = crop)
+    img_nparray = np.empty((len(slice_indices),) + first_slice.shape, dtype = first_slice.dtype)
+    img_nparray[0] = first_slice
+
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(slice_indices) - 1))
+    blocks = np.array_split(np.arange(1, len(slice_indices)), n_workers)
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        list(executor.map(read_block, blocks)) # list() re-raises any exception from the workers
+
+    return img_nparray
+
+def iter_slices(img_fname, slice_indices, use_memmap = False, n_workers = None, raw_header = None, crop = None):
+    """ Reads slices of a 3D image stack one at a time, so only a few slices are held in memory
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices or glob pattern matching slices
+    slice_indices : array-like
+        Indices of slices to read, e.g. output from stack_slice_indices
+    use_memmap : bool, default False
+        If True, read slices of an uncompressed TIFF through numpy.memmap instead of decoding with PIL
+    n_workers : int, optional
+        Number of threads reading files of an image sequence concurrently, defaults to the number of CPUs.
+        At most n_workers slices are held in memory at once.
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes, which are always memory-mapped.
+    crop : tuple, optional
+        (y, x) slices to crop each slice to, e.g. roi_slices(roi)[1:]. Defaults to the whole slice. Without
+        use_memmap, uncompressed TIFF slices are still memory-mapped if cropped, see read_cropped_pages.
+
+    Yields
+    ------
+    numpy array
+        2D numpy array of each slice in slice_indices
+    """
+    crop = (slice(None), slice(None)) if crop is None else tuple(crop)
+    if use_memmap == True and is_image_sequence(img_fname):
+        fnames = list_image_sequence(img_fname)
+        for index in slice_indices: # one file mapped at a time
+            yield QM_load_memmap(fnames[index], [0], crop = crop)[0]
+    elif use_memmap == True or is_raw_volume(img_fname):
+        for img_slice in QM_load_memmap(img_fname, slice_indices, raw_header, crop):
+            yield img_slice
+    elif is_image_sequence(img_fname):
+        fnames = list_image_sequence(img_fname)
+        def read_file(index):
+            pages = read_cropped_pages(fnames[index], [0], crop)
+            if pages is not None:
+                return np.ascontiguousarray(pages[0], dtype = pages[0].dtype.newbyteorder("="))
+            with Image.open(fnames[index]) as I:
+                return np.asarray(I)[crop]
+        n_workers = max(1, n_workers or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers = n_workers) as executor:
+            for batch_start in range(0, len(slice_indices), n_workers): # bounded number of slices in flight
+                for img_slice in executor.map(read_file, slice_indices[batch_start:batch_start + n_workers]):
+                    yield img_slice
+    else:
+        pages = read_cropped_pages(img_fname, slice_indices, crop)
+        if pages is not None:
+            for img_slice in pages:
+                yield np.ascontiguousarray(img_slice, dtype = img_slice.dtype.newbyteorder("=")) # read one page at a time
+            return
+        with Image.open(img_fname) as I:
+            for index in slice_indices:
+                I.seek(int(index))
+                yield np.asarray(I)[crop]
+
+def read_slice(img_fname, index, use_memmap = False, raw_header = None, crop = None):
+    """ Reads a single slice of a 3D image stack, closing the image file before returning
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of slices or glob pattern matching slices
+    index : int
+        Index of slice to read
+    use_memmap, raw_header, crop
+        See iter_slices
+
+    Returns
+    -------
+    numpy array
+        2D numpy array of the slice
+
+    Raises
+    ------
+    ValueError
+        If crop leaves no pixels of the slice, e.g. roi (None, None, 10, -500, None, None) of a 500 pixel high slice
+    """
+    with closing(iter_slices(img_fname, [index], use_memmap, 1, raw_header, crop)) as slice_iter: # an abandoned generator would keep the file open
+        img_slice = next(slice_iter)
+    if img_slice.size == 0:
+        raise ValueError("Crop {} of slice {} of {} is empty".format(crop, index, img_fname))
+    return img_slice
+
+def apply_gv_window(img_chunks, min_GV, max_GV, out):
+    """ Copies grey values inside (min_GV, max_GV) from each chunk to the start of out, keeping their dtype
+
+    Only chunk-sized masks are allocated. The chunks may be views of out itself, in which case the image is
+    filtered in place, since kept voxels are never written past the end of the chunk being read.
+
+    Parameters
+    ----------
+    img_chunks : iterable of numpy arrays
+        Chunks of the image in order, e.g. slices
     min_GV : float
-        Minimum grey value to consider, ignored if specify_gv == False
+        Minimum grey value to keep
     max_GV : float
-        Maximum grey value to consider, ignored if specify_gv == False
+        Maximum grey value to keep
+    out : numpy array
+        1-D array at least as long as the total number of voxels in img_chunks
+
+    Returns
+    -------
+    numpy array
+        View of the start of out holding the kept grey values
+    """
+    n_kept = 0
+    for chunk in img_chunks:
+        kept = chunk[(chunk > min_GV) & (chunk < max_GV)]
+        out[n_kept:n_kept + len(kept)] = kept
+        n_kept += len(kept)
+    return out[:n_kept]
+
+def gv_range(img_fname, slice_indices, use_memmap = False, n_workers = None, raw_header = None, crop = None):
+    """ Finds the lowest and highest grey values in slices of a 3D image stack, reading one slice at a time
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    slice_indices : array-like
+        Indices of slices to read, e.g. output from roi_slice_indices
+    use_memmap : bool, default False
+        If True, read slices of an uncompressed TIFF through numpy.memmap instead of decoding with PIL
+    n_workers : int, optional
+        Number of threads reading files of an image sequence concurrently, defaults to the number of CPUs
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes.
+    crop : tuple, optional
+        (y, x) slices to crop each slice to, e.g. roi_slices(roi)[1:]
+
+    Returns
+    -------
+    min_GV, max_GV
+        Lowest and highest finite grey values, as Python scalars
+    """
+    min_GV = np.inf
+    max_GV = -np.inf
+    for img_slice in iter_slices(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop):
+        if img_slice.dtype.kind == "f":
+            img_slice = img_slice[np.isfinite(img_slice)]
+            if img_slice.size == 0:
+                continue
+        min_GV = min(min_GV, img_slice.min().item())
+        max_GV = max(max_GV, img_slice.max().item())
+    if min_GV > max_GV:
+        raise ValueError("No finite grey values found in {}".format(img_fname))
+    return min_GV, max_GV
+
+def sample_voxels(img_fname, n_samples, random_state = 3, n_workers = None, raw_header = None, roi = None):
+    """ Draws a fixed number of voxels by stratified random sampling across the whole stack
+
+    The sample budget is split evenly between all slices, and within each slice one voxel is drawn at random
+    from each of n equal runs of pixels, so every region of the specimen is represented. Uncompressed stacks,
+    image sequences and raw volumes are memory-mapped, so only the sampled voxels are read from disk.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    n_samples : int
+        Number of voxels to draw
+    random_state : int, default 3
+        Seed for the random number generator, fixed for predictability
+    n_workers : int, optional
+        Number of threads decoding slices of compressed images concurrently, defaults to the number of CPUs
+    raw_header : dict, optional
+        Raw volume description, see raw_volume_memmap. Only used for raw volumes.
+    roi : tuple, optional
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max) to sample from, see roi_slices
+
+    Returns
+    -------
+    numpy array
+        1-D array of n_samples voxels, with the dtype of the image
+    """
+    n_samples = int(n_samples)
+    rng = np.random.RandomState(random_state)
+    z_indices = roi_slice_indices(get_n_slices(img_fname, raw_header), 100., roi) # every slice inside roi
+    crop = roi_slices(roi)[1:]
+    samples_per_slice = np.diff(np.floor(np.linspace(0, n_samples, len(z_indices) + 1)).astype(int))
+    slice_indices = z_indices[samples_per_slice > 0]
+    samples_per_slice = samples_per_slice[samples_per_slice > 0]
+
+    try:
+        QM_load_memmap(img_fname, slice_indices[:1], raw_header)
+        use_memmap = True
+    except ValueError: # compressed, slices must be decoded
+        use_memmap = False
+
+    img_sampled = None
+    n_sampled = 0
+    for m, img_slice in zip(samples_per_slice, iter_slices(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop)):
+        if img_slice.size == 0:
+            raise ValueError("roi {} does not contain any pixels of the slices of {}".format(roi, img_fname))
+        if img_sampled is None:
+            img_sampled = np.empty(n_samples, dtype = img_slice.dtype.newbyteorder("="))
+        n_pixels = img_slice.size
+        positions = ((np.arange(m) + rng.uniform(size = m)) * (n_pixels / m)).astype(np.int64) # one voxel per stratum
+        rows, cols = np.divmod(np.minimum(positions, n_pixels - 1), img_slice.shape[1]) # cropped slices are not contiguous
+        img_sampled[n_sampled:n_sampled + m] = img_slice[rows, cols]
+        n_sampled += m
+
+    return img_sampled
+
+def QM_load(img_fname, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 10., use_memmap = False, n_workers = None, raw_header = None, n_samples = None, random_state = 3, roi = None):
+    """Loads n slices of a 3D image stack specified by % of stack to import, limits to min and max GV if specify_gv == True
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume (.raw, .vol)
+    min_GV : float, optional
+        Minimum grey value to consider, ignored if specify_gv == False. None places no lower limit.
+    max_GV : float, optional
+        Maximum grey value to consider, ignored if specify_gv == False. None places no upper limit.
     specify_gv : bool
         If True, discard grey values outside [min_GV, max_GV]
     pct_stack_import : float, default 10.
         Percentage of stack to import. Used to calculate number of slices to import, evenly spaced throughout stack
-    
+    use_memmap : bool, default False
+        If True, read slices of an uncompressed TIFF directly from disk through numpy.memmap instead of decoding with PIL
+    n_workers : int, optional
+        Number of threads decoding slices concurrently, defaults to the number of CPUs. Ignored if use_memmap == True
+    raw_header : dict, optional
+        Description of a raw volume with keys shape (n_slices, height, width), dtype, byte_order ("little" or "big")
+        and header_offset. If None, read from a sidecar header next to the raw volume, see find_raw_header.
+        Raw volumes are always memory-mapped.
+    n_samples : int, optional
+        If given, pct_stack_import is ignored and a fixed number of voxels is drawn by stratified random sampling
+        across the whole stack, see sample_voxels. Grey value limits are applied after sampling.
+    random_state : int, default 3
+        Seed for voxel sampling, ignored if n_samples is None
+    roi : tuple, optional
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max) in voxels to crop the stack to while reading,
+        see roi_slices. pct_stack_import is then a percentage of the slices inside the bounding box.
+        Defaults to None, which imports whole slices.
+
     Returns
     -------
     img
-        Flattened 1D numpy array with only n slices imported based on pct_stack_import
+        Flattened 1D numpy array with only n slices imported based on pct_stack_import, with the dtype of the image,
+        e.g. uint16 or float32 images are not promoted to float64
     """
     start = time.time()
+    img_to_return = None
+    if specify_gv == True: # limits left as None do not exclude any grey values
+        min_GV = -np.inf if min_GV is None else min_GV
+        max_GV = np.inf if max_GV is None else max_GV
+
+    if n_samples is not None:
+        img_nparray = sample_voxels(img_fname, n_samples, random_state, n_workers, raw_header, roi)
+
+    elif use_memmap == True or is_raw_volume(img_fname):
+        n_frames = get_n_slices(img_fname, raw_header)
+        slice_indices = roi_slice_indices(n_frames, pct_stack_import, roi)
+        if len(slice_indices) == 0:
+            raise ValueError("pct_stack_import is too small to import any slices of {}".format(img_fname))
+        slices = iter_slices(img_fname, slice_indices, True, raw_header = raw_header, crop = roi_slices(roi)[1:])
+        first_slice = read_slice(img_fname, slice_indices[0], True, raw_header, roi_slices(roi)[1:])
+        img_nparray = np.empty((len(slice_indices),) + first_slice.shape, dtype = first_slice.dtype.newbyteorder("="))
+        if specify_gv == True: # filter while copying from the page cache, rejected voxels are never copied
+            img_to_return = apply_gv_window(slices, min_GV, max_GV, img_nparray.reshape(-1))
+        else:
+            for i, img_slice in enumerate(slices):
+                img_nparray[i] = img_slice # single copy from page cache into output array
+
+    else:
+        n_frames = get_n_slices(img_fname, raw_header)
+        img_nparray = read_slices(img_fname, roi_slice_indices(n_frames, pct_stack_import, roi), n_workers, crop = roi_slices(roi)[1:]) # evenly spaced slices through stack
+
+    if img_to_return is None:
+        img_1d = img_nparray.reshape(-1) # no copy, img_nparray is contiguous
+        if specify_gv == True:
+            chunk_size = img_nparray[0].size if img_nparray.ndim > 1 else 2**20 # one slice at a time
+            img_chunks = (img_1d[i:i + chunk_size] for i in range(0, len(img_1d), chunk_size))
+            img_to_return = apply_gv_window(img_chunks, min_GV, max_GV, img_1d) # filter in place
+        elif specify_gv == False:
+            img_to_return = img_1d
 
-    I = Image.open(img_fname)
-    n_slices = int(I.n_frames * (pct_stack_import/100)) # calculate number of slices to import
-    img_list = []
-
-    if I.n_frames > 1:
-        for i in np.arange(0, n_slices):
-            I.seek(int((i+1)*(I.n_frames/(n_slices + 1)))) # evenly spaced slices through stack
-            img = np.array(I)
-            img_list.append(img)
-            img_nparray = np.asarray(img_list)
-    if I.n_frames == 1: # handles 1D case
-        I.seek(0)
-        img_nparray = np.asarray(I)
-    
-    if specify_gv == True:
-        img_flatten = img_nparray.flatten()
-        img_thresholded = img_flatten[(img_flatten > min_GV) & (img_flatten < max_GV)]
-        img_to_return = img_thresholded
-    
-    elif specify_gv == False:
-        img_to_return = img_nparray.flatten()
-    
     end = time.time()
-    
+
     print("Image imported, time elapsed = {0:.2f} s".format((end-start)))
-    
+
     return img_to_return
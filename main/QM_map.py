@@ -0,0 +1,220 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import QM_load
+import QM_histogram
+import GMM_em
+import GMM_fit
+import QM_calc
+
+BATCH_SIZE = 1024 # blocks fitted together in one call to GMM_em.fit_histograms_batched
+
+def block_grid(shape, block_shape):
+    """ Tiles a volume into blocks, the last block along each axis holding any remainder
+
+    Parameters
+    ----------
+    shape : tuple
+        (z, y, x) dimensions of the volume
+    block_shape : tuple
+        (z, y, x) dimensions of each block in voxels. None along an axis uses the whole extent, e.g.
+        (50, None, None) tiles the volume into slabs of 50 slices.
+
+    Returns
+    -------
+    block_shape
+        Tuple of block dimensions with None replaced by the extent of the volume
+    n_blocks
+        Tuple of the number of blocks along each axis
+    """
+    block_shape = tuple(int(extent) if size is None else min(int(size), int(extent)) for size, extent in zip(block_shape, shape))
+    if min(block_shape) < 1:
+        raise ValueError("Block dimensions must be at least 1 voxel, got {}".format(block_shape))
+    n_blocks = tuple(-(-int(extent) // size) for size, extent in zip(block_shape, shape))
+    return block_shape, n_blocks
+
+def accumulate_block_histograms(img_fname, block_shape, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 100., use_memmap = False, n_bins = 256, n_workers = None, raw_header = None, roi = None):
+    """ Streams slices of a 3D image stack into one grey value histogram per block, reading each slice once
+
+    8-bit and 16-bit images are binned with one bin per grey value over the range of grey values seen so far,
+    so memory use is n_blocks * occupied grey value range. Other dtypes are binned into n_bins equal width bins
+    between min_GV and max_GV, and any limit not given is found by an extra pass with QM_load.gv_range, as in
+    QM_histogram.QM_load_histogram.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    block_shape : tuple
+        (z, y, x) dimensions of each block in voxels, see block_grid
+    min_GV, max_GV, specify_gv, pct_stack_import, use_memmap, n_bins, n_workers, raw_header, roi
+        See QM_histogram.QM_load_histogram
+
+    Returns
+    -------
+    Histogram
+        Histograms sharing the same bins, with counts of shape (n_blocks_z, n_blocks_y, n_blocks_x, n_bins)
+    block_shape
+        Tuple of block dimensions, see block_grid
+    origin
+        Tuple of the (z, y, x) voxel of the first block, i.e. the resolved start of roi
+    """
+    n_frames = QM_load.get_n_slices(img_fname, raw_header)
+    z_indices = np.arange(n_frames)[QM_load.roi_slices(roi)[0]]
+    slice_indices = QM_load.roi_slice_indices(n_frames, pct_stack_import, roi)
+    crop = QM_load.roi_slices(roi)[1:]
+
+    full_slice = QM_load.read_slice(img_fname, slice_indices[0], use_memmap, raw_header)
+    first_slice = full_slice[crop]
+    if first_slice.size == 0:
+        raise ValueError("roi {} does not contain any pixels of the slices of {}".format(roi, img_fname))
+    dtype = first_slice.dtype
+    origin = (int(z_indices[0]), ) + tuple(axis_slice.indices(extent)[0] for axis_slice, extent in zip(crop, full_slice.shape))
+    block_shape, n_blocks = block_grid((len(z_indices), ) + first_slice.shape, block_shape)
+    rows = np.arange(first_slice.shape[0]) // block_shape[1]
+    cols = np.arange(first_slice.shape[1]) // block_shape[2]
+    block_labels = (rows[:, np.newaxis] * n_blocks[2] + cols).ravel() # (y, x) block of each voxel in a slice
+    n_blocks_yx = n_blocks[1] * n_blocks[2]
+
+    integer = np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2
+    if integer == True:
+        lowest = None # bins grow to cover the grey values seen so far
+        counts = np.zeros([n_blocks[0], n_blocks_yx, 0], dtype = np.int64)
+    else:
+        if min_GV is None or max_GV is None:
+            detected_min_GV, detected_max_GV = QM_load.gv_range(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop)
+            min_GV = detected_min_GV if min_GV is None else min_GV
+            max_GV = detected_max_GV if max_GV is None else max_GV
+        bin_edges = QM_histogram.Histogram.for_dtype(dtype, min_GV, max_GV, n_bins).bin_edges
+        counts = np.zeros([n_blocks[0], n_blocks_yx, len(bin_edges) - 1], dtype = np.int64)
+
+    slice_iter = QM_load.iter_slices(img_fname, slice_indices, use_memmap, n_workers, raw_header, crop)
+    for index, img_slice in zip(slice_indices, slice_iter):
+        block_z = (index - z_indices[0]) // block_shape[0]
+        img_1d = img_slice.ravel()
+        labels = block_labels
+        if specify_gv == True:
+            keep = np.ones(len(img_1d), dtype = bool)
+            if min_GV is not None:
+                keep &= img_1d > min_GV
+            if max_GV is not None:
+                keep &= img_1d < max_GV
+            img_1d, labels = img_1d[keep], labels[keep]
+        if integer == True:
+            if len(img_1d) == 0:
+                continue
+            slice_min, slice_max = int(img_1d.min()), int(img_1d.max())
+            if lowest is None:
+                lowest = slice_min
+            pad_low = max(lowest - slice_min, 0)
+            pad_high = max(slice_max - (lowest + counts.shape[2] - 1), 0)
+            if pad_low > 0 or pad_high > 0:
+                counts = np.pad(counts, [(0, 0), (0, 0), (pad_low, pad_high)], mode = "constant")
+                lowest -= pad_low
+            bins = img_1d.astype(np.int64) - lowest
+        else:
+            bins = np.floor((img_1d - bin_edges[0]) / (bin_edges[1] - bin_edges[0])).astype(np.int64)
+            bins[img_1d == bin_edges[-1]] = len(bin_edges) - 2 # right edge is inside the last bin, as np.histogram
+            keep = (bins >= 0) & (bins < len(bin_edges) - 1) # also drops NaN and inf
+            bins, labels = bins[keep], labels[keep]
+        n_cols = counts.shape[2]
+        counts[block_z] += np.bincount(labels * n_cols + bins, minlength = n_blocks_yx * n_cols).reshape([n_blocks_yx, n_cols])
+
+    if integer == True:
+        if lowest is None:
+            raise ValueError("No grey values inside (min_GV, max_GV) in {}".format(img_fname))
+        bin_edges = np.arange(lowest, lowest + counts.shape[2] + 1) - 0.5
+    histo = QM_histogram.Histogram(bin_edges, counts.reshape(n_blocks + (counts.shape[2], )), integer)
+    return histo.trim(), block_shape, origin
+
+def QM_map(img_fname, n_gaussians, block_shape = (None, None, None), min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 100., n_bins = 256, min_voxels = 1000, tol = 1e-5, max_iter = 1000, raw_header = None, roi = None, use_memmap = False, n_workers = None, save_results = True):
+    """ Block-wise quality map: fits a Gaussian mixture model to every block of the volume
+
+    The volume is read once, slice by slice, into one grey value histogram per block. The sum of the block
+    histograms is fitted first, and that global fit starts EM for every block, so component i of each block
+    describes the same material as component i of the global fit. Blocks are fitted together with batched EM.
+
+    Parameters
+    ----------
+    img_fname : str
+        Filepath of image stack, directory of per-slice images, glob pattern matching per-slice images or raw volume
+    n_gaussians : int
+        Number of Gaussians to fit to every block
+    block_shape : tuple
+        (z, y, x) dimensions of each block in voxels. None along an axis uses the whole extent, so the default
+        (None, None, None) gives a single block and e.g. (50, None, None) slabs of 50 slices.
+    min_GV, max_GV, specify_gv, pct_stack_import, raw_header, roi, use_memmap
+        See QM_histogram.QM_load_histogram
+    n_bins : int
+        Maximum number of bins per block histogram, 16-bit grey value ranges are merged down to this. Defaults to 256.
+    min_voxels : int
+        Blocks with fewer voxels are not fitted and are NaN in the map. Defaults to 1000.
+    tol : float
+        EM convergence threshold of the block fits, see GMM_em.fit_histogram. Tighter than for single fits,
+        since blocks start from the global fit and would otherwise stop before moving away from it. Defaults to 1e-5.
+    max_iter : int
+        Maximum number of EM iterations of the block fits. Defaults to 1000.
+    n_workers : int
+        Number of threads reading slices and fitting batches of blocks, defaults to the number of CPUs
+    save_results : bool
+        If True, save the map to Quality_Map.npz in the results directory. Defaults to True.
+
+    Returns
+    -------
+    quality_map
+        Dict of numpy arrays. mu, sigma and weights have shape (n_blocks_z, n_blocks_y, n_blocks_x, n_gaussians),
+        SNR and CNR shape (n_blocks_z, n_blocks_y, n_blocks_x, n_gaussians, n_gaussians) with Gaussian A along the
+        fourth and Gaussian B along the fifth axis as in QM_calc (NaN where A == B), n_voxels and converged shape
+        (n_blocks_z, n_blocks_y, n_blocks_x). global_mu, global_sigma and global_weights hold the global fit,
+        block_shape the block dimensions and origin the (z, y, x) voxel of the first block.
+    """
+    start = time.time()
+
+    histo, block_shape, origin = accumulate_block_histograms(img_fname, block_shape, min_GV, max_GV, specify_gv, pct_stack_import,
+        use_memmap, n_bins, n_workers, raw_header, roi)
+    histo = histo.rebin(n_bins)
+    n_blocks = histo.counts.shape[:-1]
+    print("Block histograms accumulated for {} blocks, time elapsed = {:.2f} s".format(np.prod(n_blocks), (time.time()-start)))
+
+    global_histo = QM_histogram.Histogram(histo.bin_edges, histo.counts.reshape([-1, histo.counts.shape[-1]]).sum(axis = 0), histo.integer)
+    mu, sigma, weights = GMM_fit.extract_GMM_results(GMM_fit.GMM_fit_histogram(global_histo, n_gaussians))
+
+    counts = histo.counts.reshape([-1, histo.counts.shape[-1]])
+    n_voxels = counts.sum(axis = 1)
+    fitted = np.flatnonzero(n_voxels >= min_voxels)
+    batches = [fitted[i:i + BATCH_SIZE] for i in range(0, len(fitted), BATCH_SIZE)]
+    sheppard = 0. if histo.integer == True else histo.bin_width ** 2 / 12.
+    def fit_batch(batch):
+        return GMM_em.fit_histograms_batched(histo.bin_centres, counts[batch], n_gaussians, mu, sigma ** 2 + sheppard, weights,
+            tol = tol, max_iter = max_iter)
+    n_workers = max(1, n_workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        batch_results = list(executor.map(fit_batch, batches))
+
+    block_params = np.full([3, len(counts), n_gaussians], np.nan)
+    converged = np.zeros(len(counts), dtype = bool)
+    for batch, (means, variances, block_weights, n_iter, batch_converged, lower_bound) in zip(batches, batch_results):
+        block_params[:, batch] = means, np.sqrt(np.maximum(variances - sheppard, 1e-6)), block_weights
+        converged[batch] = batch_converged
+    block_mu, block_sigma, block_weights = [param.reshape(n_blocks + (n_gaussians, )) for param in block_params]
+
+    SNR, CNR = QM_calc.SNR_CNR(block_mu, block_sigma)
+
+    quality_map = {"mu": block_mu, "sigma": block_sigma, "weights": block_weights, "SNR": SNR, "CNR": CNR,
+        "n_voxels": n_voxels.reshape(n_blocks), "converged": converged.reshape(n_blocks),
+        "global_mu": mu, "global_sigma": sigma, "global_weights": weights,
+        "block_shape": np.array(block_shape), "origin": np.array(origin)}
+
+    if save_results == True:
+        results_dir = QM_load.get_results_dir(img_fname)
+        if os.path.isdir(results_dir) == False:
+            os.mkdir(results_dir)
+        np.savez_compressed(os.path.join(results_dir, "Quality_Map.npz"), **quality_map)
+        print("Quality map saved to {}".format(results_dir))
+
+    end = time.time()
+    print("Quality map of {} blocks complete, {} fitted, time elapsed = {:.2f} s\n".format(len(counts), len(fitted), (end-start)))
+
+    return quality_map
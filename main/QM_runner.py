@@ -1,32 +1,79 @@
 # Import libraries
 import os
+import time
 
 # Import QM functions
 
-from QM_load import QM_load
+from QM_load import QM_load, get_results_dir
+from QM_histogram import QM_load_histogram
+from QM_cache import QM_load_cached, QM_load_histogram_cached
 from QM_calc import QM_calc
+import QM_histogram
+import QM_uncertainty
+import QM_db
 import GMM_fit
 
-def QM_runner(img_fname, n_gaussians, min_GV = 0, max_GV = 255, specify_gv = False, pct_stack_import = 10.):
+def QM_runner(img_fname, n_gaussians, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 10., stream_histogram = False, engine = "sklearn", raw_header = None, n_samples = None, roi = None, use_cache = False, max_gaussians = 6, n_init = 1, save_diagnostics = False, return_diagnostics = False, uncertainty = None, results_db = None, save_histogram = False):
     """ Basic workflow returning SNR and CNR
     Parameters
     ----------
     img_fname : str
-        Filepath of image to load
-    n_gaussians : int
-        Number of Gaussians to fit
+        Filepath of image to load, directory or glob pattern of per-slice images, or raw volume
+    n_gaussians : int or "auto"
+        Number of Gaussians to fit. If "auto", choose between 1 and max_gaussians Gaussians by BIC, see
+        GMM_fit.select_n_gaussians, and save the score table to Model_Selection.csv in the results directory.
     min_GV : float
-        Minimum grey value to consider, ignored if specify_gv == False
+        Minimum grey value to consider, ignored if specify_gv == False. Defaults to None, which places no lower limit.
     max_GV : float
-        Maximum grey value to consider, ignored if specify_gv == False
+        Maximum grey value to consider, ignored if specify_gv == False. Defaults to None, which places no upper limit.
     specify_gv : bool
         If True, discard grey values outside [min_GV, max_GV]
     pct_stack_import : float
         Percentage of stack to import, defaults to 10.
+    stream_histogram : bool
+        If True, stream slices into a grey value histogram instead of loading voxels, so memory use
+        does not grow with pct_stack_import. Defaults to False.
+    engine : str
+        Fitting engine passed to GMM_fit, "sklearn", "histogram", "coarse_to_fine" or "chunked". Defaults to "sklearn".
+        Ignored if stream_histogram == True, as histograms are always fitted with the "histogram" engine.
+    raw_header : dict
+        Description of a raw volume (.raw, .vol), see QM_load. Defaults to None, which reads the sidecar header.
+    n_samples : int
+        If given, fit a fixed number of voxels drawn by stratified random sampling across the whole stack
+        instead of pct_stack_import slices, so fitting time is bounded. Ignored if stream_histogram == True.
+        Defaults to None.
+    roi : tuple
+        Bounding box (z_min, z_max, y_min, y_max, x_min, x_max) in voxels to crop the image to while reading,
+        see QM_load.roi_slices. Defaults to None, which uses whole slices.
+    use_cache : bool
+        If True, reuse voxels or histograms loaded before from the same, unchanged image with the same loading
+        parameters, so re-fitting with a different n_gaussians skips reading the image, and reuse fits of data
+        with the same grey value histogram and fitting parameters, see GMM_fit.GMM_fit_cached. Defaults to False.
+    max_gaussians : int
+        Largest number of Gaussians considered if n_gaussians == "auto". Defaults to 6.
+    n_init : int
+        Number of EM initialisations run in parallel, keeping the best, see GMM_fit.GMM_fit. Defaults to 1.
+    save_diagnostics : bool
+        If True, save EM convergence, data size and the time spent in each step to fit_diagnostics.json in the
+        results directory. Defaults to False.
+    return_diagnostics : bool
+        If True, also return the diagnostics as a dict. Defaults to False.
+    uncertainty : str
+        If "bootstrap" or "fisher", save 95% confidence intervals of SNR and CNR from the grey value histogram to
+        SNR_CNR_Uncertainty.csv in the results directory, see QM_uncertainty.SNR_CNR_intervals. Finer, e.g. 16-bit,
+        histograms are rebinned to QM_uncertainty.MAX_BOOTSTRAP_BINS bins and the fit refined once on them, so
+        "fisher" takes a fraction of a second and "bootstrap", which refits 200 resampled histograms, about a
+        second, whatever the bit depth. Defaults to None.
+    results_db : str
+        Filepath of an SQLite results database to also record the parameters, fitted Gaussians, SNR, CNR, overlap
+        metrics and timings of this run in, see QM_db. Defaults to None.
+    save_histogram : bool
+        If True, save the grey value histogram to histogram.npz in the results directory, so the results can be
+        replotted or refitted without reading the image, see QM_histogram.save_histogram. Defaults to False.
     Returns
     -------
     img
-        Numpy array containing loaded image
+        Numpy array containing loaded image, or Histogram if stream_histogram == True
     mu
         Numpy 1-D array of size (n_gaussians,) containing fitted means from Gaussian mixture model
     sigma
@@ -34,19 +81,109 @@ def QM_runner(img_fname, n_gaussians, min_GV = 0, max_GV = 255, specify_gv = Fal
     weights
         Numpy 1-D array of size (n_gaussians,) containing fitted weights from Gaussian mixture model
     SNR_CNR_df
-        Pandas DataFrame containing calculated SNR and CNR for all combinations of Gaussians
+        Pandas DataFrame containing calculated SNR and CNR for all combinations of Gaussians. SNR_CNR_Results.csv
+        also holds the Bhattacharyya distance, overlap and decision threshold of each pair, see QM_calc.overlap_metrics.
+    diagnostics
+        Only returned if return_diagnostics == True. Dict of the fit diagnostics from GMM_fit.fit_diagnostics,
+        with img_fname, engine and a timing dict of seconds spent in load, fit, extract, save, plot, snr_cnr and,
+        if calculated, uncertainty.
     """
     print("GMM Fitting \n===========")
-    img = QM_load(img_fname, min_GV, max_GV, specify_gv, pct_stack_import) # import image from img_fname
-    GMM = GMM_fit.GMM_fit(img, n_gaussians)
-    mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
-    out_dir = "{}_results".format(os.path.splitext(img_fname)[0])
-    GMM_fit.save_GMM_results(img_fname, GMM)
-    GMM_fit.plot_GMM_fit(img, GMM, img_fname)
-    SNR_CNR_df = QM_calc(mu, sigma, out_dir)
+    timing = {}
+    start = time.time()
+    if stream_histogram == True:
+        load_histogram = QM_load_histogram_cached if use_cache == True else QM_load_histogram
+        img = load_histogram(img_fname, min_GV, max_GV, specify_gv, pct_stack_import, raw_header = raw_header, roi = roi) # accumulate histogram of img_fname
+    else:
+        load = QM_load_cached if use_cache == True else QM_load
+        img = load(img_fname, min_GV, max_GV, specify_gv, pct_stack_import, raw_header = raw_header, n_samples = n_samples, roi = roi) # import image from img_fname
+    histo = img if isinstance(img, QM_histogram.Histogram) else QM_histogram.histogram_from_image(img) # binned once, shared by fit, plot and uncertainty
+    timing["load"] = time.time() - start
+
+    def timed(step, function, *args, **kwargs):
+        step_start = time.time()
+        result = function(*args, **kwargs)
+        timing[step] = time.time() - step_start
+        return result
+
+    GMM = timed("fit", GMM_fit.GMM_fit, img, n_gaussians, engine = engine, max_gaussians = max_gaussians, n_init = n_init, use_cache = use_cache, histo = histo)
+    mu, sigma, weights = timed("extract", GMM_fit.extract_GMM_results, GMM)
+    out_dir = get_results_dir(img_fname)
+    timed("save", GMM_fit.save_GMM_results, img_fname, GMM)
+    if n_gaussians == "auto":
+        GMM.model_selection_.to_csv(os.path.join(out_dir, "Model_Selection.csv"))
+    if save_histogram == True:
+        QM_histogram.save_histogram(img_fname, histo)
+    timed("plot", GMM_fit.plot_GMM_fit, histo, GMM, img_fname)
+    results_df = timed("snr_cnr", QM_calc, mu, sigma, out_dir, weights = weights) # overlap metrics are saved, not returned
+    SNR_CNR_df = results_df[["Gaussian_B", "SNR", "CNR"]]
+    if uncertainty is not None:
+        intervals_df = timed("uncertainty", QM_uncertainty.SNR_CNR_intervals, histo, GMM, uncertainty)
+        intervals_df.to_csv(os.path.join(out_dir, "SNR_CNR_Uncertainty.csv"))
+    timing["total"] = time.time() - start
+    if results_db is not None:
+        params = {"n_gaussians": n_gaussians, "min_GV": min_GV, "max_GV": max_GV, "specify_gv": specify_gv, "pct_stack_import": pct_stack_import,
+            "stream_histogram": stream_histogram, "engine": engine, "n_samples": n_samples, "roi": roi, "n_init": n_init}
+        QM_db.save_runs(results_db, [QM_db.run_record(img_fname, mu, sigma, weights, results_df, params, timing)])
+
+    if save_diagnostics == True or return_diagnostics == True:
+        diagnostics = {"img_fname": img_fname, "engine": engine, "timing": timing}
+        diagnostics.update(GMM_fit.fit_diagnostics(GMM, img))
+        if save_diagnostics == True:
+            GMM_fit.save_diagnostics(img_fname, diagnostics)
+        if return_diagnostics == True:
+            return img, mu, sigma, SNR_CNR_df, diagnostics
 
     return img, mu, sigma, SNR_CNR_df
 
+def QM_runner_series(img_fnames, n_gaussians, min_GV = None, max_GV = None, specify_gv = False, pct_stack_import = 10., stream_histogram = False, engine = "sklearn", warm_start = "previous", use_cache = False, results_db = None):
+    """ Workflow for a series of similar scans, warm-starting each fit from the previous ones
+    Parameters
+    ----------
+    img_fnames : list of str
+        Filepaths of images to load, one per scan, in the order they should be fitted
+    n_gaussians : int
+        Number of Gaussians to fit to every scan
+    min_GV, max_GV, specify_gv, pct_stack_import, stream_histogram, engine, use_cache
+        See QM_runner, applied to every scan
+    warm_start : str
+        "previous" to start each fit from the previous scan, "mean" from the mean of all previous scans,
+        see GMM_fit.GMM_fit_series. Defaults to "previous".
+    results_db : str
+        Filepath of an SQLite results database to record every scan in, see QM_db. All scans are written together
+        in one transaction once the series is fitted. Defaults to None.
+    Returns
+    -------
+    report
+        Pandas DataFrame indexed by scan number with the filename, EM iterations used and saved, and convergence
+        of each scan. Fitted results and SNR and CNR are saved in the results directory of each scan, without plots.
+    """
+    def load_scans():
+        for img_fname in img_fnames: # one scan in memory at a time
+            if stream_histogram == True:
+                load_histogram = QM_load_histogram_cached if use_cache == True else QM_load_histogram
+                yield load_histogram(img_fname, min_GV, max_GV, specify_gv, pct_stack_import)
+            else:
+                load = QM_load_cached if use_cache == True else QM_load
+                yield load(img_fname, min_GV, max_GV, specify_gv, pct_stack_import)
+
+    print("GMM Fitting of series \n=====================")
+    GMMs, report = GMM_fit.GMM_fit_series(load_scans(), n_gaussians, warm_start, engine)
+    records = []
+    params = {"n_gaussians": n_gaussians, "min_GV": min_GV, "max_GV": max_GV, "specify_gv": specify_gv, "pct_stack_import": pct_stack_import,
+        "stream_histogram": stream_histogram, "engine": engine, "warm_start": warm_start}
+    for img_fname, GMM in zip(img_fnames, GMMs):
+        GMM_fit.save_GMM_results(img_fname, GMM)
+        mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
+        SNR_CNR_df = QM_calc(mu, sigma, get_results_dir(img_fname), verbose = False, weights = weights)
+        if results_db is not None:
+            records.append(QM_db.run_record(img_fname, mu, sigma, weights, SNR_CNR_df, params))
+    if results_db is not None:
+        QM_db.save_runs(results_db, records)
+    report.insert(0, "img_fname", list(img_fnames))
+
+    return report
+
 # Main
 
 if __name__ == "__main__":
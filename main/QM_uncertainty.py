@@ -0,0 +1,226 @@
+import numpy as np
+from scipy.special import logsumexp
+from scipy.stats import norm
+
+import GMM_em
+import GMM_fit
+import QM_calc
+
+MAX_BATCH_VALUES = 2**22 # bootstrap histograms are refitted in batches of at most this many bins * n_gaussians
+MAX_BOOTSTRAP_BINS = 1024 # finer histograms, e.g. of 16-bit images, are rebinned before refining and resampling
+MAX_REFINE_ITER = 1000 # EM iterations allowed for refining the fit and for each resample
+
+def refine_GMM(histo, GMM, tol = None, max_iter = MAX_REFINE_ITER):
+    """ Continues EM from a fitted model until it converges to within the sampling error of histo
+
+    Fits to the default tolerance stop once the log-likelihood per voxel changes by less than 1e-3, which for
+    large or overlapping histograms can leave the parameters further from the maximum likelihood estimate than
+    their standard error. Uncertainties are only meaningful around the converged model. Each iteration costs
+    n_bins * n_gaussians, so fine histograms, e.g. of 16-bit images, should be rebinned to MAX_BOOTSTRAP_BINS
+    first, as SNR_CNR_intervals does.
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram the model was fitted to, e.g. output from QM_histogram.QM_load_histogram
+    GMM : instance of GaussianMixture class or GMMResult
+        Fitted Gaussian mixture model, output from GMM_fit.GMM_fit
+    tol : float, optional
+        EM convergence threshold of the mean log-likelihood per voxel, defaults to 1e-3 / n_voxels, i.e. a change
+        of 0.001 in the total log-likelihood
+    max_iter : int, default MAX_REFINE_ITER
+        Maximum number of EM iterations
+
+    Returns
+    -------
+    GMMResult
+        Converged model, with components in ascending order of the means of GMM
+    """
+    mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
+    tol = 1e-3 / histo.n_voxels if tol is None else tol
+    sheppard = 0. if histo.integer == True else histo.bin_width ** 2 / 12. # as GMM_fit.GMM_fit_histogram
+    GMM = GMM_em.fit_histogram(histo.bin_centres, histo.counts, len(mu), mu, sigma ** 2 + sheppard, weights, tol = tol, max_iter = max_iter)
+    if GMM.converged_ == False:
+        print("Refinement stopped after {} EM iterations without converging".format(GMM.n_iter_))
+    GMM.covariances_ = np.maximum(GMM.covariances_ - sheppard, 1e-6)
+    GMM.precisions_ = 1. / GMM.covariances_
+    return GMM
+
+def bootstrap_GMM(histo, GMM, n_boot = 200, random_state = 3, tol = None, max_iter = MAX_REFINE_ITER, refine = True):
+    """ Refits a Gaussian mixture model to multinomial resamples of a grey value histogram
+
+    Resampling the bin counts is equivalent to resampling the voxels with replacement. The cost of each EM
+    iteration grows with the number of bins, so histograms with more than MAX_BOOTSTRAP_BINS bins, e.g. of
+    16-bit images, are first merged into at most MAX_BOOTSTRAP_BINS bins, with Sheppard's correction for the
+    bin width. GMM is then refined on the merged histogram with refine_GMM, unless refine == False, and every
+    resample is fitted by batched EM started from it, so component i of every resample is component i of GMM
+    and no voxels are read again. Resamples differ from GMM by about 1 / sqrt(n_voxels), so EM must converge
+    much more tightly than for a single fit, or the resamples stay at the start and the spread is underestimated.
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram the model was fitted to, e.g. output from QM_histogram.QM_load_histogram
+    GMM : instance of GaussianMixture class or GMMResult
+        Fitted Gaussian mixture model, output from GMM_fit.GMM_fit
+    n_boot : int, default 200
+        Number of bootstrap resamples
+    random_state : int, default 3
+        Seed for resampling, fixed for predictability
+    tol, max_iter
+        See refine_GMM, used for every resample
+    refine : bool, default True
+        If False, GMM must already be refined on histo rebinned to MAX_BOOTSTRAP_BINS, e.g. by SNR_CNR_intervals
+
+    Returns
+    -------
+    mu, sigma, weights : numpy array
+        Parameters fitted to each resample, shape (n_boot, n_gaussians), components in ascending order of the
+        means of GMM
+    """
+    histo = histo.rebin(MAX_BOOTSTRAP_BINS)
+    counts = np.asarray(histo.counts, dtype = np.int64)
+    tol = 1e-3 / counts.sum() if tol is None else tol
+    sheppard = 0. if histo.integer == True else histo.bin_width ** 2 / 12.
+    if refine == True:
+        GMM = refine_GMM(histo, GMM, tol, max_iter)
+    mu, variances, weights = GMM.means_.ravel(), GMM.covariances_.ravel() + sheppard, GMM.weights_
+    rng = np.random.RandomState(random_state)
+    batch_size = max(1, MAX_BATCH_VALUES // (len(counts) * len(mu)))
+
+    boot_params = []
+    for batch_start in range(0, n_boot, batch_size):
+        n_batch = min(batch_size, n_boot - batch_start)
+        boot_counts = rng.multinomial(counts.sum(), counts / counts.sum(), size = n_batch)
+        boot_means, boot_variances, boot_weights = GMM_em.fit_histograms_batched(histo.bin_centres, boot_counts, len(mu), mu,
+            variances, weights, tol = tol, max_iter = max_iter)[:3]
+        boot_params.append((boot_means, np.sqrt(np.maximum(boot_variances - sheppard, 1e-6)), boot_weights))
+    return tuple(np.concatenate(param) for param in zip(*boot_params))
+
+def parameter_covariance(histo, GMM):
+    """ Asymptotic covariance of the fitted means, standard deviations and weights from the Fisher information
+
+    The observed information is estimated by the sum of outer products of the per-voxel score vectors, each
+    bin of the histogram contributing its count times the outer product of the score at its centre. For bins
+    wider than one grey value, the scores are those of the binned model, whose variances include Sheppard's
+    correction, as fitted by refine_GMM.
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram the model was fitted to
+    GMM : instance of GaussianMixture class or GMMResult
+        Fitted Gaussian mixture model, output from GMM_fit.GMM_fit
+
+    Returns
+    -------
+    mu, sigma, weights
+        Fitted parameters, shape (n_gaussians, ), in ascending order of means
+    covariance
+        Covariance matrix of (mu_0, ..., mu_k-1, sigma_0, ..., sigma_k-1, weight_0, ..., weight_k-2), the last
+        weight being fixed by the others, shape (3 * n_gaussians - 1, 3 * n_gaussians - 1)
+    """
+    mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
+    x = histo.bin_centres
+    variances = sigma ** 2 + (0. if histo.integer == True else histo.bin_width ** 2 / 12.) # as refine_GMM
+    log_prob = GMM_em.estimate_log_prob(x, mu, variances, weights)
+    resp = np.exp(log_prob - logsumexp(log_prob, axis = 1)[:, np.newaxis])
+
+    diff = x[:, np.newaxis] - mu
+    score_mu = resp * diff / variances
+    score_sigma = resp * sigma * (diff ** 2 / variances ** 2 - 1. / variances) # chain rule through the binned variances
+    score_weights = resp[:, :-1] / weights[:-1] - resp[:, -1:] / weights[-1]
+    scores = np.concatenate([score_mu, score_sigma, score_weights], axis = 1)
+
+    information = (scores * np.asarray(histo.counts, dtype = np.float64)[:, np.newaxis]).T @ scores
+    return mu, sigma, weights, np.linalg.pinv(information)
+
+def SNR_CNR_standard_errors(mu, sigma, covariance):
+    """ Standard errors of SNR and CNR of every pair of Gaussians by the delta method
+
+    Parameters
+    ----------
+    mu, sigma : numpy array
+        Fitted parameters, shape (n_gaussians, )
+    covariance : numpy array
+        Output from parameter_covariance
+
+    Returns
+    -------
+    SNR_se, CNR_se : numpy array
+        Standard errors, shape (n_gaussians, n_gaussians), laid out as QM_calc.SNR_CNR
+    """
+    k = len(mu)
+    i, j = np.meshgrid(np.arange(k), np.arange(k), indexing = "ij") # Gaussian A, Gaussian B
+    grad_SNR = np.zeros([k, k, len(covariance)])
+    grad_CNR = np.zeros([k, k, len(covariance)])
+
+    np.add.at(grad_SNR, (i, j, i), 1. / sigma[j]) # d(mu_A / sigma_B) / d mu_A
+    np.add.at(grad_SNR, (i, j, k + j), -mu[i] / sigma[j] ** 2) # d(mu_A / sigma_B) / d sigma_B
+
+    spread = np.sqrt(sigma[i] ** 2 + sigma[j] ** 2)
+    sign = np.sign(mu[i] - mu[j])
+    contrast = np.abs(mu[i] - mu[j])
+    np.add.at(grad_CNR, (i, j, i), sign / spread)
+    np.add.at(grad_CNR, (i, j, j), -sign / spread)
+    np.add.at(grad_CNR, (i, j, k + i), -contrast * sigma[i] / spread ** 3)
+    np.add.at(grad_CNR, (i, j, k + j), -contrast * sigma[j] / spread ** 3)
+
+    SNR_se = np.sqrt(np.einsum("abp,pq,abq->ab", grad_SNR, covariance, grad_SNR))
+    CNR_se = np.sqrt(np.einsum("abp,pq,abq->ab", grad_CNR, covariance, grad_CNR))
+    diagonal = np.eye(k, dtype = bool)
+    SNR_se[diagonal] = np.nan
+    CNR_se[diagonal] = np.nan
+    return SNR_se, CNR_se
+
+def SNR_CNR_intervals(histo, GMM, method = "bootstrap", confidence = 0.95, n_boot = 200, random_state = 3):
+    """ Confidence intervals of SNR and CNR of every pair of Gaussians, without reading or refitting voxels
+
+    Parameters
+    ----------
+    histo : Histogram
+        Grey value histogram the model was fitted to, e.g. output from QM_histogram.QM_load_histogram or
+        QM_histogram.histogram_from_image of the voxels from QM_load
+    GMM : instance of GaussianMixture class or GMMResult
+        Fitted Gaussian mixture model, output from GMM_fit.GMM_fit
+    method : str, default "bootstrap"
+        "bootstrap" for percentile intervals from bootstrap_GMM, or "fisher" for normal intervals from the
+        standard errors of SNR_CNR_standard_errors
+    confidence : float, default 0.95
+        Confidence level of the intervals
+    n_boot : int, default 200
+        Number of bootstrap resamples, only used if method == "bootstrap"
+    random_state : int, default 3
+        Seed for resampling, only used if method == "bootstrap"
+
+    Returns
+    -------
+    SNR_CNR_df : pandas DataFrame
+        Pandas DataFrame of Gaussian A, Gaussian B, SNR and CNR as QM_calc.QM_calc, with columns SNR_lower,
+        SNR_upper, CNR_lower and CNR_upper giving the confidence interval of each. SNR and CNR are those of GMM
+        refined by refine_GMM, so can differ slightly from QM_calc of a fit to the default tolerance.
+    """
+    if method not in ("bootstrap", "fisher"):
+        raise ValueError("method must be 'bootstrap' or 'fisher', not '{}'".format(method))
+    histo = histo.rebin(MAX_BOOTSTRAP_BINS) # binned and refined once, shared by the estimate and both methods
+    GMM = refine_GMM(histo, GMM)
+    mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
+    SNR, CNR = QM_calc.SNR_CNR(mu, sigma)
+    if method == "bootstrap":
+        mu_boot, sigma_boot, weights_boot = bootstrap_GMM(histo, GMM, n_boot, random_state, refine = False)
+        SNR_boot, CNR_boot = QM_calc.SNR_CNR(mu_boot, sigma_boot)
+        percentiles = [50. * (1. - confidence), 50. * (1. + confidence)]
+        SNR_lower, SNR_upper = np.percentile(SNR_boot, percentiles, axis = 0)
+        CNR_lower, CNR_upper = np.percentile(CNR_boot, percentiles, axis = 0)
+    else:
+        covariance = parameter_covariance(histo, GMM)[3]
+        SNR_se, CNR_se = SNR_CNR_standard_errors(mu, sigma, covariance)
+        z = norm.ppf(0.5 + confidence / 2.)
+        SNR_lower, SNR_upper = SNR - z * SNR_se, SNR + z * SNR_se
+        CNR_lower, CNR_upper = CNR - z * CNR_se, CNR + z * CNR_se
+
+    SNR_CNR_df = QM_calc.SNR_CNR_table(SNR, CNR)
+    pairs = np.nonzero(~np.eye(len(mu), dtype = bool)) # same order as the rows of SNR_CNR_table
+    for name, values in [("SNR_lower", SNR_lower), ("SNR_upper", SNR_upper), ("CNR_lower", CNR_lower), ("CNR_upper", CNR_upper)]:
+        SNR_CNR_df[name] = values[pairs]
+    return SNR_CNR_df[["Gaussian_B", "SNR", "SNR_lower", "SNR_upper", "CNR", "CNR_lower", "CNR_upper"]]
@@ -4,6 +4,7 @@ from javax.swing import JFrame, JButton, JList
 from java.awt import GridLayout, BorderLayout
 from ij.measure import ResultsTable
 from ij import IJ, ImagePlus
+from ij.plugin import FolderOpener
 
 # Import Run_CPython
 script_path = os.path.dirname(os.path.realpath(__file__))
@@ -43,19 +44,26 @@ def get_user_params(event):
     Returns
     -------
     dict
-        Dict containing filename, number of Gaussians to fit,
+        Dict containing filename (multi-page image or directory of
+        per-slice images), number of Gaussians to fit (or "auto"),
+        maximum number of Gaussians,
         % of dataset to import, whether to specify grey value
         limits, minimum grey value and maximum grey value to 
-        consider (optional)
+        consider (optional), whether to crop to a bounding box and
+        the bounding box (optional)
     """
     # Open user dialog
     gui = GenericDialogPlus("Define user parameters")
-    gui.addFileField("Image filename", "Select image file")
+    gui.addDirectoryOrFileField("Image filename or directory of slices", "Select image file or directory")
     gui.addNumericField("Number of Gaussians to fit: ", 2, 0)
+    gui.addCheckbox("Choose number of Gaussians automatically (BIC)?", False)
+    gui.addNumericField("Max number of Gaussians (optional): ", 6, 0)
     gui.addNumericField("Percentage of dataset to import: ", 15, 0)
     gui.addCheckbox("Specify grey value limits?", False)
-    gui.addNumericField("Min grey value (optional): ", 0, 0)
-    gui.addNumericField("Max grey value (optional): ", 255, 0)
+    gui.addStringField("Min grey value (optional, auto = no limit): ", "auto")
+    gui.addStringField("Max grey value (optional, auto = no limit): ", "auto")
+    gui.addCheckbox("Crop to bounding box?", False)
+    gui.addStringField("Bounding box z_min z_max y_min y_max x_min x_max (optional): ", "0 None 0 None 0 None", 30)
     gui.showDialog()
 
     # Extract user parameters
@@ -63,13 +71,21 @@ def get_user_params(event):
         user_params = {} # empty dict
         user_params['img_fname'] = str(gui.getNextString())
         user_params['n_gaussians'] = int(gui.getNextNumber())
+        if gui.getNextBoolean():
+            user_params['n_gaussians'] = "auto"
+        user_params['max_gaussians'] = int(gui.getNextNumber())
         user_params['pct_stack_import'] = float(gui.getNextNumber())
         user_params['specify_gv'] = gui.getNextBoolean()
-        user_params['min_gv'] = float(gui.getNextNumber())
-        user_params['max_gv'] = float(gui.getNextNumber())
+        user_params['min_gv'] = str(gui.getNextString())
+        user_params['max_gv'] = str(gui.getNextString())
+        user_params['specify_roi'] = gui.getNextBoolean()
+        user_params['roi'] = str(gui.getNextString())
     
-    # Create results directory
-    results_dir = os.path.splitext(user_params['img_fname'])[0] + "_results"
+    # Create results directory, named after the directory for image sequences
+    if os.path.isdir(user_params['img_fname']):
+        results_dir = os.path.normpath(user_params['img_fname']) + "_results"
+    else:
+        results_dir = os.path.splitext(user_params['img_fname'])[0] + "_results"
     if os.path.isdir(results_dir) == False:
         os.mkdir(results_dir)
     print("Results directory: {}".format(results_dir))
@@ -153,8 +169,6 @@ def show_thresholded(event):
         reader = csv.DictReader(csv_file)
         for row in reader:
             img_fname = row['img_fname']
-            n_gaussians = int(row['n_gaussians'])
-    print("Displaying image {} with {} Gaussians fitted".format(img_fname, n_gaussians))
    
     # Read mu and sigma from results directory
     with open(os.path.join(results_dir, "fitted_results.csv")) as csv_file:
@@ -167,6 +181,8 @@ def show_thresholded(event):
     for i in range(3, len(results)):
         mu_all.append(float(results[i][0]))
         sigma_all.append(float(results[i][1]))
+    n_gaussians = len(mu_all) # also correct if the number of Gaussians was chosen automatically
+    print("Displaying image {} with {} Gaussians fitted".format(img_fname, n_gaussians))
 
     # Calculate values for thresholding (mu +/- 1x sigma)
     lower_threshold = map(lambda mu, sigma: mu - sigma, mu_all, sigma_all)
@@ -174,7 +190,10 @@ def show_thresholded(event):
 
     # Display each slice thresholded with the Gaussian number in title
     for gaussian in range(n_gaussians):
-        imp = IJ.openVirtual(img_fname)
+        if os.path.isdir(img_fname): # image sequence
+            imp = FolderOpener.open(img_fname, "virtual")
+        else:
+            imp = IJ.openVirtual(img_fname)
         imp.setTitle("Gaussian {}".format(gaussian))
         imp.show()
         IJ.setThreshold(imp, lower_threshold[gaussian], upper_threshold[gaussian])
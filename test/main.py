@@ -5,6 +5,14 @@ import unittest
 # Import test scripts
 import test_outputs
 import test_phantom
+import test_load
+import test_histogram
+import test_cache
+import test_fit
+import test_map
+import test_calc
+import test_uncertainty
+import test_db
 
 if __name__ == "__main__":
     
@@ -14,4 +22,36 @@ if __name__ == "__main__":
     
     # Phantom validation
     suite = unittest.TestLoader().loadTestsFromTestCase(test_phantom.Phantom_Validation)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Image loading
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_load.Test_Load)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Grey value histograms
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_histogram.Test_Histogram)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # On-disk cache
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_cache.Test_Cache)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Gaussian mixture model fitting
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_fit.Test_Fit)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Block-wise quality maps
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_map.Test_Map)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # SNR and CNR
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_calc.Test_Calc)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Uncertainty of SNR and CNR
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_uncertainty.Test_Uncertainty)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+
+    # Results database
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_db.Test_DB)
     unittest.TextTestRunner(verbosity = 2).run(suite)
\ No newline at end of file
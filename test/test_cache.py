@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_load
+import QM_cache
+import GMM_em
+import GMM_fit
+from test_load import save_stack
+from test_histogram import create_phantom_stack
+
+class Test_Cache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.cache_dir = os.path.join(cls.tmp_dir, "cache")
+        rng = np.random.RandomState(0)
+        cls.stack = rng.randint(0, 65536, (10, 30, 40)).astype(np.uint16)
+        cls.fname = os.path.join(cls.tmp_dir, "stack.tif")
+        save_stack(cls.fname, cls.stack)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_hit(self):
+        """ Tests if a second load with the same parameters is read from the cache without opening the image
+        Raises
+        ------
+        AssertionError
+            Cached voxels and histograms should equal freshly loaded ones, with the same dtype
+        """
+        img = QM_cache.QM_load_cached(self.fname, pct_stack_import = 50., roi = (0, 5, None, None, 10, 30), cache_dir = self.cache_dir)
+        histo = QM_cache.QM_load_histogram_cached(self.fname, 1000, 60000, True, cache_dir = self.cache_dir)
+        load, QM_load.QM_load = QM_load.QM_load, None # any call to QM_load would fail
+        try:
+            img_cached = QM_cache.QM_load_cached(self.fname, pct_stack_import = 50., roi = (0, 5, None, None, 10, 30), cache_dir = self.cache_dir)
+        finally:
+            QM_load.QM_load = load
+        self.assertEqual(img_cached.dtype, np.uint16)
+        np.testing.assert_array_equal(img_cached, img)
+        histo_cached = QM_cache.QM_load_histogram_cached(self.fname, 1000, 60000, True, cache_dir = self.cache_dir)
+        np.testing.assert_array_equal(histo_cached.counts, histo.counts)
+        np.testing.assert_array_equal(histo_cached.bin_edges, histo.bin_edges)
+        self.assertEqual(histo_cached.integer, histo.integer)
+
+    def test_key(self):
+        """ Tests if the cache key changes with loading parameters and the image file, but not with how it is read
+        Raises
+        ------
+        AssertionError
+            Keys should differ for different pct_stack_import or a modified image
+        """
+        key = QM_cache.cache_key(self.fname, "voxels", pct_stack_import = 10.)
+        self.assertEqual(QM_cache.cache_key(self.fname, "voxels", pct_stack_import = 10.), key)
+        self.assertNotEqual(QM_cache.cache_key(self.fname, "voxels", pct_stack_import = 20.), key)
+        self.assertNotEqual(QM_cache.cache_key(self.fname, "histogram", pct_stack_import = 10.), key)
+        fname = os.path.join(self.tmp_dir, "modified.tif")
+        save_stack(fname, self.stack)
+        key = QM_cache.cache_key(fname, "voxels")
+        os.utime(fname, ns = (0, 0))
+        self.assertNotEqual(QM_cache.cache_key(fname, "voxels"), key)
+
+    def test_ignored_limits(self):
+        """ Tests if grey value limits which are not applied do not create separate cache entries
+        Raises
+        ------
+        AssertionError
+            Loads with specify_gv == False should share one entry whatever min_GV and max_GV are, and be read
+            from the cache without opening the image, except for float images, where the limits set the bins
+        """
+        cache_dir = os.path.join(self.tmp_dir, "limits_cache")
+        img = QM_cache.QM_load_cached(self.fname, cache_dir = cache_dir)
+        np.testing.assert_array_equal(QM_cache.QM_load_cached(self.fname, 1000, 60000, False, cache_dir = cache_dir), img)
+        QM_cache.QM_load_histogram_cached(self.fname, cache_dir = cache_dir)
+        read_slice, QM_load.read_slice = QM_load.read_slice, None # any read of the image would fail
+        try:
+            QM_cache.QM_load_histogram_cached(self.fname, 1000, 60000, False, cache_dir = cache_dir)
+        finally:
+            QM_load.read_slice = read_slice
+        self.assertEqual(len(os.listdir(cache_dir)), 2) # one voxel and one histogram entry
+        QM_cache.QM_load_cached(self.fname, 1000, 60000, True, cache_dir = cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+        fname_float = os.path.join(self.tmp_dir, "stack_float.tif")
+        save_stack(fname_float, self.stack.astype(np.float32))
+        histo = QM_cache.QM_load_histogram_cached(fname_float, cache_dir = cache_dir)
+        histo_limits = QM_cache.QM_load_histogram_cached(fname_float, 0, 1000, False, cache_dir = cache_dir)
+        self.assertEqual(histo_limits.bin_edges[-1], 1000)
+        self.assertNotEqual(histo.bin_edges[-1], 1000)
+        self.assertEqual(len(os.listdir(cache_dir)), 5)
+
+    def test_eviction(self):
+        """ Tests if least recently used entries are evicted once the cache exceeds its size limit
+        Raises
+        ------
+        AssertionError
+            Only the most recently used entries should remain
+        """
+        cache_dir = os.path.join(self.tmp_dir, "small_cache")
+        arrays = {"img": np.zeros(1000, dtype = np.uint8)}
+        for key in ["a", "b", "c"]:
+            QM_cache.cache_save(key, arrays, cache_dir, max_cache_bytes = 10**6)
+            time.sleep(0.01)
+        self.assertIsNotNone(QM_cache.cache_load("a", cache_dir)) # a is now the most recently used
+        time.sleep(0.01)
+        QM_cache.cache_save("d", arrays, cache_dir, max_cache_bytes = 3 * 1500)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ["a.npz", "c.npz", "d.npz"])
+        self.assertIsNone(QM_cache.cache_load("b", cache_dir))
+
+    def test_corrupt_entry(self):
+        """ Tests if a truncated cache entry is treated as a miss and deleted
+        Raises
+        ------
+        AssertionError
+            cache_load should return None for a truncated entry and remove it, so it is rewritten on the next save
+        """
+        cache_dir = os.path.join(self.tmp_dir, "corrupt_cache")
+        QM_cache.cache_save("a", {"img": np.arange(1000)}, cache_dir)
+        fname = QM_cache.cache_fname("a", cache_dir)
+        with open(fname, "r+b") as entry:
+            entry.truncate(os.path.getsize(fname) // 2)
+        self.assertIsNone(QM_cache.cache_load("a", cache_dir))
+        self.assertFalse(os.path.isfile(fname))
+        with open(fname, "wb") as entry:
+            entry.write(b"PK\x03\x04 not a zip file")
+        self.assertIsNone(QM_cache.cache_load("a", cache_dir))
+        self.assertIsNone(QM_cache.cache_load("missing", cache_dir))
+
+    def test_fit_cache(self):
+        """ Tests if fits of data with the same fingerprint and parameters are read from the cache
+        Raises
+        ------
+        AssertionError
+            Permuted voxels should hit the cache with the stored result, while changed parameters or a new
+            fitter version should fit again
+        """
+        img = create_phantom_stack().ravel()
+        GMM = GMM_fit.GMM_fit(img, 3, engine = "histogram", use_cache = True, cache_dir = self.cache_dir)
+        GMM_auto = GMM_fit.GMM_fit(img, "auto", engine = "histogram", max_gaussians = 4, use_cache = True, cache_dir = self.cache_dir)
+        permuted = np.random.RandomState(1).permutation(img)
+        self.assertEqual(QM_cache.fit_fingerprint(permuted), QM_cache.fit_fingerprint(img))
+        self.assertNotEqual(QM_cache.fit_fingerprint(permuted.astype(np.float32)), QM_cache.fit_fingerprint(img.astype(np.float32)))
+
+        fit_histogram, GMM_em.fit_histogram = GMM_em.fit_histogram, None # any fit would fail
+        try:
+            GMM_cached = GMM_fit.GMM_fit(permuted, 3, engine = "histogram", use_cache = True, cache_dir = self.cache_dir)
+            GMM_auto_cached = GMM_fit.GMM_fit(img, "auto", engine = "histogram", max_gaussians = 4, use_cache = True, cache_dir = self.cache_dir)
+            with self.assertRaises(TypeError):
+                GMM_fit.GMM_fit(img, 2, engine = "histogram", use_cache = True, cache_dir = self.cache_dir)
+            version, GMM_fit.FITTER_VERSION = GMM_fit.FITTER_VERSION, GMM_fit.FITTER_VERSION + 1
+            try:
+                with self.assertRaises(TypeError):
+                    GMM_fit.GMM_fit(img, 3, engine = "histogram", use_cache = True, cache_dir = self.cache_dir)
+            finally:
+                GMM_fit.FITTER_VERSION = version
+        finally:
+            GMM_em.fit_histogram = fit_histogram
+        for result, cached_result in zip(GMM_fit.extract_GMM_results(GMM), GMM_fit.extract_GMM_results(GMM_cached)):
+            np.testing.assert_array_equal(cached_result, result)
+        self.assertEqual(GMM_cached.n_iter_, GMM.n_iter_)
+        self.assertEqual(GMM_cached.lower_bound_history_, GMM.lower_bound_history_)
+        self.assertEqual(GMM_auto_cached.n_components, GMM_auto.n_components)
+        self.assertTrue(GMM_auto_cached.model_selection_.equals(GMM_auto.model_selection_))
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Cache)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
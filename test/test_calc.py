@@ -0,0 +1,104 @@
+import os
+import sys
+import math
+import shutil
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_calc
+
+def trapezoid(y, x):
+    """ Trapezoidal rule, as np.trapz which was renamed in later numpy """
+    return np.sum((y[1:] + y[:-1]) * np.diff(x)) / 2.
+
+class Test_Calc(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.mu = np.sort(rng.uniform(0, 255, (8, 4)), axis = 1)
+        cls.sigma = rng.uniform(1, 30, (8, 4))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_batch(self):
+        """ Tests if SNR and CNR of many images at once match the definitions for every pair
+        Raises
+        ------
+        AssertionError
+            SNR and CNR should have shape (n_images, n_gaussians, n_gaussians), equal the pairwise definitions
+            off the diagonal and be NaN on it
+        """
+        SNR, CNR = QM_calc.SNR_CNR(self.mu, self.sigma)
+        self.assertEqual(SNR.shape, (8, 4, 4))
+        for n in range(8):
+            for i in range(4):
+                for j in range(4):
+                    if i == j:
+                        self.assertTrue(np.isnan(SNR[n, i, j]) and np.isnan(CNR[n, i, j]))
+                    else:
+                        self.assertAlmostEqual(SNR[n, i, j], self.mu[n, i] / self.sigma[n, j])
+                        self.assertAlmostEqual(CNR[n, i, j], abs(self.mu[n, i] - self.mu[n, j]) / np.sqrt(self.sigma[n, i]**2 + self.sigma[n, j]**2))
+        SNR_single, CNR_single = QM_calc.SNR_CNR(self.mu[3], self.sigma[3])
+        np.testing.assert_array_equal(SNR_single, SNR[3])
+        np.testing.assert_array_equal(CNR_single, CNR[3])
+
+    def test_table(self):
+        """ Tests if QM_calc gives one row per ordered pair of different Gaussians and saves it as .csv
+        Raises
+        ------
+        AssertionError
+            Table should list pairs in order of Gaussian A then Gaussian B, with the values from SNR_CNR
+        """
+        SNR_CNR_df = QM_calc.QM_calc(self.mu[0], self.sigma[0], self.tmp_dir, verbose = False)
+        self.assertEqual(list(SNR_CNR_df.columns), ["Gaussian_B", "SNR", "CNR"])
+        self.assertEqual(list(SNR_CNR_df.index), [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3])
+        self.assertEqual(list(SNR_CNR_df["Gaussian_B"]), [1, 2, 3, 0, 2, 3, 0, 1, 3, 0, 1, 2])
+        self.assertAlmostEqual(SNR_CNR_df["SNR"].iloc[4], self.mu[0, 1] / self.sigma[0, 2])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "SNR_CNR_Results.csv")))
+
+    def test_overlap(self):
+        """ Tests if overlap metrics match numerical integration of the weighted Gaussians of each pair
+        Raises
+        ------
+        AssertionError
+            Bhattacharyya distance and overlap should match integrals over a fine grid, thresholds should lie
+            between the means where the weighted densities are equal, and the metrics should be saved by QM_calc
+        """
+        weights = np.random.RandomState(1).dirichlet(np.ones(4), 8)
+        Bhattacharyya, Overlap, Threshold = QM_calc.overlap_metrics(self.mu, self.sigma, weights)
+        self.assertEqual(Overlap.shape, (8, 4, 4))
+        x = np.linspace(-300, 600, 200001)
+        for n in range(8):
+            density = np.exp(-(x - self.mu[n, :, np.newaxis])**2 / (2 * self.sigma[n, :, np.newaxis]**2)) / (np.sqrt(2 * np.pi) * self.sigma[n, :, np.newaxis])
+            for i in range(4):
+                for j in range(4):
+                    if i == j:
+                        self.assertTrue(np.isnan(Overlap[n, i, j]) and np.isnan(Threshold[n, i, j]))
+                        continue
+                    w_A, w_B = weights[n, i] / (weights[n, i] + weights[n, j]), weights[n, j] / (weights[n, i] + weights[n, j])
+                    self.assertAlmostEqual(Overlap[n, i, j], trapezoid(np.minimum(w_A * density[i], w_B * density[j]), x), places = 6)
+                    self.assertAlmostEqual(Bhattacharyya[n, i, j], Bhattacharyya[n, j, i])
+                    if Bhattacharyya[n, i, j] < 10:
+                        self.assertAlmostEqual(Bhattacharyya[n, i, j], -np.log(trapezoid(np.sqrt(density[i] * density[j]), x)), places = 5)
+                    if np.isnan(Threshold[n, i, j]) == False:
+                        t = Threshold[n, i, j]
+                        self.assertTrue(min(self.mu[n, i], self.mu[n, j]) <= t <= max(self.mu[n, i], self.mu[n, j]))
+                        self.assertAlmostEqual(np.log(w_A / self.sigma[n, i]) - (t - self.mu[n, i])**2 / (2 * self.sigma[n, i]**2),
+                            np.log(w_B / self.sigma[n, j]) - (t - self.mu[n, j])**2 / (2 * self.sigma[n, j]**2))
+
+        # equal sigma and weights, threshold halfway between the means
+        Bhattacharyya, Overlap, Threshold = QM_calc.overlap_metrics([100., 160.], [15., 15.], [0.3, 0.3])
+        self.assertAlmostEqual(Threshold[0, 1], 130.)
+        self.assertAlmostEqual(Overlap[0, 1], 0.5 * math.erfc(2 / np.sqrt(2))) # P(z > 2), the tail of each Gaussian beyond the threshold
+        self.assertAlmostEqual(Bhattacharyya[0, 1], 60.**2 / (8 * 15.**2))
+
+        SNR_CNR_df = QM_calc.QM_calc(self.mu[0], self.sigma[0], self.tmp_dir, verbose = False, weights = weights[0])
+        self.assertEqual(list(SNR_CNR_df.columns), ["Gaussian_B", "SNR", "CNR", "Bhattacharyya", "Overlap", "Threshold"])
+        self.assertAlmostEqual(SNR_CNR_df["Overlap"].iloc[4], QM_calc.overlap_metrics(self.mu[0], self.sigma[0], weights[0])[1][1, 2])
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Calc)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
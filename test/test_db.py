@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_calc
+import QM_db
+import QM_runner
+from test_load import save_stack
+from test_histogram import create_phantom_stack
+
+class Test_DB(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_save_query(self):
+        """ Tests if runs written in one batch are read back by indexed queries and the bulk export
+        Raises
+        ------
+        AssertionError
+            Every run should be stored with its components, metrics and timings, filters should select the
+            matching runs, and the export should have one row per run and pair of Gaussians
+        """
+        db_fname = os.path.join(self.tmp_dir, "batch", "results.db")
+        records = []
+        for i in range(20):
+            mu, sigma, weights = np.array([40., 100., 160. + i]), np.array([5., 6., 7.]), np.array([0.2, 0.3, 0.5])
+            SNR_CNR_df = QM_calc.QM_calc(mu, sigma, "NA", save_results = False, verbose = False, weights = weights)
+            engine = "histogram" if i % 2 == 0 else "sklearn"
+            records.append(QM_db.run_record("scan_{}.tif".format(i), mu, sigma, weights, SNR_CNR_df, {"engine": engine, "pct_stack_import": 10.}, {"fit": 0.1 * i}))
+        run_ids = QM_db.save_runs(db_fname, records)
+        self.assertEqual(len(run_ids), 20)
+
+        runs_df = QM_db.query_runs(db_fname, engine = "histogram")
+        self.assertEqual(list(runs_df.index), run_ids[::2])
+        self.assertEqual(json.loads(runs_df["params"].iloc[1])["pct_stack_import"], 10.)
+        self.assertAlmostEqual(runs_df["time_fit"].iloc[1], 0.2)
+        self.assertEqual(list(QM_db.query_runs(db_fname, img_fname = "scan_3.tif").index), [run_ids[3]])
+
+        results_df = QM_db.export_results(db_fname)
+        self.assertEqual(len(results_df), 20 * 6)
+        row = results_df[(results_df["run_id"] == run_ids[5]) & (results_df["Gaussian_A"] == 2) & (results_df["Gaussian_B"] == 1)].iloc[0]
+        self.assertAlmostEqual(row["mu_A"], 165.)
+        self.assertAlmostEqual(row["CNR"], 65. / np.sqrt(7.**2 + 6.**2))
+        self.assertAlmostEqual(row["Overlap"], QM_calc.overlap_metrics([100., 165.], [6., 7.], [0.3, 0.5])[1][1, 0])
+        self.assertEqual(len(QM_db.export_results(db_fname, run_ids = run_ids[:3])), 18)
+
+        # a failing batch writes nothing
+        records[1]["components"] = records[1]["components"] * 2 # duplicate primary key
+        with self.assertRaises(sqlite3.IntegrityError):
+            QM_db.save_runs(db_fname, records[:2])
+        self.assertEqual(len(QM_db.query_runs(db_fname)), 20)
+
+    def test_runner(self):
+        """ Tests if QM_runner and QM_runner_series record runs in the results database
+        Raises
+        ------
+        AssertionError
+            Database should hold the fitted Gaussians and timings of QM_runner, and one run per scan of the series
+        """
+        db_fname = os.path.join(self.tmp_dir, "runner.db")
+        img_fnames = []
+        for i in range(2):
+            img_fnames.append(os.path.join(self.tmp_dir, "scan_{}.tif".format(i)))
+            save_stack(img_fnames[-1], create_phantom_stack(seed = i))
+        img, mu, sigma, SNR_CNR_df = QM_runner.QM_runner(img_fnames[0], 3, pct_stack_import = 50., engine = "histogram", results_db = db_fname)
+        self.assertEqual(SNR_CNR_df.shape, (6, 3)) # overlap metrics are only saved
+        saved_df = pd.read_csv(os.path.join(self.tmp_dir, "scan_0_results", "SNR_CNR_Results.csv"))
+        self.assertEqual(list(saved_df.columns), ["Gaussian_A", "Gaussian_B", "SNR", "CNR", "Bhattacharyya", "Overlap", "Threshold"])
+        QM_runner.QM_runner_series(img_fnames, 3, pct_stack_import = 50., engine = "histogram", results_db = db_fname)
+        runs_df = QM_db.query_runs(db_fname)
+        self.assertEqual(list(runs_df["img_fname"]), [os.path.abspath(img_fnames[0])] + [os.path.abspath(fname) for fname in img_fnames])
+        self.assertTrue(runs_df["time_fit"].iloc[0] > 0)
+        results_df = QM_db.export_results(db_fname, run_ids = runs_df.index[:1])
+        np.testing.assert_allclose(results_df["SNR"], SNR_CNR_df["SNR"])
+        np.testing.assert_allclose(results_df.drop_duplicates("Gaussian_A")["mu_A"], mu)
+        np.testing.assert_allclose(results_df["Overlap"], saved_df["Overlap"])
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_DB)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import sklearn.mixture
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+from unittest import mock
+import QM_histogram
+import GMM_em
+import GMM_fit
+import QM_runner
+from test_load import save_stack
+from test_histogram import create_phantom_stack
+
+class Test_Fit(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.stack = create_phantom_stack()
+        cls.histo = QM_histogram.histogram_from_image(cls.stack)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_select_n_gaussians(self):
+        """ Tests if BIC and AIC pick the number of Gaussians the phantom was drawn from
+        Raises
+        ------
+        AssertionError
+            3 Gaussians should be selected, with one row of scores per candidate
+        """
+        for criterion in ["bic", "aic"]:
+            GMM, scores = GMM_fit.select_n_gaussians(self.histo, 5, criterion, n_workers = 2)
+            self.assertEqual(GMM.n_components, 3)
+            self.assertEqual(list(scores.index), [1, 2, 3, 4, 5])
+            self.assertEqual(scores[criterion.upper()].idxmin(), 3)
+        with self.assertRaises(ValueError):
+            GMM_fit.select_n_gaussians(self.histo, 5, "unknown")
+
+    def test_auto(self):
+        """ Tests if n_gaussians = "auto" works with both engines and in the full workflow
+        Raises
+        ------
+        AssertionError
+            Auto fits should have 3 components and keep the score table, which QM_runner saves
+        """
+        img = self.stack.ravel()
+        GMM_sklearn = GMM_fit.GMM_fit(img, "auto", max_gaussians = 4)
+        GMM_histo = GMM_fit.GMM_fit(img, "auto", engine = "histogram", max_gaussians = 4)
+        self.assertEqual(GMM_sklearn.n_components, 3)
+        self.assertNotIsInstance(GMM_sklearn, GMM_em.GMMResult)
+        self.assertEqual(GMM_histo.n_components, 3)
+        self.assertEqual(len(GMM_histo.model_selection_), 4)
+
+        fname = os.path.join(self.tmp_dir, "phantom.tif")
+        save_stack(fname, self.stack)
+        img, mu, sigma, SNR_CNR_df = QM_runner.QM_runner(fname, "auto", pct_stack_import = 50., engine = "histogram", max_gaussians = 4)
+        self.assertEqual(mu.shape, (3,))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "phantom_results", "Model_Selection.csv")))
+
+    def test_multistart(self):
+        """ Tests if multi-start EM keeps the best start and abandons a poor user-provided start
+        Raises
+        ------
+        AssertionError
+            Multi-start fit should be at least as likely as a single start, and the poor start should be abandoned
+        """
+        x, counts = self.histo.bin_centres, self.histo.counts
+        GMM_single = GMM_em.fit_histogram(x, counts, 3)
+        GMM_multi = GMM_em.fit_histogram_multistart(x, counts, 3, n_init = 5, means_init = [250, 251, 252], n_workers = 2)
+        self.assertEqual(GMM_multi.n_init_, 5)
+        self.assertTrue(GMM_multi.n_abandoned_ >= 1)
+        self.assertTrue(GMM_multi.lower_bound_ >= GMM_single.lower_bound_ - 1e-3)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM_multi)[0], [40, 100, 160], rtol = 2e-2)
+
+        GMM_sklearn = GMM_fit.GMM_fit(self.stack, 3, n_init = 3)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM_sklearn)[0], GMM_fit.extract_GMM_results(GMM_multi)[0], rtol = 1e-2)
+
+    def test_coarse_to_fine(self):
+        """ Tests if refining a subsample fit on every voxel converges to the same model as fitting every voxel
+        Raises
+        ------
+        AssertionError
+            Means, standard deviations and weights should be at least as close to the fully converged model
+            as a fit from scratch, and within 3% of it, for 8-bit and 16-bit images fitted in float64
+        """
+        GMM_converged = GMM_em.fit_histogram(self.histo.bin_centres, self.histo.counts, 3, tol = 1e-8, max_iter = 1000)
+        GMM_cold = GMM_fit.GMM_fit(self.stack, 3)
+        GMM_staged = GMM_fit.GMM_fit_coarse_to_fine(self.stack, 3, n_coarse = 5000)
+        self.assertTrue(GMM_staged.n_iter_coarse_ > 0)
+        for converged_result, cold_result, staged_result in zip(*[GMM_fit.extract_GMM_results(GMM) for GMM in [GMM_converged, GMM_cold, GMM_staged]]):
+            np.testing.assert_allclose(staged_result, converged_result, rtol = 3e-2)
+            self.assertTrue(np.max(np.abs(staged_result - converged_result)) <= np.max(np.abs(cold_result - converged_result)))
+        self.assertEqual(GMM_fit.GMM_fit(self.stack, 3, engine = "coarse_to_fine").n_components, 3)
+
+        stack = self.stack.astype(np.uint16) * 200 # 16-bit grey values
+        GMM_converged = sklearn.mixture.GaussianMixture(n_components = 3, random_state = 3, tol = 1e-10, max_iter = 1000).fit(stack.reshape(-1,1).astype(np.float64))
+        GMM_cold = GMM_fit.GMM_fit(stack, 3)
+        GMM_staged = GMM_fit.GMM_fit_coarse_to_fine(stack, 3, n_coarse = 5000)
+        self.assertEqual(GMM_staged.means_.dtype, np.float64)
+        for converged_result, cold_result, staged_result in zip(*[GMM_fit.extract_GMM_results(GMM) for GMM in [GMM_converged, GMM_cold, GMM_staged]]):
+            np.testing.assert_allclose(staged_result, converged_result, rtol = 3e-2)
+            self.assertTrue(np.max(np.abs(staged_result - converged_result)) <= np.max(np.abs(cold_result - converged_result)))
+
+    def test_sklearn_dtype(self):
+        """ Tests if the sklearn engine fits 16-bit voxels in float64
+        Raises
+        ------
+        AssertionError
+            Fitted parameters should be float64 and equal those of a fit to a float64 copy of the image
+        """
+        stack = self.stack.astype(np.uint16) * 200 # 16-bit grey values
+        GMM = GMM_fit.GMM_fit(stack, 3)
+        GMM_float64 = GMM_fit.GMM_fit(stack.astype(np.float64), 3)
+        self.assertEqual(GMM.means_.dtype, np.float64)
+        for result, result_float64 in zip(GMM_fit.extract_GMM_results(GMM), GMM_fit.extract_GMM_results(GMM_float64)):
+            np.testing.assert_allclose(result, result_float64, rtol = 1e-10)
+
+    def test_user_init(self):
+        """ Tests if user-provided means, standard deviations and weights start the sklearn and histogram engines
+        Raises
+        ------
+        AssertionError
+            Fits started from the converged model should need at most 2 iterations and keep its means
+        """
+        mu, sigma, weights = GMM_fit.extract_GMM_results(GMM_fit.GMM_fit(self.stack, 3))
+        for engine in ["sklearn", "histogram"]:
+            GMM = GMM_fit.GMM_fit(self.stack, 3, mu, sigma, engine = engine, weights_init = weights)
+            self.assertTrue(GMM.n_iter_ <= 2)
+            np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[0], mu, rtol = 1e-2)
+        GMM = GMM_fit.GMM_fit(self.stack, 3, mu) # means only
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[0], mu, rtol = 1e-2)
+
+    def test_series(self):
+        """ Tests if warm-started series fits save EM iterations and give the same models as cold fits
+        Raises
+        ------
+        AssertionError
+            Later scans should use fewer iterations than the first, with means within 2% of cold fits
+        """
+        stacks = [create_phantom_stack(mu = (70 + i, 100 - i, 160 + i), sigma = (12, 15, 20), seed = i) for i in range(4)] # overlapping peaks
+        for warm_start in ["previous", "mean"]:
+            GMMs, report = GMM_fit.GMM_fit_series(iter(stacks), 3, warm_start, engine = "histogram")
+            self.assertEqual(list(report.index), [0, 1, 2, 3])
+            self.assertTrue(np.all(report["n_iter_saved"].iloc[1:] > 0))
+            for stack, GMM in zip(stacks, GMMs):
+                GMM_cold = GMM_fit.GMM_fit(stack, 3, engine = "histogram")
+                np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[0], GMM_fit.extract_GMM_results(GMM_cold)[0], rtol = 2e-2)
+
+        img_fnames = []
+        for i, stack in enumerate(stacks[:2]):
+            img_fnames.append(os.path.join(self.tmp_dir, "scan_{}.tif".format(i)))
+            save_stack(img_fnames[-1], stack)
+        report = QM_runner.QM_runner_series(img_fnames, 3, pct_stack_import = 50.)
+        self.assertEqual(list(report["img_fname"]), img_fnames)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "scan_1_results", "SNR_CNR_Results.csv")))
+
+    def test_batch(self):
+        """ Tests if batched EM gives every image the same model as fitting its histogram on its own
+        Raises
+        ------
+        AssertionError
+            Means, standard deviations and weights should match individual fits, including images with
+            different grey value ranges
+        """
+        stacks = [create_phantom_stack(shape = (4, 50, 60), mu = (40 + 5 * i, 100, 160 + 10 * i), seed = i) for i in range(6)]
+        mu, sigma, weights = GMM_fit.GMM_fit_batch(stacks, 3)
+        self.assertEqual(mu.shape, (6, 3))
+        for i, stack in enumerate(stacks):
+            GMM = GMM_fit.GMM_fit_histogram(QM_histogram.histogram_from_image(stack), 3)
+            for batch_result, result in zip([mu[i], sigma[i], weights[i]], GMM_fit.extract_GMM_results(GMM)):
+                np.testing.assert_allclose(batch_result, result, rtol = 1e-8)
+
+        histos = [QM_histogram.Histogram.for_dtype(np.float32, 0, 255, 128) for i in range(2)]
+        for histo, stack in zip(histos, stacks):
+            histo.add(stack.astype(np.float32))
+        mu_float = GMM_fit.GMM_fit_batch(histos, 3)[0]
+        np.testing.assert_allclose(mu_float, mu[:2], rtol = 2e-2)
+        with self.assertRaises(ValueError):
+            QM_histogram.histogram_matrix([histos[0], QM_histogram.Histogram.for_dtype(np.float32, 0, 200, 128)])
+
+    def test_chunked(self):
+        """ Tests if chunked voxel EM gives the same model as EM on the histogram, with bounded memory
+        Raises
+        ------
+        AssertionError
+            Chunked fits in float64 and float32 should match the histogram fit from the same start, and peak memory
+            should stay well below the size of an n_voxels * n_gaussians responsibility matrix
+        """
+        x, counts = self.histo.bin_centres, self.histo.counts.astype(np.float64)
+        params = GMM_em.init_histogram(x, counts, 3)
+        GMM_histo = GMM_em.fit_histogram(x, counts, 3, *params, tol = 1e-6, max_iter = 1000)
+        img = self.stack.ravel()
+        tracemalloc.start()
+        GMM_chunked = GMM_em.fit_voxels_chunked(img, *params, chunk_size = 1000, tol = 1e-6, max_iter = 1000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(GMM_chunked.n_iter_, GMM_histo.n_iter_)
+        self.assertAlmostEqual(GMM_chunked.lower_bound_, GMM_histo.lower_bound_)
+        for chunked_result, histo_result in zip(GMM_fit.extract_GMM_results(GMM_chunked), GMM_fit.extract_GMM_results(GMM_histo)):
+            np.testing.assert_allclose(chunked_result, histo_result, rtol = 1e-6)
+        self.assertTrue(peak < img.size * 3 * 8 / 4)
+
+        GMM_float32 = GMM_em.fit_voxels_chunked(img, *params, chunk_size = 1000, dtype = np.float32, tol = 1e-6, max_iter = 1000)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM_float32)[0], GMM_fit.extract_GMM_results(GMM_histo)[0], rtol = 1e-4)
+
+        GMM = GMM_fit.GMM_fit(self.stack, 3, engine = "chunked")
+        self.assertIsInstance(GMM, GMM_em.GMMResult)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[0], GMM_fit.extract_GMM_results(GMM_fit.GMM_fit(self.stack, 3, engine = "histogram"))[0], rtol = 1e-3)
+
+    def test_shared_histogram(self):
+        """ Tests if a precomputed histogram is used instead of binning the voxels again
+        Raises
+        ------
+        AssertionError
+            Fits given the histogram should not call histogram_from_image, and QM_runner should bin the voxels once
+            with every engine, automatic model selection, several starts and the cache
+        """
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        with mock.patch.object(QM_histogram, "histogram_from_image", side_effect = AssertionError("voxels binned again")):
+            for engine in ["sklearn", "histogram", "chunked"]:
+                GMM_fit.GMM_fit(self.stack, 3, engine = engine, n_init = 2, histo = self.histo)
+                GMM_fit.GMM_fit(self.stack, "auto", engine = engine, max_gaussians = 3, histo = self.histo)
+                GMM_fit.GMM_fit(self.stack, 3, engine = engine, use_cache = True, cache_dir = cache_dir, histo = self.histo)
+
+        fname = os.path.join(self.tmp_dir, "shared.tif")
+        save_stack(fname, self.stack)
+        for engine in ["sklearn", "chunked"]:
+            with mock.patch.object(QM_histogram, "histogram_from_image", wraps = QM_histogram.histogram_from_image) as histogram_from_image:
+                QM_runner.QM_runner(fname, "auto", engine = engine, max_gaussians = 3, n_init = 2)
+            self.assertEqual(histogram_from_image.call_count, 1)
+
+    def test_diagnostics(self):
+        """ Tests if convergence, data size and timing of a fit are recorded and saved as JSON
+        Raises
+        ------
+        AssertionError
+            Log-likelihood history should have one non-decreasing value per EM iteration, and the saved JSON
+            should match the returned diagnostics
+        """
+        x, counts = self.histo.bin_centres, self.histo.counts
+        for GMM in [GMM_em.fit_histogram(x, counts, 3), GMM_em.fit_histogram_multistart(x, counts, 3, n_init = 3, n_workers = 2),
+                GMM_fit.GMM_fit(self.stack, 3, engine = "chunked")]:
+            history = GMM.lower_bound_history_
+            self.assertEqual(len(history), GMM.n_iter_)
+            self.assertEqual(history[-1], GMM.lower_bound_)
+            self.assertTrue(np.all(np.diff(history) > -1e-10))
+        diagnostics = GMM_fit.fit_diagnostics(GMM_fit.GMM_fit(self.stack, 3), self.stack)
+        self.assertIsNone(diagnostics["lower_bound_history"])
+        self.assertEqual(diagnostics["n_voxels"], self.stack.size)
+        self.assertEqual(diagnostics["dtype"], "uint8")
+
+        fname = os.path.join(self.tmp_dir, "diagnostics.tif")
+        save_stack(fname, self.stack)
+        outputs = QM_runner.QM_runner(fname, 3, engine = "histogram", save_diagnostics = True, return_diagnostics = True)
+        diagnostics = outputs[-1]
+        self.assertEqual(len(outputs), 5)
+        self.assertEqual(set(diagnostics["timing"]), {"load", "fit", "extract", "save", "plot", "snr_cnr", "total"})
+        self.assertTrue(diagnostics["converged"])
+        with open(os.path.join(self.tmp_dir, "diagnostics_results", "fit_diagnostics.json")) as json_file:
+            self.assertEqual(json.load(json_file), json.loads(json.dumps(diagnostics)))
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Fit)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
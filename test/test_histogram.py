@@ -0,0 +1,233 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+import sklearn.mixture
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_load
+import QM_histogram
+import GMM_em
+import GMM_fit
+import QM_runner
+from test_load import save_stack
+
+def create_phantom_stack(shape = (20, 50, 60), mu = (40, 100, 160), sigma = (5, 15, 20), seed = 0):
+    """ Creates an 8-bit stack with grey values drawn from a known Gaussian mixture
+    Parameters
+    ----------
+    shape : tuple
+        Dimensions of the stack
+    mu : tuple
+        Means of each Gaussian
+    sigma : tuple
+        Standard deviations of each Gaussian
+    seed : int
+        Seed for the random number generator
+    Returns
+    -------
+    numpy array
+        uint8 array of the given shape
+    """
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, len(mu), np.prod(shape))
+    img = rng.normal(np.array(mu)[labels], np.array(sigma)[labels])
+    return np.clip(np.round(img), 0, 255).astype(np.uint8).reshape(shape)
+
+class Test_Histogram(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.stack = create_phantom_stack()
+        cls.fname = os.path.join(cls.tmp_dir, "phantom.tif")
+        save_stack(cls.fname, cls.stack)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_counts(self):
+        """ Tests if the streamed histogram counts every imported voxel
+        Raises
+        ------
+        AssertionError
+            Histogram counts should equal the bincount of voxels loaded by QM_load
+        """
+        img = QM_load.QM_load(self.fname, pct_stack_import = 50.)
+        histo = QM_histogram.QM_load_histogram(self.fname, pct_stack_import = 50.)
+        self.assertEqual(histo.n_voxels, len(img))
+        bincount = np.bincount(img, minlength = 256)
+        np.testing.assert_array_equal(histo.counts, bincount[histo.bin_centres.astype(int)])
+
+    @unittest.skipIf(resource is None, "resource limits are not available on this platform")
+    def test_memmap_many_pages(self):
+        """ Tests if a stack with more pages than the open file limit can be streamed through memory maps
+        Raises
+        ------
+        AssertionError
+            Histogram should count every voxel of the stack under a file descriptor limit smaller than the number of pages
+        """
+        stack = create_phantom_stack((600, 4, 5))
+        fname = os.path.join(self.tmp_dir, "many_pages.tif")
+        save_stack(fname, stack)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, soft), hard))
+        try:
+            histo = QM_histogram.QM_load_histogram(fname, pct_stack_import = 100., use_memmap = True)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        np.testing.assert_array_equal(histo.counts, QM_histogram.histogram_from_image(stack).counts)
+
+    def test_image_sequence(self):
+        """ Tests if slices of an image sequence are streamed into the histogram
+        Raises
+        ------
+        AssertionError
+            Histogram of the image sequence should equal the histogram of the stack
+        """
+        sequence_dir = os.path.join(self.tmp_dir, "slices")
+        os.mkdir(sequence_dir)
+        for i, img_slice in enumerate(self.stack):
+            save_stack(os.path.join(sequence_dir, "{:03d}.tif".format(i)), img_slice[np.newaxis])
+        histo_stack = QM_histogram.QM_load_histogram(self.fname)
+        histo_sequence = QM_histogram.QM_load_histogram(sequence_dir, n_workers = 3)
+        np.testing.assert_array_equal(histo_sequence.counts, histo_stack.counts)
+
+    def test_specify_gv(self):
+        """ Tests if grey value limits give the same voxels as QM_load with specify_gv == True
+        Raises
+        ------
+        AssertionError
+            Histogram should only count voxels inside (min_GV, max_GV)
+        """
+        img = QM_load.QM_load(self.fname, 20, 200, True, 100.)
+        histo = QM_histogram.QM_load_histogram(self.fname, 20, 200, True, 100.)
+        self.assertEqual(histo.n_voxels, len(img))
+        self.assertTrue(histo.bin_centres[0] > 20 and histo.bin_centres[-1] < 200)
+
+    def test_roi(self):
+        """ Tests if the streamed histogram only counts voxels inside the bounding box
+        Raises
+        ------
+        AssertionError
+            Histogram should equal the bincount of voxels loaded by QM_load with the same bounding box
+        """
+        roi = (2, 18, 10, 40, None, 30)
+        img = QM_load.QM_load(self.fname, pct_stack_import = 100., roi = roi)
+        histo = QM_histogram.QM_load_histogram(self.fname, roi = roi)
+        self.assertEqual(histo.n_voxels, 16 * 30 * 30)
+        np.testing.assert_array_equal(histo.counts, np.bincount(img, minlength = 256)[histo.bin_centres.astype(int)])
+
+    def test_native_dtypes(self):
+        """ Tests if 16-bit and float32 stacks are loaded, binned and fitted without promotion to float64
+        Raises
+        ------
+        AssertionError
+            Voxels should keep their dtype, float32 bins should span the detected grey value range and
+            fits in float32 should agree with the histogram engine
+        """
+        stack_16bit = self.stack.astype(np.uint16) * 200 + 1000
+        fname_16bit = os.path.join(self.tmp_dir, "phantom_16bit.tif")
+        fname_float = os.path.join(self.tmp_dir, "phantom_float.tif")
+        save_stack(fname_16bit, stack_16bit)
+        save_stack(fname_float, stack_16bit.astype(np.float32) / 1000.)
+
+        img_16bit = QM_load.QM_load(fname_16bit, pct_stack_import = 100.)
+        self.assertEqual(img_16bit.dtype, np.uint16)
+        self.assertEqual(GMM_fit.fit_dtype(img_16bit.dtype), np.float32)
+        histo_16bit = QM_histogram.QM_load_histogram(fname_16bit)
+        self.assertTrue(histo_16bit.integer)
+        self.assertEqual(histo_16bit.n_voxels, stack_16bit.size)
+        mu_sklearn = GMM_fit.extract_GMM_results(GMM_fit.GMM_fit(img_16bit, 3))[0]
+        mu_histo = GMM_fit.extract_GMM_results(GMM_fit.GMM_fit(histo_16bit, 3))[0]
+        np.testing.assert_allclose(mu_sklearn, mu_histo, rtol = 1e-2)
+
+        img_float = QM_load.QM_load(fname_float, pct_stack_import = 100.)
+        self.assertEqual(img_float.dtype, np.float32)
+        histo_float = QM_histogram.QM_load_histogram(fname_float, n_bins = 512)
+        self.assertEqual(histo_float.n_voxels, img_float.size)
+        self.assertAlmostEqual(histo_float.bin_edges[0], img_float.min(), places = 5)
+        self.assertAlmostEqual(histo_float.bin_edges[-1], img_float.max(), places = 5)
+        self.assertEqual(QM_load.QM_load(fname_float, None, 10., True, 100.).max(), img_float[img_float < 10.].max())
+
+        self.assertFalse(QM_histogram.Histogram.for_dtype(np.int32, 0, 10**6, n_bins = 100).integer)
+
+    def test_rebin(self):
+        """ Tests if rebinning keeps every voxel
+        Raises
+        ------
+        AssertionError
+            Rebinned histogram should have at most n_bins bins and the same total count
+        """
+        histo = QM_histogram.QM_load_histogram(self.fname)
+        rebinned = histo.rebin(50)
+        self.assertTrue(len(rebinned.counts) <= 50)
+        self.assertEqual(rebinned.n_voxels, histo.n_voxels)
+        self.assertAlmostEqual(np.sum(rebinned.density() * np.diff(rebinned.bin_edges)), 1.)
+
+    def test_fit_matches_voxels(self):
+        """ Tests if EM on histogram counts converges to the same model as sklearn on voxels
+        Raises
+        ------
+        AssertionError
+            Fitted means, standard deviations and weights should agree to within 0.5%
+        """
+        img = QM_load.QM_load(self.fname, pct_stack_import = 100.)
+        histo = QM_histogram.QM_load_histogram(self.fname, pct_stack_import = 100.)
+        GMM_voxels = sklearn.mixture.GaussianMixture(n_components = 3, random_state = 3, tol = 1e-8, max_iter = 1000).fit(img.reshape(-1,1).astype(float))
+        GMM_histo = GMM_em.fit_histogram(histo.bin_centres, histo.counts, 3, tol = 1e-8, max_iter = 1000)
+        for voxel_result, histo_result in zip(GMM_fit.extract_GMM_results(GMM_voxels), GMM_fit.extract_GMM_results(GMM_histo)):
+            np.testing.assert_allclose(histo_result, voxel_result, rtol = 5e-3)
+
+    def test_engine(self):
+        """ Tests if the histogram engine can be selected for voxels loaded by QM_load
+        Raises
+        ------
+        AssertionError
+            Histogram engine should return a GMMResult with means within 2% of the sklearn engine
+        """
+        img = QM_load.QM_load(self.fname, pct_stack_import = 100.)
+        GMM_sklearn = GMM_fit.GMM_fit(img, 3)
+        GMM_histo = GMM_fit.GMM_fit(img, 3, engine = "histogram")
+        self.assertIsInstance(GMM_histo, GMM_em.GMMResult)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM_histo)[0], GMM_fit.extract_GMM_results(GMM_sklearn)[0], rtol = 2e-2)
+        with self.assertRaises(ValueError):
+            GMM_fit.GMM_fit(img, 3, engine = "unknown")
+
+    def test_saved_histogram(self):
+        """ Tests if the histogram of a run is saved once and results can be replotted from it without the image
+        Raises
+        ------
+        AssertionError
+            Saved histogram should equal the histogram of the stack, and fitted results should be read back
+        """
+        histo_float = QM_histogram.histogram_from_image(self.stack.astype(np.float32) / 100.)
+        fname_float = os.path.join(self.tmp_dir, "float_histogram.npz")
+        histo_float.save(fname_float)
+        loaded = QM_histogram.Histogram.load(fname_float)
+        self.assertFalse(loaded.integer)
+        np.testing.assert_array_equal(loaded.bin_edges, histo_float.bin_edges)
+        np.testing.assert_array_equal(loaded.counts, histo_float.counts)
+
+        fname = os.path.join(self.tmp_dir, "saved.tif")
+        save_stack(fname, self.stack)
+        img, mu, sigma, SNR_CNR_df = QM_runner.QM_runner(fname, 3, pct_stack_import = 100., save_histogram = True)
+        histo = QM_histogram.load_saved_histogram(fname)
+        self.assertTrue(histo.integer)
+        np.testing.assert_array_equal(histo.counts, QM_histogram.histogram_from_image(self.stack).counts)
+
+        os.remove(fname) # replot from the results directory only
+        GMM = GMM_fit.load_GMM_results(fname)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[0], mu)
+        np.testing.assert_allclose(GMM_fit.extract_GMM_results(GMM)[1], sigma)
+        os.remove(os.path.join(self.tmp_dir, "saved_results", "histo.png"))
+        GMM_fit.plot_GMM_fit(histo, GMM, fname)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "saved_results", "histo.png")))
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Histogram)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
@@ -0,0 +1,296 @@
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import numpy as np
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+from PIL import Image, TiffImagePlugin
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+from unittest import mock
+import QM_load
+
+def save_stack(fname, stack, **kwargs):
+    """ Saves a 3D numpy array as a multi-page TIFF with PIL
+    Parameters
+    ----------
+    fname : str
+        Filename to save stack to
+    stack : numpy array
+        3D numpy array of image, slices along the first axis
+    **kwargs
+        Passed to PIL.Image.save, e.g. compression = "tiff_lzw"
+    Returns
+    -------
+    None
+    """
+    frames = [Image.fromarray(img_slice) for img_slice in stack]
+    frames[0].save(fname, save_all = True, append_images = frames[1:], **kwargs)
+
+def save_big_endian_stack(fname, stack):
+    """ Saves a 3D uint16 numpy array as an uncompressed, big-endian ("MM") multi-page TIFF, which PIL cannot write
+    Parameters
+    ----------
+    fname : str
+        Filename to save stack to
+    stack : numpy array
+        3D uint16 numpy array of image, slices along the first axis
+    Returns
+    -------
+    None
+    """
+    n_slices, height, width = stack.shape
+    page_bytes = height * width * 2
+    ifd_bytes = 2 + 9 * 12 + 4
+    with open(fname, "wb") as tiff_file:
+        tiff_file.write(b"MM" + struct.pack(">HI", 42, 8))
+        for i, img_slice in enumerate(stack):
+            ifd_offset = 8 + i * (ifd_bytes + page_bytes)
+            next_offset = 0 if i == n_slices - 1 else ifd_offset + ifd_bytes + page_bytes
+            tags = [(256, 3, width), (257, 3, height), (258, 3, 16), (259, 3, 1), (262, 3, 1),
+                (273, 4, ifd_offset + ifd_bytes), (277, 3, 1), (278, 3, height), (279, 4, page_bytes)]
+            tiff_file.write(struct.pack(">H", len(tags)))
+            for tag, field_type, value in tags: # SHORT values are left-aligned in the 4 byte value field
+                tiff_file.write(struct.pack(">HHI", tag, field_type, 1) + (struct.pack(">HH", value, 0) if field_type == 3 else struct.pack(">I", value)))
+            tiff_file.write(struct.pack(">I", next_offset))
+            tiff_file.write(img_slice.astype(">u2").tobytes())
+
+class Test_Load(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.stack_8bit = rng.randint(0, 256, (20, 30, 40)).astype(np.uint8)
+        cls.stack_16bit = rng.randint(0, 65536, (20, 30, 40)).astype(np.uint16)
+        cls.fname_8bit = os.path.join(cls.tmp_dir, "stack_8bit.tif")
+        cls.fname_16bit = os.path.join(cls.tmp_dir, "stack_16bit.tif")
+        cls.fname_lzw = os.path.join(cls.tmp_dir, "stack_lzw.tif")
+        save_stack(cls.fname_8bit, cls.stack_8bit)
+        save_stack(cls.fname_16bit, cls.stack_16bit)
+        save_stack(cls.fname_lzw, cls.stack_16bit, compression = "tiff_lzw")
+        cls.sequence_dir = os.path.join(cls.tmp_dir, "slices")
+        os.mkdir(cls.sequence_dir)
+        for i, img_slice in enumerate(cls.stack_16bit):
+            Image.fromarray(img_slice).save(os.path.join(cls.sequence_dir, "slice_{}.tif".format(i)))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_slice_indices(self):
+        """ Tests if slices are evenly spaced through the stack
+        Raises
+        ------
+        AssertionError
+            10% of a 20 slice stack should be slices 6 and 13
+        """
+        self.assertEqual(list(QM_load.stack_slice_indices(20, 10.)), [6, 13], "Slices should be evenly spaced")
+        self.assertEqual(list(QM_load.stack_slice_indices(1, 10.)), [0], "Single slice images should import slice 0")
+
+    def test_memmap_matches_PIL(self):
+        """ Tests if memory-mapped loading gives the same voxels as decoding with PIL
+        Raises
+        ------
+        AssertionError
+            Memory-mapped and PIL loaded images should be identical, with the same dtype, for little-endian and
+            big-endian stacks, and ValueError should be raised if no slices are selected
+        """
+        for fname in [self.fname_8bit, self.fname_16bit]:
+            img_PIL = QM_load.QM_load(fname, pct_stack_import = 50.)
+            img_memmap = QM_load.QM_load(fname, pct_stack_import = 50., use_memmap = True)
+            self.assertEqual(img_memmap.dtype, img_PIL.dtype, "dtype should be preserved")
+            np.testing.assert_array_equal(img_memmap, img_PIL)
+
+        fname_big_endian = os.path.join(self.tmp_dir, "stack_big_endian.tif")
+        save_big_endian_stack(fname_big_endian, self.stack_16bit)
+        img_memmap = QM_load.QM_load(fname_big_endian, pct_stack_import = 50., use_memmap = True)
+        self.assertEqual(img_memmap.dtype, np.uint16) # converted to native byte order
+        np.testing.assert_array_equal(img_memmap, QM_load.QM_load(fname_big_endian, pct_stack_import = 50.))
+        np.testing.assert_array_equal(img_memmap, self.stack_16bit[QM_load.stack_slice_indices(20, 50.)].ravel())
+        with self.assertRaises(ValueError):
+            QM_load.QM_load(self.fname_16bit, pct_stack_import = 0., use_memmap = True)
+
+    def test_memmap_views(self):
+        """ Tests if QM_load_memmap returns slices of the stack as memory-mapped arrays
+        Raises
+        ------
+        AssertionError
+            Each memory-mapped page should equal the corresponding slice of the stack
+        """
+        slice_indices = QM_load.stack_slice_indices(20, 25.)
+        slices = QM_load.QM_load_memmap(self.fname_16bit, slice_indices)
+        for img_slice, index in zip(slices, slice_indices):
+            self.assertIsInstance(img_slice, np.memmap)
+            np.testing.assert_array_equal(img_slice, self.stack_16bit[index])
+
+    @unittest.skipIf(resource is None, "resource limits are not available on this platform")
+    def test_memmap_many_pages(self):
+        """ Tests if a stack with more pages than the open file limit can be memory-mapped
+        Raises
+        ------
+        AssertionError
+            All pages should be mapped and loaded under a file descriptor limit smaller than the number of pages
+        """
+        stack = np.random.RandomState(1).randint(0, 65536, (600, 4, 5)).astype(np.uint16)
+        fname = os.path.join(self.tmp_dir, "many_pages.tif")
+        save_stack(fname, stack)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, soft), hard))
+        try:
+            np.testing.assert_array_equal(np.stack(QM_load.QM_load_memmap(fname, np.arange(600))), stack)
+            np.testing.assert_array_equal(QM_load.QM_load(fname, pct_stack_import = 100., use_memmap = True), stack.ravel())
+            self.assertEqual(len(QM_load.QM_load(fname, n_samples = 5000)), 5000)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_parallel_decoding(self):
+        """ Tests if decoding a compressed stack with several threads gives the same voxels as one thread
+        Raises
+        ------
+        AssertionError
+            Slices decoded concurrently should be assembled in the order of the stack
+        """
+        slice_indices = QM_load.stack_slice_indices(20, 50.)
+        img_serial = QM_load.read_slices(self.fname_lzw, slice_indices, n_workers = 1)
+        img_parallel = QM_load.read_slices(self.fname_lzw, slice_indices, n_workers = 4)
+        np.testing.assert_array_equal(img_serial, self.stack_16bit[slice_indices])
+        np.testing.assert_array_equal(img_parallel, self.stack_16bit[slice_indices])
+
+    def test_image_sequence(self):
+        """ Tests if a directory or glob pattern of per-slice images loads like the equivalent stack
+        Raises
+        ------
+        AssertionError
+            Slices should be sorted in natural order and evenly spaced as for a multi-page stack
+        """
+        img_stack = QM_load.QM_load(self.fname_16bit, pct_stack_import = 25.)
+        for img_fname in [self.sequence_dir, os.path.join(self.sequence_dir, "slice_*.tif")]:
+            self.assertEqual(QM_load.get_n_slices(img_fname), 20)
+            np.testing.assert_array_equal(QM_load.QM_load(img_fname, pct_stack_import = 25.), img_stack)
+            np.testing.assert_array_equal(QM_load.QM_load(img_fname, pct_stack_import = 25., use_memmap = True), img_stack)
+        self.assertEqual(QM_load.get_results_dir(self.sequence_dir + os.sep), self.sequence_dir + "_results")
+
+    def test_raw_volume(self):
+        """ Tests if raw volumes load like the equivalent stack, from a sidecar header or explicit description
+        Raises
+        ------
+        AssertionError
+            Raw volume should give the same voxels as the TIFF stack for each header format and byte order
+        """
+        img_stack = QM_load.QM_load(self.fname_16bit, pct_stack_import = 25.)
+
+        raw_fname = os.path.join(self.tmp_dir, "volume.raw")
+        with open(raw_fname, "wb") as f:
+            f.write(b"\x00" * 16) # header bytes before voxel data
+            self.stack_16bit.astype(">u2").tofile(f)
+        with open(raw_fname + ".txt", "w") as f:
+            f.write("dims = 40 30 20\ndtype = uint16\nbyte_order = big\nheader_offset = 16\n")
+        np.testing.assert_array_equal(QM_load.QM_load(raw_fname, pct_stack_import = 25.), img_stack)
+
+        vol_fname = os.path.join(self.tmp_dir, "volume.vol")
+        self.stack_16bit.astype("<u2").tofile(vol_fname)
+        with open(os.path.join(self.tmp_dir, "volume.mhd"), "w") as f:
+            f.write("NDims = 3\nDimSize = 40 30 20\nElementType = MET_USHORT\nElementByteOrderMSB = False\nHeaderSize = -1\n")
+        np.testing.assert_array_equal(QM_load.QM_load(vol_fname, pct_stack_import = 25.), img_stack)
+
+        raw_header = {"shape": (20, 30, 40), "dtype": "uint16", "byte_order": "little", "header_offset": 0}
+        self.assertEqual(QM_load.get_n_slices(vol_fname, raw_header), 20)
+        np.testing.assert_array_equal(QM_load.QM_load(vol_fname, pct_stack_import = 25., raw_header = raw_header), img_stack)
+
+    def test_sample_voxels(self):
+        """ Tests if stratified sampling draws a fixed, reproducible number of voxels from every slice
+        Raises
+        ------
+        AssertionError
+            Sample should have n_samples voxels of the image dtype, be identical for the same seed and
+            identical whether the stack is memory-mapped or decoded
+        """
+        img_sampled = QM_load.QM_load(self.fname_16bit, n_samples = 1000)
+        self.assertEqual(img_sampled.shape, (1000,))
+        self.assertEqual(img_sampled.dtype, np.uint16)
+        np.testing.assert_array_equal(QM_load.QM_load(self.fname_16bit, n_samples = 1000), img_sampled)
+        np.testing.assert_array_equal(QM_load.QM_load(self.fname_lzw, n_samples = 1000), img_sampled)
+        for i in range(20): # 50 voxels drawn from each slice
+            self.assertTrue(np.all(np.isin(img_sampled[50 * i:50 * (i + 1)], self.stack_16bit[i])))
+        self.assertFalse(np.array_equal(QM_load.QM_load(self.fname_16bit, n_samples = 1000, random_state = 4), img_sampled))
+
+        png_dir = os.path.join(self.tmp_dir, "png_slices") # cannot be memory-mapped, slices are decoded
+        os.mkdir(png_dir)
+        for i, img_slice in enumerate(self.stack_16bit):
+            Image.fromarray(img_slice).save(os.path.join(png_dir, "slice_{}.png".format(i)))
+        np.testing.assert_array_equal(QM_load.QM_load(png_dir, n_samples = 1000), img_sampled)
+        with self.assertRaises(ValueError):
+            QM_load.tiff_page_layout(os.path.join(png_dir, "slice_0.png"), [0])
+
+    def test_specify_gv(self):
+        """ Tests if grey value limits keep only voxels inside (min_GV, max_GV) without changing dtype
+        Raises
+        ------
+        AssertionError
+            Filtered voxels should match masking the stack, for decoded, memory-mapped and sampled images
+        """
+        slice_indices = QM_load.stack_slice_indices(20, 50.)
+        expected = self.stack_8bit[slice_indices].ravel()
+        expected = expected[(expected > 50) & (expected < 200)]
+        for use_memmap in [False, True]:
+            img = QM_load.QM_load(self.fname_8bit, 50, 200, True, 50., use_memmap = use_memmap)
+            self.assertEqual(img.dtype, np.uint8)
+            np.testing.assert_array_equal(img, expected)
+        img_sampled = QM_load.QM_load(self.fname_8bit, n_samples = 1000)
+        np.testing.assert_array_equal(QM_load.QM_load(self.fname_8bit, 50, 200, True, n_samples = 1000), img_sampled[(img_sampled > 50) & (img_sampled < 200)])
+
+    def test_roi(self):
+        """ Tests if cropping to a bounding box while reading gives the same voxels as cropping the stack
+        Raises
+        ------
+        AssertionError
+            Cropped voxels should match for decoded, compressed, memory-mapped, image sequence and raw volumes,
+            uncompressed TIFFs should not be decoded, sampled voxels should all lie inside the bounding box and
+            empty bounding boxes should raise ValueError
+        """
+        roi = (4, 16, 5, 20, 10, None)
+        slice_indices = QM_load.roi_slice_indices(20, 50., roi)
+        self.assertEqual(list(slice_indices), [5, 7, 9, 10, 12, 14])
+        expected = self.stack_16bit[slice_indices, 5:20, 10:].ravel()
+        raw_fname = os.path.join(self.tmp_dir, "roi.raw")
+        self.stack_16bit.tofile(raw_fname)
+        raw_header = {"shape": (20, 30, 40), "dtype": "uint16", "byte_order": "little", "header_offset": 0}
+        for img_fname in [self.fname_16bit, self.fname_lzw, self.sequence_dir]:
+            np.testing.assert_array_equal(QM_load.QM_load(img_fname, pct_stack_import = 50., roi = roi), expected)
+        np.testing.assert_array_equal(QM_load.QM_load(self.fname_16bit, pct_stack_import = 50., use_memmap = True, roi = roi), expected)
+        np.testing.assert_array_equal(QM_load.QM_load(raw_fname, pct_stack_import = 50., raw_header = raw_header, roi = roi), expected)
+        with mock.patch.object(TiffImagePlugin.TiffImageFile, "load", side_effect = AssertionError("slice decoded")):
+            for img_fname in [self.fname_16bit, self.sequence_dir]: # only the rows inside roi are read
+                np.testing.assert_array_equal(QM_load.QM_load(img_fname, pct_stack_import = 50., roi = roi), expected)
+                img_slices = list(QM_load.iter_slices(img_fname, slice_indices, crop = QM_load.roi_slices(roi)[1:]))
+                np.testing.assert_array_equal(np.ravel(img_slices), expected)
+
+        img_sampled = QM_load.QM_load(self.fname_16bit, n_samples = 600, roi = roi)
+        np.testing.assert_array_equal(QM_load.QM_load(self.fname_lzw, n_samples = 600, roi = roi), img_sampled)
+        for i in range(12): # 50 voxels drawn from each slice inside the bounding box
+            self.assertTrue(np.all(np.isin(img_sampled[50 * i:50 * (i + 1)], self.stack_16bit[4 + i, 5:20, 10:])))
+        with self.assertRaises(ValueError):
+            QM_load.QM_load(self.fname_16bit, roi = (25, None, None, None, None, None))
+        for empty_roi in [(None, None, 10, 10, None, None), (None, None, None, None, -5, -10), (None, None, 10, -25, None, None)]:
+            for img_fname in [self.fname_16bit, self.fname_lzw]:
+                with self.assertRaises(ValueError):
+                    QM_load.QM_load(img_fname, roi = empty_roi)
+                with self.assertRaises(ValueError):
+                    QM_load.QM_load(img_fname, n_samples = 600, roi = empty_roi)
+
+    def test_memmap_compressed(self):
+        """ Tests if compressed stacks are rejected by the memory-mapped loader
+        Raises
+        ------
+        AssertionError
+            ValueError should be raised for LZW compressed stacks
+        """
+        with self.assertRaises(ValueError):
+            QM_load.QM_load(self.fname_lzw, use_memmap = True)
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Load)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_histogram
+import QM_map
+import GMM_em
+import GMM_fit
+from test_load import save_stack
+from test_histogram import create_phantom_stack
+
+class Test_Map(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        # grey values drift up by 10 in each slab of 5 slices
+        cls.stack = np.concatenate([create_phantom_stack((5, 50, 60), mu = (40 + 10 * i, 100 + 10 * i, 160 + 10 * i), seed = i) for i in range(4)])
+        cls.fname = os.path.join(cls.tmp_dir, "drift.tif")
+        save_stack(cls.fname, cls.stack)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_block_histograms(self):
+        """ Tests if every voxel is counted once, in the histogram of the block it lies in
+        Raises
+        ------
+        AssertionError
+            Each block histogram should equal the histogram of that block of the stack
+        """
+        histo, block_shape, origin = QM_map.accumulate_block_histograms(self.fname, (10, 20, None), roi = (None, None, 5, None, None, None))
+        self.assertEqual(block_shape, (10, 20, 60))
+        self.assertEqual(origin, (0, 5, 0))
+        self.assertEqual(histo.counts.shape[:3], (2, 3, 1))
+        self.assertTrue(histo.integer)
+        for z in range(2):
+            for y in range(3):
+                block = self.stack[10 * z:10 * (z + 1), 5 + 20 * y:5 + 20 * (y + 1)]
+                expected = np.bincount(block.ravel(), minlength = 256)[histo.bin_centres.astype(int)]
+                np.testing.assert_array_equal(histo.counts[z, y, 0], expected)
+
+    def test_drift(self):
+        """ Tests if slab-wise fits follow the grey value drift along the stack
+        Raises
+        ------
+        AssertionError
+            Means of each slab should be within 2% of the phantom means, and SNR and CNR should match QM_calc
+        """
+        quality_map = QM_map.QM_map(self.fname, 3, block_shape = (5, None, None), save_results = False)
+        self.assertEqual(quality_map["mu"].shape, (4, 1, 1, 3))
+        self.assertTrue(np.all(quality_map["converged"]))
+        for i in range(4):
+            np.testing.assert_allclose(quality_map["mu"][i, 0, 0], [40 + 10 * i, 100 + 10 * i, 160 + 10 * i], rtol = 2e-2)
+        mu, sigma = quality_map["mu"][2, 0, 0], quality_map["sigma"][2, 0, 0]
+        self.assertAlmostEqual(quality_map["SNR"][2, 0, 0, 1, 0], mu[1] / sigma[0])
+        self.assertAlmostEqual(quality_map["CNR"][2, 0, 0, 2, 1], abs(mu[2] - mu[1]) / np.sqrt(sigma[2]**2 + sigma[1]**2))
+        self.assertTrue(np.isnan(quality_map["SNR"][2, 0, 0, 1, 1]))
+
+    def test_single_block(self):
+        """ Tests if a map with one block equals the global histogram fit, and small blocks are left unfitted
+        Raises
+        ------
+        AssertionError
+            Single block should match a converged histogram fit of the whole stack, blocks below min_voxels should be NaN,
+            and the origin should resolve negative roi bounds
+        """
+        stack = create_phantom_stack()
+        fname = os.path.join(self.tmp_dir, "phantom.tif")
+        save_stack(fname, stack)
+        quality_map = QM_map.QM_map(fname, 3)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "phantom_results", "Quality_Map.npz")))
+        histo = QM_histogram.histogram_from_image(stack)
+        GMM = GMM_em.fit_histogram(histo.bin_centres, histo.counts, 3, tol = 1e-8, max_iter = 1000)
+        mu, sigma, weights = GMM_fit.extract_GMM_results(GMM)
+        np.testing.assert_allclose(quality_map["mu"][0, 0, 0], mu, rtol = 1e-2)
+        np.testing.assert_allclose(quality_map["sigma"][0, 0, 0], sigma, rtol = 1e-2)
+
+        quality_map = QM_map.QM_map(self.fname, 3, block_shape = (20, 25, 60), min_voxels = 20 * 25 * 60, roi = (None, None, None, 45, None, None), save_results = False)
+        np.testing.assert_array_equal(quality_map["n_voxels"].ravel(), [20 * 25 * 60, 20 * 20 * 60])
+        self.assertFalse(np.any(np.isnan(quality_map["mu"][0, 0])))
+        self.assertTrue(np.all(np.isnan(quality_map["mu"][0, 1])))
+        quality_map = QM_map.QM_map(self.fname, 3, block_shape = (5, None, None), roi = (-10, None, None, -20, 10, -10), save_results = False)
+        np.testing.assert_array_equal(quality_map["origin"], [10, 0, 10]) # negative bounds count from the end
+        np.testing.assert_array_equal(quality_map["n_voxels"].ravel(), [5 * 30 * 40] * 2)
+
+    def test_float(self):
+        """ Tests if floating point stacks are binned into equal width bins across their grey value range
+        Raises
+        ------
+        AssertionError
+            Means of each slab should follow the drift of the scaled phantom
+        """
+        fname_float = os.path.join(self.tmp_dir, "drift_float.tif")
+        save_stack(fname_float, self.stack.astype(np.float32) / 100.)
+        quality_map = QM_map.QM_map(fname_float, 3, block_shape = (5, None, None), save_results = False)
+        for i in range(4):
+            np.testing.assert_allclose(quality_map["mu"][i, 0, 0], [0.4 + 0.1 * i, 1. + 0.1 * i, 1.6 + 0.1 * i], rtol = 2e-2)
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Map)
+# unittest.TextTestRunner(verbosity = 2).run(suite)
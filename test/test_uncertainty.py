@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.getcwd(), "main"))
+import unittest
+import QM_histogram
+import QM_uncertainty
+import QM_runner
+import GMM_fit
+from test_load import save_stack
+from test_histogram import create_phantom_stack
+
+class Test_Uncertainty(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.stack = create_phantom_stack()
+        cls.histo = QM_histogram.histogram_from_image(cls.stack)
+        cls.GMM = GMM_fit.GMM_fit(cls.histo, 3)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_fisher(self):
+        """ Tests if the Fisher information gives the standard error of the mean of well separated Gaussians
+        Raises
+        ------
+        AssertionError
+            Standard errors of the means should be within 5% of sigma / sqrt(number of voxels in the Gaussian)
+        """
+        histo = QM_histogram.histogram_from_image(create_phantom_stack(sigma = (4, 5, 6)))
+        GMM = QM_uncertainty.refine_GMM(histo, GMM_fit.GMM_fit(histo, 3))
+        mu, sigma, weights, covariance = QM_uncertainty.parameter_covariance(histo, GMM)
+        self.assertEqual(covariance.shape, (8, 8))
+        np.testing.assert_allclose(np.sqrt(np.diag(covariance)[:3]), sigma / np.sqrt(weights * histo.n_voxels), rtol = 5e-2)
+
+    def test_bootstrap(self):
+        """ Tests if bootstrap and Fisher information standard errors of SNR and CNR agree
+        Raises
+        ------
+        AssertionError
+            Bootstrap spread of SNR and CNR should be within 30% of the delta method standard errors
+        """
+        mu_boot, sigma_boot, weights_boot = QM_uncertainty.bootstrap_GMM(self.histo, self.GMM, n_boot = 200)
+        self.assertEqual(mu_boot.shape, (200, 3))
+        SNR_boot, CNR_boot = QM_uncertainty.QM_calc.SNR_CNR(mu_boot, sigma_boot)
+        mu, sigma, weights, covariance = QM_uncertainty.parameter_covariance(self.histo, QM_uncertainty.refine_GMM(self.histo, self.GMM))
+        SNR_se, CNR_se = QM_uncertainty.SNR_CNR_standard_errors(mu, sigma, covariance)
+        off_diagonal = ~np.eye(3, dtype = bool)
+        np.testing.assert_allclose(np.std(SNR_boot, axis = 0)[off_diagonal], SNR_se[off_diagonal], rtol = 0.3)
+        np.testing.assert_allclose(np.std(CNR_boot, axis = 0)[off_diagonal], CNR_se[off_diagonal], rtol = 0.3)
+
+    def test_bootstrap_16bit(self):
+        """ Tests if 16-bit histograms are rebinned before resampling without changing the bootstrap spread
+        Raises
+        ------
+        AssertionError
+            Bootstrap of a histogram with one bin per 16-bit grey value should take seconds, and the spread of
+            the means should be within 30% of the Fisher information standard errors of the full histogram.
+            Bootstrap and Fisher intervals should share their SNR and CNR and agree within 1%
+        """
+        rng = np.random.RandomState(0)
+        labels = rng.randint(0, 3, 500000)
+        img = np.round(rng.normal(np.array([10000, 30000, 45000])[labels], np.array([2000, 4000, 5000])[labels])).astype(np.uint16)
+        histo = QM_histogram.histogram_from_image(img)
+        self.assertGreater(len(histo.counts), QM_uncertainty.MAX_BOOTSTRAP_BINS)
+        GMM = GMM_fit.GMM_fit(histo, 3)
+        start = time.time()
+        mu_boot = QM_uncertainty.bootstrap_GMM(histo, GMM, n_boot = 200)[0]
+        self.assertLess(time.time() - start, 30)
+        mu, sigma, weights, covariance = QM_uncertainty.parameter_covariance(histo, QM_uncertainty.refine_GMM(histo, GMM))
+        np.testing.assert_allclose(np.std(mu_boot, axis = 0), np.sqrt(np.diag(covariance)[:3]), rtol = 0.3)
+
+        start = time.time()
+        SNR_CNR_dfs = [QM_uncertainty.SNR_CNR_intervals(histo, GMM, method, n_boot = 200) for method in ["fisher", "bootstrap"]]
+        self.assertLess(time.time() - start, 30)
+        for column in ["SNR", "CNR"]: # both intervals are centred on the same refined model
+            np.testing.assert_array_equal(SNR_CNR_dfs[0][column], SNR_CNR_dfs[1][column])
+        for column in ["SNR_lower", "SNR_upper", "CNR_lower", "CNR_upper"]:
+            np.testing.assert_allclose(SNR_CNR_dfs[0][column], SNR_CNR_dfs[1][column], rtol = 1e-2)
+
+    def test_intervals(self):
+        """ Tests if confidence intervals are tabulated like QM_calc and saved by QM_runner
+        Raises
+        ------
+        AssertionError
+            Intervals should contain the estimates and be saved to SNR_CNR_Uncertainty.csv
+        """
+        for method in ["bootstrap", "fisher"]:
+            SNR_CNR_df = QM_uncertainty.SNR_CNR_intervals(self.histo, self.GMM, method, n_boot = 50)
+            self.assertEqual(list(SNR_CNR_df.columns), ["Gaussian_B", "SNR", "SNR_lower", "SNR_upper", "CNR", "CNR_lower", "CNR_upper"])
+            self.assertTrue(np.all(SNR_CNR_df["SNR_lower"] < SNR_CNR_df["SNR"]) and np.all(SNR_CNR_df["SNR"] < SNR_CNR_df["SNR_upper"]))
+            self.assertTrue(np.all(SNR_CNR_df["CNR_lower"] < SNR_CNR_df["CNR"]) and np.all(SNR_CNR_df["CNR"] < SNR_CNR_df["CNR_upper"]))
+        with self.assertRaises(ValueError):
+            QM_uncertainty.SNR_CNR_intervals(self.histo, self.GMM, "unknown")
+
+        fname = os.path.join(self.tmp_dir, "phantom.tif")
+        save_stack(fname, self.stack)
+        QM_runner.QM_runner(fname, 3, engine = "histogram", uncertainty = "fisher")
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "phantom_results", "SNR_CNR_Uncertainty.csv")))
+
+# suite = unittest.TestLoader().loadTestsFromTestCase(Test_Uncertainty)
+# unittest.TextTestRunner(verbosity = 2).run(suite)